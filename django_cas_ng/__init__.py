@@ -23,6 +23,17 @@ _DEFAULTS = {
     'CAS_VERSION': '2',
     'CAS_USERNAME_ATTRIBUTE': 'cas:user',
     'CAS_PROXY_CALLBACK': None,
+    'CAS_PROXY_TICKET_WORKERS': 8,
+    'CAS_PROXIED_SESSIONS_MAXSIZE': 256,
+    'CAS_SESSION_EXPIRY_REFRESH_INTERVAL': 3600,
+    'CAS_JANITOR_INTERVAL': 60,
+    'CAS_JANITOR_BATCH_SIZE': 1000,
+    'CAS_TICKET_STORE': 'django_cas_ng.stores.DatabaseTicketStore',
+    'CAS_TICKET_STORE_CACHE': 'default',
+    'CAS_DEFERRED_TICKET_WRITES': False,
+    'CAS_DEFERRED_TICKET_WRITES_QUEUE_SIZE': 1000,
+    'CAS_USER_CACHE_TIMEOUT': None,
+    'CAS_USER_CACHE': 'default',
     'CAS_LOGIN_MSG': _("Login succeeded. Welcome, %s."),
     'CAS_LOGGED_MSG': _("You are logged in as %s."),
     'CAS_STORE_NEXT': False,
@@ -34,7 +45,23 @@ _DEFAULTS = {
     'CAS_FORCE_SSL_SERVICE_URL': False,
     'CAS_CHECK_NEXT': True,
     'CAS_SESSION_FACTORY': None,
+    'CAS_HTTP_POOL_CONNECTIONS': 10,
+    'CAS_HTTP_POOL_MAXSIZE': 10,
+    'CAS_HTTP_TIMEOUT': None,
+    'CAS_HTTP_TIMEOUTS': {},
+    'CAS_HTTP_WARMUP': 0,
+    'CAS_HTTP_KEEPALIVE_INTERVAL': None,
+    'CAS_HTTP_PRECONNECT': False,
+    'CAS_CIRCUIT_BREAKER_THRESHOLD': None,
+    'CAS_CIRCUIT_BREAKER_RESET_TIMEOUT': 30,
+    'CAS_CIRCUIT_OPEN_RESPONSE': None,
+    'CAS_TICKET_REPLAY_TIMEOUT': 0,
+    'CAS_TICKET_REPLAY_CACHE': 'default',
+    'CAS_RESPONSE_FORMAT': 'XML',
+    'CAS_NATIVE_XML_PARSER': False,
     'CAS_MAP_AFFILIATIONS': False,
+    'CAS_AFFILIATIONS_PRUNE_GROUPS': None,
+    'CAS_AFFILIATIONS_CACHE_GROUPS': False,
     'CAS_AFFILIATIONS_HANDLERS': [],
     'CAS_AFFILIATIONS_KEY': 'affiliation',
     'CAS_ADMIN_AFFILIATION': None,
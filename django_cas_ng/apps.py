@@ -1,6 +1,19 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CASConfig(AppConfig):
     default_auto_field = 'django.db.models.AutoField'
     name = 'django_cas_ng'
+
+    def ready(self):
+        # Connects the receivers clearing the users cached by CASBackend
+        from . import backends  # noqa: F401
+        from .transport import start_keepalive, warmup
+
+        if settings.CAS_HTTP_WARMUP:
+            threading.Thread(target=warmup, kwargs={'connections': settings.CAS_HTTP_WARMUP},
+                             name='django-cas-ng-warmup', daemon=True).start()
+        start_keepalive()
@@ -1,32 +1,214 @@
 """CAS authentication backend"""
 
-from typing import Mapping, Optional
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User, Group
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpRequest
 
-from django_cas_ng.signals import cas_user_authenticated
+from django_cas_ng.signals import cas_user_authenticated, cas_user_logout
+
+from .utils import _get_users_in_bulk, get_cas_client
+from .validation import averify_ticket, verify_ticket
+
+__all__ = ['CASBackend', 'clear_cached_user']
 
-from .utils import get_cas_client
 
-__all__ = ['CASBackend']
+# Process-wide cache of the group ids by name, with CAS_AFFILIATIONS_CACHE_GROUPS.
+_group_ids: Dict[str, int] = {}
+
+
+def _get_user_cache_key(user_id: Any) -> str:
+    return 'django_cas_ng:user:%s' % user_id
+
+
+def clear_cached_user(user_id: Any) -> None:
+    """Forgets the user cached by :meth:`CASBackend.get_user` for ``user_id``."""
+    if settings.CAS_USER_CACHE_TIMEOUT:
+        caches[settings.CAS_USER_CACHE].delete(_get_user_cache_key(user_id))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _clear_cached_user_on_change(*, instance, **kwargs) -> None:
+    clear_cached_user(instance.pk)
+
+
+@receiver(cas_user_logout)
+def _clear_cached_user_on_logout(*, user, **kwargs) -> None:
+    if user is not None and user.pk is not None:
+        clear_cached_user(user.pk)
+
+
+def _get_group_ids(names: Set[str]) -> Dict[str, int]:
+    """Returns the id of the group of each of ``names``, creating the missing ones."""
+    if settings.CAS_AFFILIATIONS_CACHE_GROUPS:
+        group_ids = {name: _group_ids[name] for name in names if name in _group_ids}
+    else:
+        group_ids = {}
+    missing = names - group_ids.keys()
+    if missing:
+        group_ids.update(Group.objects.filter(name__in=missing).values_list('name', 'pk'))
+        missing -= group_ids.keys()
+    if missing:
+        # The primary keys of the rows inserted are not returned on every
+        # database, and ignored conflicts don't return any.
+        Group.objects.bulk_create([Group(name=name) for name in missing], ignore_conflicts=True)
+        group_ids.update(Group.objects.filter(name__in=missing).values_list('name', 'pk'))
+    if settings.CAS_AFFILIATIONS_CACHE_GROUPS:
+        _group_ids.update(group_ids)
+    return group_ids
+
+
+class _AttributePlan(NamedTuple):
+    # (CAS name, new name) pairs of CAS_RENAME_ATTRIBUTES
+    renames: Tuple[Tuple[str, str], ...]
+    # (not null, boolean) coercions of the attributes named after user fields
+    coercions: Dict[str, Tuple[bool, bool]]
+
+
+@lru_cache(maxsize=None)
+def _get_attribute_plan() -> _AttributePlan:
+    """
+    Compiles CAS_RENAME_ATTRIBUTES and the fields of the user model into the
+    steps applied to the attributes at each login, until the settings change.
+    """
+    renames = tuple(
+        (cas_attr_name, req_attr_name)
+        for cas_attr_name, req_attr_name in settings.CAS_RENAME_ATTRIBUTES.items()
+        if cas_attr_name != req_attr_name
+    )
+    coercions = {}
+    for field in get_user_model()._meta.fields:
+        not_null = not field.null
+        boolean = field.get_internal_type() == 'BooleanField'
+        if not_null or boolean:
+            coercions[field.name] = (not_null, boolean)
+    return _AttributePlan(renames, coercions)
+
+
+@receiver(setting_changed)
+def _clear_attribute_plan(*, setting: str, **kwargs) -> None:
+    if setting in ('CAS_RENAME_ATTRIBUTES', 'AUTH_USER_MODEL'):
+        _get_attribute_plan.cache_clear()
+
+
+def _rename_attributes(attributes: Dict[str, Any]) -> None:
+    for cas_attr_name, req_attr_name in _get_attribute_plan().renames:
+        if cas_attr_name in attributes:
+            attributes[req_attr_name] = attributes.pop(cas_attr_name)
+
+
+def _coerce_attributes(attributes: Dict[str, Any]) -> None:
+    """Replaces None by '' for non null fields and parses booleans, in place."""
+    coercions = _get_attribute_plan().coercions
+    for name, value in list(attributes.items()):
+        coercion = coercions.get(name)
+        if coercion is None:
+            continue
+        not_null, boolean = coercion
+        if not_null and value is None:
+            value = ''
+        if boolean:
+            value = value == 'True'
+        attributes[name] = value
+
+
+def _get_field_values(user: User) -> Dict[str, Any]:
+    return {
+        field.name: getattr(user, field.attname)
+        for field in user._meta.concrete_fields
+        if not field.primary_key
+    }
+
+
+def _get_changed_fields(user: User, saved_values: Mapping[str, Any]) -> List[str]:
+    """Returns the fields of ``user`` whose value differs from ``saved_values``."""
+    return [
+        name for name, value in _get_field_values(user).items()
+        if value != saved_values[name]
+    ]
+
+
+def _are_group_ids_valid(group_ids: Dict[str, int]) -> bool:
+    """Whether the groups of ``group_ids`` still exist, under the same names."""
+    return dict(
+        Group.objects.filter(pk__in=group_ids.values()).values_list('name', 'pk')
+    ) == group_ids
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def _clear_group_ids(**kwargs) -> None:
+    _group_ids.clear()
 
 
 class CASBackend(ModelBackend):
     """CAS authentication backend"""
 
-    def authenticate(self, request: HttpRequest, ticket: str, service: str) -> Optional[User]: # skipcq: PY-R1000
+    def authenticate(self, request: HttpRequest, ticket: str, service: str) -> Optional[User]:
         """
         Verifies CAS ticket and gets or creates User object
 
         :returns: [User] Authenticated User object or None if authenticate failed.
         """
         client = get_cas_client(service_url=service, request=request)
-        username, attributes, pgtiou = client.verify_ticket(ticket)
+        username, attributes, pgtiou = verify_ticket(client, ticket)
+
+        prepared = self._prepare_login(request, username, attributes)
+        if prepared is None:
+            return None
+        username, attributes = prepared
+
+        with transaction.atomic():
+            user, created = self._get_or_create_user(username, attributes)
+            return self._complete_login(request, user, created, username, attributes,
+                                        pgtiou, ticket, service)
+
+    async def aauthenticate(self, request: HttpRequest, ticket: str, service: str) -> Optional[User]:
+        """
+        Asynchronous version of :meth:`authenticate`.
+
+        The ticket is validated without blocking a thread and the user is
+        looked up with the async ORM. Other steps, which may call overridable
+        hooks and touch the session, run in a worker thread.
+
+        :returns: [User] Authenticated User object or None if authenticate failed.
+        """
+        client = get_cas_client(service_url=service, request=request)
+        username, attributes, pgtiou = await averify_ticket(client, ticket)
+
+        prepared = await sync_to_async(self._prepare_login)(request, username, attributes)
+        if prepared is None:
+            return None
+        username, attributes = prepared
+
+        user, created = await self._aget_or_create_user(username, attributes)
+        return await sync_to_async(transaction.atomic(self._complete_login))(
+            request, user, created, username, attributes, pgtiou, ticket, service)
+
+    def _prepare_login(self,
+                       request: HttpRequest,
+                       username: Optional[str],
+                       attributes: Optional[Dict[str, Any]],
+                       ) -> Optional[Tuple[str, Optional[Dict[str, Any]]]]:
+        """
+        Extracts and cleans the username from the validation response, then
+        renames the attributes.
+
+        :returns: (username, attributes) or None if the login must be rejected.
+        """
         if attributes and request:
             request.session['attributes'] = attributes
 
@@ -38,7 +220,6 @@ class CASBackend(ModelBackend):
 
         if not username:
             return None
-        user = None
         username = self.clean_username(username)
 
         if attributes:
@@ -48,39 +229,85 @@ class CASBackend(ModelBackend):
 
             # If we can, we rename the attributes as described in the settings file
             # Existing attributes will be overwritten
-            for cas_attr_name, req_attr_name in settings.CAS_RENAME_ATTRIBUTES.items():
-                if cas_attr_name in attributes and cas_attr_name is not req_attr_name:
-                    attributes[req_attr_name] = attributes[cas_attr_name]
-                    attributes.pop(cas_attr_name)
+            _rename_attributes(attributes)
 
-        UserModel = get_user_model()
+        return username, attributes
 
-        # Note that this could be accomplished in one try-except clause, but
-        # instead we use get_or_create when creating unknown users since it has
-        # built-in safeguards for multiple threads.
+    def _get_user_kwargs(self, username: str, attributes: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        UserModel = get_user_model()
         if settings.CAS_CREATE_USER:
             user_kwargs = {
                 UserModel.USERNAME_FIELD: username
             }
             if settings.CAS_CREATE_USER_WITH_ID:
                 user_kwargs['id'] = self.get_user_id(attributes)
-
-            user, created = UserModel._default_manager.get_or_create(**user_kwargs)
-            if created:
-                user = self.configure_user(user)
+        elif settings.CAS_LOCAL_NAME_FIELD:
+            user_kwargs = {
+                settings.CAS_LOCAL_NAME_FIELD: username
+            }
         else:
-            created = False
-            try:
-                if settings.CAS_LOCAL_NAME_FIELD:
-                    user_kwargs = {
-                        settings.CAS_LOCAL_NAME_FIELD: username
-
-                    }
-                    user = UserModel._default_manager.get(**user_kwargs)
-                else:
-                    user = UserModel._default_manager.get_by_natural_key(username)
-            except UserModel.DoesNotExist:
-                pass
+            user_kwargs = {}
+        return user_kwargs
+
+    def _get_or_create_user(self,
+                            username: str,
+                            attributes: Optional[Dict[str, Any]],
+                            ) -> Tuple[Optional[User], bool]:
+        UserModel = get_user_model()
+        user_kwargs = self._get_user_kwargs(username, attributes)
+
+        # Note that this could be accomplished in one try-except clause, but
+        # instead we use get_or_create when creating unknown users since it has
+        # built-in safeguards for multiple threads.
+        if settings.CAS_CREATE_USER:
+            return UserModel._default_manager.get_or_create(**user_kwargs)
+
+        try:
+            if user_kwargs:
+                return UserModel._default_manager.get(**user_kwargs), False
+            return UserModel._default_manager.get_by_natural_key(username), False
+        except UserModel.DoesNotExist:
+            return None, False
+
+    async def _aget_or_create_user(self,
+                                   username: str,
+                                   attributes: Optional[Dict[str, Any]],
+                                   ) -> Tuple[Optional[User], bool]:
+        UserModel = get_user_model()
+        user_kwargs = self._get_user_kwargs(username, attributes)
+
+        if settings.CAS_CREATE_USER:
+            return await UserModel._default_manager.aget_or_create(**user_kwargs)
+
+        try:
+            if user_kwargs:
+                return await UserModel._default_manager.aget(**user_kwargs), False
+            # Manager.aget_by_natural_key() is only available since Django 5.2.
+            return await UserModel._default_manager.aget(
+                **{UserModel.USERNAME_FIELD: username}), False
+        except UserModel.DoesNotExist:
+            return None, False
+
+    def _complete_login(self,  # skipcq: PY-R1000
+                        request: HttpRequest,
+                        user: Optional[User],
+                        created: bool,
+                        username: str,
+                        attributes: Optional[Dict[str, Any]],
+                        pgtiou: Optional[str],
+                        ticket: str,
+                        service: str,
+                        ) -> Optional[User]:
+        """
+        Configures the new user, applies the CAS attributes and affiliations
+        to the user, saving the changed fields at once, and sends the
+        ``cas_user_authenticated`` signal.
+
+        :returns: [User] Authenticated User object or None if authenticate failed.
+        """
+        saved_values = _get_field_values(user) if user else {}
+        if created:
+            user = self.configure_user(user)
 
         if not self.user_can_authenticate(user):
             return None
@@ -91,10 +318,7 @@ class CASBackend(ModelBackend):
         # Map CAS affiliations to Django groups
         if settings.CAS_MAP_AFFILIATIONS and user and attributes:
             affils = attributes.get(settings.CAS_AFFILIATIONS_KEY, [])
-            for affil in affils:
-                if affil:
-                    g, created = Group.objects.get_or_create(name=affil)
-                    user.groups.add(g)
+            self.sync_affiliation_groups(user, affils)
 
         if settings.CAS_AFFILIATIONS_HANDLERS and user and attributes:
             affils = attributes.get(settings.CAS_AFFILIATIONS_KEY, [])
@@ -105,16 +329,14 @@ class CASBackend(ModelBackend):
         if settings.CAS_STAFF_AFFILIATION and user and attributes:
             affils = attributes.get(settings.CAS_AFFILIATIONS_KEY, [])
             staff_status = settings.CAS_STAFF_AFFILIATION in affils
-            if user.is_staff != staff_status:
-                user.is_staff = staff_status
-                user.save()
+            user.is_staff = staff_status
 
         if settings.CAS_ADMIN_AFFILIATION and user and attributes:
             affils = attributes.get(settings.CAS_AFFILIATIONS_KEY, [])
             admin_status = settings.CAS_ADMIN_AFFILIATION in affils
-            if user.is_superuser != admin_status:
-                user.is_superuser = admin_status
-                user.save()
+            user.is_superuser = admin_status
+
+        update_fields = _get_changed_fields(user, saved_values) if user else []
 
         if settings.CAS_APPLY_ATTRIBUTES_TO_USER and attributes:
             # If we are receiving None for any values which cannot be NULL
@@ -122,23 +344,9 @@ class CASBackend(ModelBackend):
             # Possibly it would be desirable to let these throw an error
             # and push the responsibility to the CAS provider or remove
             # them from the dictionary entirely instead. Handling these
-            # is a little ambiguous.
-            user_model_fields = UserModel._meta.fields
-            for field in user_model_fields:
-                # Handle null -> '' conversions mentioned above
-                if not field.null:
-                    try:
-                        if attributes[field.name] is None:
-                            attributes[field.name] = ''
-                    except KeyError:
-                        continue
-                # Coerce boolean strings into true booleans
-                if field.get_internal_type() == 'BooleanField':
-                    try:
-                        boolean_value = attributes[field.name] == 'True'
-                        attributes[field.name] = boolean_value
-                    except KeyError:
-                        continue
+            # is a little ambiguous. Boolean strings are coerced into true
+            # booleans.
+            _coerce_attributes(attributes)
 
             user.__dict__.update(attributes)
 
@@ -146,7 +354,10 @@ class CASBackend(ModelBackend):
             # should save these attributes which have a corresponding
             # instance in the DB.
             if settings.CAS_CREATE_USER:
-                user.save()
+                update_fields = _get_changed_fields(user, saved_values)
+
+        if update_fields:
+            user.save(update_fields=update_fields)
 
         # send the `cas_user_authenticated` signal
         cas_user_authenticated.send(
@@ -162,6 +373,98 @@ class CASBackend(ModelBackend):
         )
         return user
 
+    def get_user(self, user_id: Any) -> Optional[User]:
+        """
+        Returns the user of ``user_id``, from the ``CAS_USER_CACHE`` cache for
+        ``CAS_USER_CACHE_TIMEOUT`` seconds when set. Cached users are
+        forgotten when saved, deleted or logged out.
+
+        :returns: [User] The User object, or None.
+        """
+        timeout = settings.CAS_USER_CACHE_TIMEOUT
+        if not timeout:
+            return super().get_user(user_id)
+        cache = caches[settings.CAS_USER_CACHE]
+        cache_key = _get_user_cache_key(user_id)
+        user = cache.get(cache_key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(cache_key, user, timeout)
+        return user
+
+    async def aget_user(self, user_id: Any) -> Optional[User]:
+        """
+        Async version of :meth:`get_user`, sharing its cache.
+
+        :returns: [User] The User object, or None.
+        """
+        timeout = settings.CAS_USER_CACHE_TIMEOUT
+        if not timeout:
+            return await super().aget_user(user_id)
+        cache = caches[settings.CAS_USER_CACHE]
+        cache_key = _get_user_cache_key(user_id)
+        user = await cache.aget(cache_key)
+        if user is None:
+            user = await super().aget_user(user_id)
+            if user is not None:
+                await cache.aset(cache_key, user, timeout)
+        return user
+
+    def get_users(self, user_ids: Iterable[Any]) -> Dict[Any, User]:
+        """
+        Batch version of :meth:`get_user`, loading the users missing from the
+        cache with a single query.
+
+        :returns: The User object of each of ``user_ids`` found.
+        """
+        user_ids = set(user_ids)
+        timeout = settings.CAS_USER_CACHE_TIMEOUT
+        if not timeout:
+            return _get_users_in_bulk(self, user_ids)
+        cache = caches[settings.CAS_USER_CACHE]
+        cache_keys = {_get_user_cache_key(user_id): user_id for user_id in user_ids}
+        users = {
+            cache_keys[cache_key]: user
+            for cache_key, user in cache.get_many(cache_keys).items()
+        }
+        found = _get_users_in_bulk(self, user_ids - users.keys())
+        if found:
+            cache.set_many({
+                _get_user_cache_key(user_id): user for user_id, user in found.items()
+            }, timeout)
+        users.update(found)
+        return users
+
+    def sync_affiliation_groups(self, user: User, affils: Iterable[str]) -> None:
+        """
+        Adds ``user`` to the group of each of ``affils``, creating the missing
+        groups, and removes it from its other groups whose name matches
+        ``CAS_AFFILIATIONS_PRUNE_GROUPS``. Costs a handful of queries whatever the number of
+        affiliations.
+
+        :param user: User object.
+        :param affils: [list] The CAS affiliations of the user.
+        """
+        names = {affil for affil in affils if affil}
+        group_ids = _get_group_ids(names)
+        current_names = dict(user.groups.values_list('pk', 'name'))
+        current = set(current_names)
+        if (settings.CAS_AFFILIATIONS_CACHE_GROUPS and set(group_ids.values()) - current
+                and not _are_group_ids_valid(group_ids)):
+            # Another process deleted or renamed some of the cached groups
+            _group_ids.clear()
+            group_ids = _get_group_ids(names)
+        wanted = set(group_ids.values())
+        if wanted - current:
+            user.groups.add(*(wanted - current))
+        if settings.CAS_AFFILIATIONS_PRUNE_GROUPS:
+            # Only the groups of past affiliations, not the ones granted in Django
+            pattern = re.compile(settings.CAS_AFFILIATIONS_PRUNE_GROUPS)
+            stale = [pk for pk in current - wanted if pattern.fullmatch(current_names[pk])]
+            if stale:
+                user.groups.remove(*stale)
+
     def get_user_id(self, attributes: Mapping[str, str]) -> str:
         """
         For use when CAS_CREATE_USER_WITH_ID is True. Will raise ImproperlyConfigured
@@ -211,7 +514,8 @@ class CASBackend(ModelBackend):
         Configures a user after creation and returns the updated user.
 
         This method is called immediately after a new user is created,
-        and can be used to perform custom setup actions.
+        and can be used to perform custom setup actions. The fields it
+        changes are saved with the other changes of the login.
 
         :param user: User object.
 
@@ -0,0 +1,135 @@
+"""Ticket writes run after the response, enabled by CAS_DEFERRED_TICKET_WRITES"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Optional
+
+from django.conf import settings
+from django.db import (
+    DatabaseError,
+    IntegrityError,
+    close_old_connections,
+    connections,
+    transaction,
+)
+
+__all__ = ['defer_write', 'flush']
+
+logger = logging.getLogger(__name__)
+
+# Number of times a write failing with a database error is retried.
+DEFERRED_WRITE_RETRIES = 3
+
+# Number of seconds the process waits at exit for the writes in progress.
+FLUSH_TIMEOUT = 10
+
+_lock = threading.Lock()
+_queue: Optional[queue.Queue] = None
+
+# Waits between retries, replaced by the tests.
+_sleep = time.sleep
+
+
+def _run(func: Callable[[], Any]) -> None:
+    for attempt in range(DEFERRED_WRITE_RETRIES + 1):
+        if attempt:
+            _sleep(0.1 * 2 ** (attempt - 1))
+            close_old_connections()
+        try:
+            func()
+            return
+        except IntegrityError:
+            # Would fail again
+            logger.exception('Deferred ticket write failed')
+            return
+        except DatabaseError:
+            if attempt == DEFERRED_WRITE_RETRIES:
+                logger.exception('Deferred ticket write failed after %d retries', attempt)
+        except Exception:
+            logger.exception('Deferred ticket write failed')
+            return
+
+
+def _work(writes: queue.Queue) -> None:
+    while True:
+        func = writes.get()
+        try:
+            _run(func)
+            if writes.empty():
+                connections.close_all()
+        finally:
+            writes.task_done()
+
+
+def _get_queue() -> queue.Queue:
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = queue.Queue(settings.CAS_DEFERRED_TICKET_WRITES_QUEUE_SIZE)
+            threading.Thread(target=_work, args=(_queue,),
+                             name='django-cas-ng-deferred-writes', daemon=True).start()
+        return _queue
+
+
+def _enqueue(func: Callable[[], Any]) -> None:
+    try:
+        _get_queue().put_nowait(func)
+    except queue.Full:
+        # Slow the requests down rather than losing writes
+        _run(func)
+
+
+def defer_write(func: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+    """
+    Calls ``func(*args, **kwargs)`` right away, or, when
+    ``CAS_DEFERRED_TICKET_WRITES`` is set, queues it once the current
+    transaction commits, to be called by a worker thread while the response
+    is sent. Failing calls are retried ``DEFERRED_WRITE_RETRIES`` times on
+    database errors other than integrity errors. When
+    ``CAS_DEFERRED_TICKET_WRITES_QUEUE_SIZE`` calls are already waiting,
+    ``func`` is called in the current thread instead.
+    """
+    func = partial(func, *args, **kwargs)
+    if not settings.CAS_DEFERRED_TICKET_WRITES:
+        func()
+        return
+    transaction.on_commit(partial(_enqueue, func))
+
+
+def flush(timeout: Optional[float] = None) -> bool:
+    """
+    Waits at most ``timeout`` seconds for the worker thread to run the
+    queued writes. Called at exit, with ``FLUSH_TIMEOUT``.
+
+    :returns: ``True`` if no write is left.
+    """
+    writes = _queue
+    if writes is None:
+        return True
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with writes.all_tasks_done:
+        while writes.unfinished_tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            writes.all_tasks_done.wait(remaining)
+    return True
+
+
+atexit.register(flush, FLUSH_TIMEOUT)
+
+
+def _after_fork_in_child() -> None:
+    # The worker thread of the parent process doesn't exist in the child.
+    global _lock, _queue
+    _lock = threading.Lock()
+    _queue = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
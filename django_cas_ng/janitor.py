@@ -0,0 +1,108 @@
+"""Background cleanup of orphaned and expired tickets, off the request path"""
+
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections, models
+from django.utils import timezone
+
+from .models import ProxyGrantingTicket, SessionTicket
+
+__all__ = ['run_janitor', 'schedule_janitor']
+
+# Number of seconds a PGT received on the proxy callback waits for the login
+# of its user before being considered orphaned.
+ORPHANED_PGT_TIMEOUT = 60
+
+_CACHE_KEY = 'django_cas_ng:janitor'
+
+_lock = threading.Lock()
+# monotonic() before which this process doesn't even ask the cache.
+_next_run = 0.0
+
+
+def _delete_batch(queryset: models.QuerySet, batch_size: int) -> int:
+    pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return 0
+    return queryset.model.objects.filter(pk__in=pks).delete()[0]
+
+
+def _clean_expired_batch(queryset: models.QuerySet, batch_size: int) -> int:
+    pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return 0
+    # Checks the sessions first when their expires_at may be outdated.
+    return queryset.model.objects.filter(pk__in=pks).clean_expired_sessions(batch_size)
+
+
+def run_janitor(batch_size: Optional[int] = None) -> Dict[str, int]:
+    """
+    Deletes at most ``batch_size`` rows, ``CAS_JANITOR_BATCH_SIZE`` by
+    default, of each kind of stale tickets: PGTs received on the proxy
+    callback but never claimed by a login, and PGTs and SessionTickets of
+    expired sessions.
+
+    :returns: The number of deleted rows of each kind.
+    """
+    batch_size = batch_size or settings.CAS_JANITOR_BATCH_SIZE
+    now = timezone.now()
+    expired_before = now - timedelta(seconds=settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL)
+    return {
+        'orphaned_pgts': _delete_batch(
+            ProxyGrantingTicket.objects.for_session_key(None).filter(
+                date__lt=now - timedelta(seconds=ORPHANED_PGT_TIMEOUT)),
+            batch_size),
+        'expired_pgts': _clean_expired_batch(
+            ProxyGrantingTicket.objects.filter(expires_at__lt=expired_before), batch_size),
+        'expired_session_tickets': _clean_expired_batch(
+            SessionTicket.objects.filter(expires_at__lt=expired_before), batch_size),
+    }
+
+
+def _run_in_background() -> None:
+    try:
+        run_janitor()
+    except DatabaseError:
+        # Contention with the requests, the next run will retry.
+        pass
+    finally:
+        connections.close_all()
+
+
+def schedule_janitor() -> bool:
+    """
+    Runs :func:`run_janitor` in a background thread, at most once every
+    ``CAS_JANITOR_INTERVAL`` seconds across all the processes sharing the
+    default cache. Does nothing when ``CAS_JANITOR_INTERVAL`` is ``None``.
+
+    :returns: ``True`` if a run was started.
+    """
+    global _next_run
+    interval = settings.CAS_JANITOR_INTERVAL
+    if not interval:
+        return False
+    now = time.monotonic()
+    with _lock:
+        if now < _next_run:
+            return False
+        _next_run = now + interval
+    if not cache.add(_CACHE_KEY, 1, interval):
+        return False
+    threading.Thread(target=_run_in_background, name='django-cas-ng-janitor', daemon=True).start()
+    return True
+
+
+def _after_fork_in_child() -> None:
+    global _lock, _next_run
+    _lock = threading.Lock()
+    _next_run = 0.0
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,12 +1,175 @@
-from django.core.management.base import BaseCommand
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from ... import models
 
 
+class InlineExecutor:
+    """Runs the submitted tasks right away, in the calling thread."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
 class Command(BaseCommand):
     args = ''
     help = "Clean SessionTicket and ProxyGrantingTicket linked to expired sessions"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=models.CLEAN_SESSIONS_BATCH_SIZE,
+            help='Number of rows checked at once (default: %(default)s).')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of primary key ranges cleaned in parallel, each with '
+                 'its own database connection (default: %(default)s).')
+        parser.add_argument(
+            '--max-runtime', type=float, default=None,
+            help='Stop after this many seconds, once the ranges in progress are done.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Count the rows which would be deleted without deleting them.')
+        parser.add_argument(
+            '--expired-only', action='store_true',
+            help='Only delete the rows whose recorded expiry date is past, '
+                 'without checking the session of the other rows.')
+        parser.add_argument(
+            '--state-file', default=None,
+            help='JSON file where the primary key up to which each table is '
+                 'clean is saved, to resume an interrupted run from there.')
+
     def handle(self, *args, **options):
-        models.ProxyGrantingTicket.clean_deleted_sessions()
-        models.SessionTicket.clean_deleted_sessions()
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive.')
+        self.options = options
+        self.deadline = None
+        if options['max_runtime'] is not None:
+            self.deadline = time.monotonic() + options['max_runtime']
+        self.state = self.load_state()
+
+        for model in (models.ProxyGrantingTicket, models.SessionTicket):
+            if not self.clean(model):
+                self.stdout.write('Stopped after --max-runtime, run again to resume.')
+                return
+
+    def load_state(self):
+        path = self.options['state_file']
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_state(self):
+        path = self.options['state_file']
+        if not path or self.options['dry_run']:
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, path)
+
+    def timed_out(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def clean(self, model):
+        """
+        Cleans the table of ``model`` from its saved watermark on, one range
+        of primary keys per task. Returns ``False`` if stopped by --max-runtime.
+        """
+        name = model.__name__
+        if self.timed_out():
+            return False
+        dry_run = self.options['dry_run']
+        expired = model.objects.clean_expired_sessions(self.options['batch_size'], dry_run,
+                                                       deadline=self.deadline)
+        self.stdout.write('{}: {} expired rows {}'.format(
+            name, expired, 'to delete' if dry_run else 'deleted'))
+        if self.timed_out():
+            return False
+        if self.options['expired_only']:
+            return True
+
+        queryset = model.objects.all()
+        watermark = self.state.get(name)
+        if watermark is not None:
+            queryset = queryset.filter(pk__gt=watermark)
+            self.stdout.write('{}: resuming after primary key {}'.format(name, watermark))
+
+        workers = self.options['workers']
+
+        def clean_range(first, last):
+            try:
+                return queryset.filter(pk__gte=first, pk__lte=last).clean_deleted_sessions(
+                    batch_size=None, dry_run=dry_run)
+            finally:
+                if workers > 1:
+                    connections.close_all()
+
+        start = time.monotonic()
+        scanned = deleted = 0
+        # Ranges in submission order: the watermark only moves past a range
+        # once all the ranges before it are done too.
+        pending = []
+        done = set()
+        finished = True
+        ranges = queryset.pk_ranges(self.options['batch_size'])
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else InlineExecutor()
+        with executor:
+            futures = {}
+            while True:
+                while len(futures) < workers * 2:
+                    if self.timed_out():
+                        finished = False
+                        break
+                    pk_range = next(ranges, None)
+                    if pk_range is None:
+                        break
+                    pending.append(pk_range)
+                    futures[executor.submit(clean_range, *pk_range[:2])] = pk_range
+                if not futures:
+                    break
+
+                completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    pk_range = futures.pop(future)
+                    deleted += future.result()
+                    scanned += pk_range[2]
+                    done.add(pk_range)
+                while pending and pending[0] in done:
+                    done.remove(pending[0])
+                    self.state[name] = pending.pop(0)[1]
+                self.save_state()
+                self.report(name, scanned, deleted, start)
+
+        if finished:
+            # Start from the beginning next time
+            self.state.pop(name, None)
+            self.save_state()
+            self.stdout.write('{}: done'.format(name))
+        return finished
+
+    def report(self, name, scanned, deleted, start):
+        elapsed = time.monotonic() - start
+        self.stdout.write('{}: {} rows scanned, {} {}, {:.0f} rows/s'.format(
+            name,
+            scanned,
+            deleted,
+            'to delete' if self.options['dry_run'] else 'deleted',
+            scanned / elapsed if elapsed > 0 else 0,
+        ))
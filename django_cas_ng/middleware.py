@@ -12,6 +12,7 @@ from django.urls import reverse
 from django.utils.deprecation import MiddlewareMixin
 from django.utils.translation import gettext_lazy as _
 
+from .models import EXPIRES_AT_SESSION_KEY, record_expires_at
 from .views import LoginView as cas_login, LogoutView as cas_logout
 
 __all__ = ["CASMiddleware"]
@@ -63,3 +64,15 @@ class CASMiddleware(MiddlewareMixin):
             raise PermissionDenied(_('You do not have staff privileges.'))
         params = urllib_parse.urlencode({REDIRECT_FIELD_NAME: request.get_full_path()})
         return HttpResponseRedirect(reverse(settings.CAS_LOGIN_URL_NAME) + '?' + params)
+
+    def process_response(self, request, response):
+        """Records the new expiry date of extended sessions in their tickets,
+        at most every CAS_SESSION_EXPIRY_REFRESH_INTERVAL seconds.
+        """
+        session = getattr(request, 'session', None)
+        if (session is not None
+                and (session.modified or settings.SESSION_SAVE_EVERY_REQUEST)
+                and response.status_code != 500
+                and EXPIRES_AT_SESSION_KEY in session):
+            record_expires_at(session)
+        return response
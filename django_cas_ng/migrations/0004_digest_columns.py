@@ -0,0 +1,58 @@
+import hashlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def get_digest(value):
+    if value is None:
+        return None
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def backfill_digests(apps, schema_editor):
+    for model_name, fields in (
+        ('SessionTicket', ('session_key', 'ticket')),
+        ('ProxyGrantingTicket', ('session_key',)),
+    ):
+        model = apps.get_model('django_cas_ng', model_name)
+        hash_fields = [field + '_hash' for field in fields]
+        batch = []
+        for obj in model.objects.only('pk', *fields).iterator(chunk_size=BATCH_SIZE):
+            for field, hash_field in zip(fields, hash_fields):
+                setattr(obj, hash_field, get_digest(getattr(obj, field)))
+            batch.append(obj)
+            if len(batch) >= BATCH_SIZE:
+                model.objects.bulk_update(batch, hash_fields)
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, hash_fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_cas_ng', '0003_auto_20210813_1226'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxygrantingticket',
+            name='session_key_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='sessionticket',
+            name='session_key_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='sessionticket',
+            name='ticket_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_digests, migrations.RunPython.noop, elidable=True),
+    ]
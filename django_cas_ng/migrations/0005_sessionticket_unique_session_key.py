@@ -0,0 +1,32 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def delete_duplicates(apps, schema_editor):
+    SessionTicket = apps.get_model('django_cas_ng', 'SessionTicket')
+    duplicates = (
+        SessionTicket.objects.values('session_key_hash')
+        .annotate(count=Count('pk'), last=Max('pk'))
+        .filter(count__gt=1)
+    )
+    # Keep the most recent ticket of each session
+    for duplicate in duplicates.iterator():
+        SessionTicket.objects.filter(
+            session_key_hash=duplicate['session_key_hash'],
+        ).exclude(pk=duplicate['last']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_cas_ng', '0004_digest_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop, elidable=True),
+        migrations.AlterField(
+            model_name='sessionticket',
+            name='session_key_hash',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
@@ -1,28 +1,263 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from importlib import import_module
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
 
 from cas import CASError
 from django.conf import settings
-from django.db import models
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.base import SessionBase
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+from django.core.cache import caches
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Exists, OuterRef
 from django.http import HttpRequest
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from .utils import get_cas_client, get_user_from_session
+from .utils import (
+    get_cas_client,
+    get_users_from_sessions,
+    is_session_authenticated,
+)
 
 SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
 
 SESSION_KEY_MAXLENGTH = 736
 
+# Number of rows checked at once by `clean_deleted_sessions`.
+CLEAN_SESSIONS_BATCH_SIZE = 1000
+
+# Length of the hex SHA-256 digests indexed in place of session keys and tickets.
+DIGEST_LENGTH = 64
+
+
+def get_digest(value: Optional[str]) -> Optional[str]:
+    """Returns the SHA-256 hex digest of `value`, `None` for `None`."""
+    if value is None:
+        return None
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+# Session key of the expiry date last recorded in the tickets of a session.
+EXPIRES_AT_SESSION_KEY = '_cas_expires_at'
+
+
+def record_expires_at(session: SessionBase) -> None:
+    """Records the expiry date of `session` in its tickets, unless it moved
+    by less than `CAS_SESSION_EXPIRY_REFRESH_INTERVAL` seconds since the
+    last time.
+    """
+    expires_at = session.get_expiry_date()
+    recorded = session.get(EXPIRES_AT_SESSION_KEY)
+    if (recorded is not None
+            and expires_at.timestamp() - recorded < settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL):
+        return
+    from .stores import get_ticket_store
+    get_ticket_store().touch(session.session_key[:SESSION_KEY_MAXLENGTH], expires_at)
+    session[EXPIRES_AT_SESSION_KEY] = expires_at.timestamp()
+
 
 class ProxyError(ValueError):
     pass
 
 
+def expires_at_is_tracked() -> bool:
+    """Whether `CASMiddleware` records the new expiry date of extended sessions."""
+    from .middleware import CASMiddleware
+
+    return any(
+        issubclass(import_string(path), CASMiddleware)
+        for path in getattr(settings, 'MIDDLEWARE', None) or ()
+    )
+
+
+class SessionKeyQuerySet(models.QuerySet):
+    def for_session_key(self, session_key: Optional[str]) -> models.QuerySet:
+        """Filters on `session_key` through its indexed digest."""
+        if session_key is not None:
+            session_key = session_key[:SESSION_KEY_MAXLENGTH]
+        return self.filter(session_key_hash=get_digest(session_key), session_key=session_key)
+
+    def for_session_keys(self, session_keys: Iterable[str]) -> models.QuerySet:
+        """Filters on any of `session_keys` through their indexed digests."""
+        session_keys = {session_key[:SESSION_KEY_MAXLENGTH] for session_key in session_keys}
+        return self.filter(
+            session_key_hash__in=[get_digest(session_key) for session_key in session_keys],
+            session_key__in=session_keys,
+        )
+
+    def pk_ranges(self, batch_size: int) -> Iterator[Tuple[int, int, int]]:
+        """Yields the first and last primary keys, and the number of rows,
+        of consecutive ranges of at most `batch_size` rows of this queryset,
+        without loading the rows.
+        """
+        ordered = self.order_by('pk')
+        last = None
+        while True:
+            chunk = ordered if last is None else ordered.filter(pk__gt=last)
+            pks = list(chunk.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return
+            last = pks[-1]
+            yield pks[0], last, len(pks)
+
+    def clean_expired_sessions(self, batch_size: int = CLEAN_SESSIONS_BATCH_SIZE,
+                               dry_run: bool = False,
+                               deadline: Optional[float] = None) -> int:
+        """Deletes the rows whose session expired, according to their
+        `expires_at`, with range scans of its index, `batch_size` rows at a time.
+        Rows without `expires_at` are left to `clean_deleted_sessions`.
+        Without `CASMiddleware`, `expires_at` is not updated when sessions
+        are extended: the sessions of these rows are checked, and the rows
+        of the live ones lose their `expires_at`.
+        Stops after the batch during which `time.monotonic()` reaches
+        `deadline`, if any.
+        Returns the number of deleted rows, or of rows which would be
+        deleted if `dry_run` is true.
+        """
+        # expires_at may lag behind the session expiry date by up to
+        # CAS_SESSION_EXPIRY_REFRESH_INTERVAL seconds.
+        cutoff = timezone.now() - timedelta(seconds=settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL)
+        expired = self.filter(expires_at__lt=cutoff)
+        deleted = 0
+        if not expires_at_is_tracked():
+            for first, last, _ in expired.pk_ranges(batch_size):
+                chunk = expired.filter(pk__gte=first, pk__lte=last)
+                deleted += chunk.clean_deleted_sessions(batch_size=None, dry_run=dry_run)
+                if not dry_run:
+                    chunk.update(expires_at=None)
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+            return deleted
+        if dry_run:
+            return expired.count()
+        while deadline is None or time.monotonic() < deadline:
+            pks = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            deleted += self.filter(pk__in=pks).delete()[0]
+        return deleted
+
+    def clean_deleted_sessions(self,
+                               batch_size: Optional[int] = CLEAN_SESSIONS_BATCH_SIZE,
+                               dry_run: bool = False,
+                               ) -> int:
+        """Deletes the rows whose session is gone or not authenticated
+        anymore, `batch_size` rows at a time, or all at once if `batch_size`
+        is `None`.
+        Returns the number of deleted rows, or of rows which would be
+        deleted if `dry_run` is true.
+        """
+        if _uses_session_table(self.db):
+            clean_chunk = _clean_chunk_with_session_table
+        elif issubclass(SessionStore, CacheSessionStore):
+            clean_chunk = _clean_chunk_with_session_cache
+        else:
+            clean_chunk = _clean_chunk_one_by_one
+        if batch_size is None:
+            return clean_chunk(self, dry_run)
+        return sum(
+            clean_chunk(self.filter(pk__gte=first, pk__lte=last), dry_run)
+            for first, last, _ in self.pk_ranges(batch_size)
+        )
+
+
+def _delete(queryset: models.QuerySet, dry_run: bool) -> int:
+    if dry_run:
+        return queryset.count()
+    return queryset.delete()[0]
+
+
+def _uses_session_table(using: str) -> bool:
+    """Whether sessions are stored in a table of the `using` database."""
+    return (
+        issubclass(SessionStore, DatabaseSessionStore)
+        and router.db_for_read(SessionStore.get_model_class()) == using
+    )
+
+
+def _clean_chunk_with_session_table(chunk: models.QuerySet, dry_run: bool) -> int:
+    Session = SessionStore.get_model_class()
+    live_sessions = Session.objects.filter(expire_date__gt=timezone.now())
+    # Sessions which are missing or expired, in a single statement
+    deleted = _delete(chunk.filter(
+        ~Exists(live_sessions.filter(session_key=OuterRef('session_key')))
+    ), dry_run)
+
+    # Sessions which are alive but anonymous
+    store = SessionStore()
+    anonymous = [
+        session_key
+        for session_key, session_data in live_sessions.filter(
+            session_key__in=chunk.values_list('session_key', flat=True)
+        ).values_list('session_key', 'session_data').iterator()
+        if not is_session_authenticated(store.decode(session_data))
+    ]
+    if anonymous:
+        deleted += _delete(chunk.filter(session_key__in=anonymous), dry_run)
+    return deleted
+
+
+def _clean_chunk_with_session_cache(chunk: models.QuerySet, dry_run: bool) -> int:
+    rows = list(chunk.values_list('pk', 'session_key'))
+    prefix = SessionStore.cache_key_prefix
+    # A single round trip for the whole chunk, sessions are not decoded
+    # nor their users loaded.
+    sessions = caches[settings.SESSION_CACHE_ALIAS].get_many(
+        [prefix + session_key for _, session_key in rows if session_key]
+    )
+    stale = [
+        pk for pk, session_key in rows
+        if not session_key or not is_session_authenticated(sessions.get(prefix + session_key, {}))
+    ]
+    if not stale:
+        return 0
+    return _delete(chunk.filter(pk__in=stale), dry_run)
+
+
+def _clean_chunk_one_by_one(chunk: models.QuerySet, dry_run: bool) -> int:
+    rows = list(chunk.values_list('pk', 'session_key'))
+    users = get_users_from_sessions(
+        SessionStore(session_key=session_key) for _, session_key in rows
+    )
+    stale = [
+        pk for pk, session_key in rows
+        if not users.get(session_key, AnonymousUser()).is_authenticated
+    ]
+    if not stale:
+        return 0
+    return _delete(chunk.filter(pk__in=stale), dry_run)
+
+
+class SessionTicketQuerySet(SessionKeyQuerySet):
+    def for_ticket(self, ticket: str) -> models.QuerySet:
+        """Filters on `ticket` through its indexed digest."""
+        return self.filter(ticket_hash=get_digest(ticket), ticket=ticket)
+
+    def for_tickets(self, tickets: Iterable[str]) -> models.QuerySet:
+        """Filters on any of `tickets` through their indexed digests."""
+        tickets = set(tickets)
+        return self.filter(
+            ticket_hash__in=[get_digest(ticket) for ticket in tickets],
+            ticket__in=tickets,
+        )
+
+
 class ProxyGrantingTicket(models.Model):
     class Meta:
         unique_together = ('session_key', 'user')
     session_key = models.CharField(
         max_length=SESSION_KEY_MAXLENGTH,
         blank=True, null=True)
+    session_key_hash = models.CharField(
+        max_length=DIGEST_LENGTH,
+        blank=True, null=True,
+        db_index=True, editable=False)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name="+",
@@ -33,14 +268,46 @@ class ProxyGrantingTicket(models.Model):
     pgtiou = models.CharField(max_length=255, null=True, blank=True)
     pgt = models.CharField(max_length=255, null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = SessionKeyQuerySet.as_manager()
+
+    def save(self, *args, **kwargs) -> None:
+        self.session_key_hash = get_digest(self.session_key)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'session_key' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'session_key_hash'}
+        super().save(*args, **kwargs)
 
     @classmethod
-    def clean_deleted_sessions(cls) -> None:
-        for pgt in cls.objects.all():
-            session = SessionStore(session_key=pgt.session_key)
-            user = get_user_from_session(session)
-            if not user.is_authenticated:
-                pgt.delete()
+    def clean_deleted_sessions(cls) -> int:
+        return cls.objects.clean_deleted_sessions()
+
+    @classmethod
+    def _get_pgt(cls, request: HttpRequest) -> str:
+        from .stores import get_ticket_store
+        session_key = request.session.session_key
+        if session_key is not None:
+            session_key = session_key[:SESSION_KEY_MAXLENGTH]
+        pgt = get_ticket_store().get_pgt(session_key, request.user)
+        if pgt is None:
+            raise ProxyError(
+                "INVALID_TICKET",
+                "No proxy ticket found for this HttpRequest object"
+            )
+        return pgt
+
+    @staticmethod
+    def _get_proxy_ticket(request: HttpRequest, pgt: str, service: str) -> str:
+        client = get_cas_client(service_url=service, request=request)
+        try:
+            return client.get_proxy_ticket(pgt)
+        # change CASError to ProxyError nicely
+        except CASError as error:
+            raise ProxyError(*error.args)
+        # just embed other errors
+        except Exception as e:
+            raise ProxyError(e)
 
     @classmethod
     def retrieve_pt(cls, request: HttpRequest, service: str) -> str:
@@ -49,36 +316,96 @@ class ProxyGrantingTicket(models.Model):
         retrieve a ticket.
         The function return a Proxy Ticket or raise `ProxyError`
         """
+        pgt = cls._get_pgt(request)
+        return cls._get_proxy_ticket(request, pgt, service)
+
+    @classmethod
+    def retrieve_pts(cls,
+                     request: HttpRequest,
+                     services: Iterable[str],
+                     ) -> Dict[str, Union[str, ProxyError]]:
+        """`request` should be the current HttpRequest object
+        `services` the services for which we want to retrieve a ticket.
+        The PGT is loaded once and the Proxy Tickets are requested
+        concurrently, by at most `CAS_PROXY_TICKET_WORKERS` threads.
+        The function return a dict mapping each service to its Proxy Ticket,
+        or to the `ProxyError` raised for it.
+        """
+        services = list(dict.fromkeys(services))
+        if not services:
+            return {}
         try:
-            pgt = cls.objects.get(
-                user=request.user,
-                session_key=request.session.session_key[:SESSION_KEY_MAXLENGTH]
-            ).pgt
-        except cls.DoesNotExist:
-            raise ProxyError(
-                "INVALID_TICKET",
-                "No proxy ticket found for this HttpRequest object"
-            )
-        else:
-            client = get_cas_client(service_url=service, request=request)
+            pgt = cls._get_pgt(request)
+        except ProxyError as error:
+            return {service: error for service in services}
+
+        def retrieve(service: str) -> Union[str, ProxyError]:
             try:
-                return client.get_proxy_ticket(pgt)
-            # change CASError to ProxyError nicely
-            except CASError as error:
-                raise ProxyError(*error.args)
-            # just embed other errors
-            except Exception as e:
-                raise ProxyError(e)
+                return cls._get_proxy_ticket(request, pgt, service)
+            except ProxyError as error:
+                return error
+
+        if len(services) == 1:
+            return {services[0]: retrieve(services[0])}
+        max_workers = min(len(services), settings.CAS_PROXY_TICKET_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(services, executor.map(retrieve, services)))
 
 
 class SessionTicket(models.Model):
     session_key = models.CharField(max_length=SESSION_KEY_MAXLENGTH)
     ticket = models.CharField(max_length=1024)
+    session_key_hash = models.CharField(max_length=DIGEST_LENGTH, unique=True, editable=False)
+    ticket_hash = models.CharField(max_length=DIGEST_LENGTH, db_index=True, editable=False)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = SessionTicketQuerySet.as_manager()
+
+    def _set_digests(self) -> None:
+        self.session_key_hash = get_digest(self.session_key)
+        self.ticket_hash = get_digest(self.ticket)
+
+    def save(self, *args, **kwargs) -> None:
+        self._set_digests()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'session_key' in update_fields:
+                update_fields.add('session_key_hash')
+            if 'ticket' in update_fields:
+                update_fields.add('ticket_hash')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def upsert(cls, session_key: str, ticket: str, expires_at: Optional[datetime] = None) -> None:
+        """Records `ticket` as the ticket of `session_key`, expiring at
+        `expires_at`, replacing the previous one, in a single
+        INSERT ... ON CONFLICT UPDATE statement where the database supports it.
+        """
+        st = cls(session_key=session_key[:SESSION_KEY_MAXLENGTH], ticket=ticket,
+                 expires_at=expires_at)
+        st._set_digests()
+        update_fields = ['ticket', 'ticket_hash', 'expires_at']
+        features = connections[router.db_for_write(cls)].features
+        if features.supports_update_conflicts_with_target:
+            cls.objects.bulk_create(
+                [st], update_conflicts=True, unique_fields=['session_key_hash'],
+                update_fields=update_fields)
+        elif features.supports_update_conflicts:
+            cls.objects.bulk_create(
+                [st], update_conflicts=True, update_fields=update_fields)
+        else:
+            values = {field: getattr(st, field) for field in update_fields}
+            if cls.objects.for_session_key(st.session_key).update(**values):
+                return
+            try:
+                with transaction.atomic(using=router.db_for_write(cls)):
+                    st.save(force_insert=True)
+            except IntegrityError:
+                # Created concurrently
+                cls.objects.for_session_key(st.session_key).update(**values)
 
     @classmethod
-    def clean_deleted_sessions(cls) -> None:
-        for st in cls.objects.all():
-            session = SessionStore(session_key=st.session_key)
-            user = get_user_from_session(session)
-            if not user.is_authenticated:
-                st.delete()
+    def clean_deleted_sessions(cls) -> int:
+        return cls.objects.clean_deleted_sessions()
@@ -0,0 +1,147 @@
+"""HTTP sessions to proxied backends, authenticated with CAS proxy tickets"""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib import parse as urllib_parse
+
+import requests
+from django.conf import settings
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from .models import SESSION_KEY_MAXLENGTH, ProxyError, ProxyGrantingTicket
+from .signals import cas_user_logout
+from .utils import _get_server_url
+
+__all__ = ['ProxiedSession', 'get_proxied_session', 'clear_proxied_sessions']
+
+_lock = threading.Lock()
+_sessions: 'OrderedDict[Tuple[str, str], ProxiedSession]' = OrderedDict()
+
+# Methods sent again after logging in to the backend, see RFC 9110.
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
+
+
+class ProxiedSession(requests.Session):
+    """
+    ``requests.Session`` to a backend proxied through CAS for ``service``.
+
+    The first request logs in to the backend by sending it a proxy ticket
+    retrieved with :meth:`ProxyGrantingTicket.retrieve_pt`. The backend then
+    authenticates the following requests with its own session cookie, kept
+    in the cookie jar of this session. A new proxy ticket is only retrieved
+    when the backend answers with a ``401`` or redirects to the CAS login
+    page, after what the request is sent again once if its method is
+    idempotent.
+
+    Only a weak reference to the Django request of the last
+    :func:`get_proxied_session` call is kept, to retrieve these proxy tickets.
+    """
+
+    def __init__(self, request: HttpRequest, service: str) -> None:
+        super().__init__()
+        self.service = service
+        self.logged_in = False
+        self.login_url = urllib_parse.urljoin(_get_server_url(request)[0] or '', 'login')
+        self.bind(request)
+
+    def bind(self, request: HttpRequest) -> None:
+        """Retrieves the next proxy tickets for the user of ``request``."""
+        self._http_request = weakref.ref(request)
+
+    def login(self, request: Optional[HttpRequest] = None) -> requests.Response:
+        """
+        Sends a new proxy ticket of the user of ``request``, by default the
+        last bound one, to ``service``. Raises ``ProxyError`` when the proxy
+        ticket cannot be retrieved.
+        """
+        if request is None:
+            request = self._http_request()
+            if request is None:
+                raise ProxyError('INVALID_REQUEST', 'The request of this session is gone')
+        ticket = ProxyGrantingTicket.retrieve_pt(request, self.service)
+        response = super().request('GET', self.service, params={'ticket': ticket})
+        response.close()
+        self.logged_in = not self.login_required(response)
+        return response
+
+    def login_required(self, response: requests.Response) -> bool:
+        """Returns ``True`` if ``response`` asks for a new proxy ticket."""
+        if response.status_code == 401:
+            return True
+        return any(
+            r.is_redirect
+            and urllib_parse.urljoin(r.url, r.headers['location']).startswith(self.login_url)
+            for r in response.history + [response]
+        )
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        if not self.logged_in:
+            self.login()
+        response = super().request(method, url, *args, **kwargs)
+        if not self.login_required(response):
+            return response
+        if method.upper() not in IDEMPOTENT_METHODS:
+            # Sending it again could apply it twice, log in for the next one.
+            self.logged_in = False
+            return response
+        response.close()
+        self.login()
+        return super().request(method, url, *args, **kwargs)
+
+
+def get_proxied_session(request: HttpRequest, service: str) -> ProxiedSession:
+    """
+    Returns the :class:`ProxiedSession` to ``service`` of the session of
+    ``request``, reused across requests of this session.
+
+    At most ``CAS_PROXIED_SESSIONS_MAXSIZE`` sessions are kept per process,
+    the least recently used ones are closed first. Requests without session
+    get a new session, which the caller must close.
+    """
+    if not request.session.session_key:
+        return ProxiedSession(request, service)
+    key = (request.session.session_key[:SESSION_KEY_MAXLENGTH], service)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = ProxiedSession(request, service)
+        else:
+            _sessions.move_to_end(key)
+        evicted = []
+        while len(_sessions) > max(settings.CAS_PROXIED_SESSIONS_MAXSIZE, 1):
+            evicted.append(_sessions.popitem(last=False)[1])
+    session.bind(request)
+    for old in evicted:
+        old.close()
+    return session
+
+
+def clear_proxied_sessions(session_key: str) -> None:
+    """Closes the proxied sessions of the user session ``session_key``."""
+    session_key = session_key[:SESSION_KEY_MAXLENGTH]
+    with _lock:
+        keys = [key for key in _sessions if key[0] == session_key]
+        closed = [_sessions.pop(key) for key in keys]
+    for session in closed:
+        session.close()
+
+
+@receiver(cas_user_logout)
+def _clear_proxied_sessions_on_logout(*, session, **kwargs) -> None:
+    if session is not None and session.session_key:
+        clear_proxied_sessions(session.session_key)
+
+
+def _after_fork_in_child() -> None:
+    # Sockets are shared with the parent process: forget them without closing.
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -6,3 +6,5 @@ from django import dispatch
 cas_user_authenticated = dispatch.Signal()
 
 cas_user_logout = dispatch.Signal()
+
+cas_circuit_breaker_state_changed = dispatch.Signal()
@@ -0,0 +1,263 @@
+"""Storage of the CAS tickets of the sessions, selected with CAS_TICKET_STORE"""
+
+import abc
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .janitor import ORPHANED_PGT_TIMEOUT, schedule_janitor
+from .models import (
+    SESSION_KEY_MAXLENGTH,
+    ProxyGrantingTicket,
+    SessionTicket,
+    expires_at_is_tracked,
+    get_digest,
+)
+
+__all__ = ['BaseTicketStore', 'DatabaseTicketStore', 'CacheTicketStore', 'get_ticket_store']
+
+# Number of seconds a login waits for another login of the same session to
+# save its tickets in the cache.
+LOGIN_LOCK_TIMEOUT = 5
+
+# How often such a login polls the cache lock.
+_POLL_INTERVAL = 0.05
+
+
+class BaseTicketStore(abc.ABC):
+    """
+    Records the service ticket each session was logged in with, to end it on
+    single logout requests, and the proxy granting ticket of its user, to
+    retrieve proxy tickets.
+
+    Session keys are truncated to ``SESSION_KEY_MAXLENGTH`` by the callers.
+    """
+
+    @abc.abstractmethod
+    def save_pgt(self, pgtiou: str, pgt: str) -> None:
+        """Records ``pgt`` received on the proxy callback, until the login claiming ``pgtiou``."""
+
+    @abc.abstractmethod
+    def save_login(self, session_key: str, user, ticket: str, pgtiou: Optional[str],
+                   expires_at: datetime) -> None:
+        """
+        Records ``ticket`` as the service ticket of ``session_key``, replacing
+        the previous one, and the PGT of ``pgtiou`` as the PGT of ``user`` in
+        it, until ``expires_at``.
+        """
+
+    @abc.abstractmethod
+    def touch(self, session_key: str, expires_at: datetime) -> None:
+        """Records the new expiry date of ``session_key``."""
+
+    @abc.abstractmethod
+    def get_ticket(self, session_key: Optional[str]) -> Optional[str]:
+        """Returns the service ticket of ``session_key``, if any."""
+
+    @abc.abstractmethod
+    def get_session_keys(self, tickets: Iterable[str]) -> Dict[str, str]:
+        """Returns the session key of each of ``tickets`` which has one."""
+
+    @abc.abstractmethod
+    def get_pgt(self, session_key: Optional[str], user) -> Optional[str]:
+        """Returns the PGT of ``user`` in ``session_key``, if any."""
+
+    @abc.abstractmethod
+    def delete(self, session_keys: Iterable[str]) -> None:
+        """Forgets the tickets of ``session_keys``."""
+
+
+class DatabaseTicketStore(BaseTicketStore):
+    """
+    Stores the tickets in the ``SessionTicket`` and ``ProxyGrantingTicket``
+    tables. The tickets of expired or deleted sessions are deleted by the
+    janitor and the ``django_cas_ng_clean_sessions`` command.
+    """
+
+    def save_pgt(self, pgtiou: str, pgt: str) -> None:
+        ProxyGrantingTicket.objects.create(pgtiou=pgtiou, pgt=pgt)
+        # Orphaned PGTs are deleted in the background
+        schedule_janitor()
+
+    def save_login(self, session_key: str, user, ticket: str, pgtiou: Optional[str],
+                   expires_at: datetime) -> None:
+        # As are the tickets of expired sessions
+        schedule_janitor()
+        SessionTicket.upsert(session_key, ticket, expires_at)
+        if pgtiou:
+            # Delete old PGT
+            ProxyGrantingTicket.objects.for_session_key(
+                session_key
+            ).filter(user=user).delete()
+            # Set new PGT ticket
+            ProxyGrantingTicket.objects.filter(pgtiou=pgtiou).update(
+                user=user,
+                session_key=session_key,
+                session_key_hash=get_digest(session_key),
+                expires_at=expires_at,
+            )
+
+    def touch(self, session_key: str, expires_at: datetime) -> None:
+        SessionTicket.objects.for_session_key(session_key).update(expires_at=expires_at)
+        ProxyGrantingTicket.objects.for_session_key(session_key).update(expires_at=expires_at)
+
+    def get_ticket(self, session_key: Optional[str]) -> Optional[str]:
+        return SessionTicket.objects.for_session_key(
+            session_key
+        ).values_list('ticket', flat=True).first()
+
+    def get_session_keys(self, tickets: Iterable[str]) -> Dict[str, str]:
+        return dict(SessionTicket.objects.for_tickets(tickets).values_list('ticket', 'session_key'))
+
+    def get_pgt(self, session_key: Optional[str], user) -> Optional[str]:
+        return ProxyGrantingTicket.objects.for_session_key(
+            session_key
+        ).filter(user=user).values_list('pgt', flat=True).first()
+
+    def delete(self, session_keys: Iterable[str]) -> None:
+        session_keys = list(session_keys)
+        ProxyGrantingTicket.objects.for_session_keys(session_keys).delete()
+        SessionTicket.objects.for_session_keys(session_keys).delete()
+
+
+class CacheTicketStore(BaseTicketStore):
+    """
+    Stores the tickets in the ``CAS_TICKET_STORE_CACHE`` cache, where they
+    expire together with their session: nothing needs to clean them up.
+    Extended sessions are only followed by `CASMiddleware`, which is thus
+    required.
+
+    Each session has an entry with its service ticket, its user and the PGT
+    of this user, and each service ticket an entry with its session key, for
+    single logout requests. Logins of the same session are serialized with a
+    lock in the cache, other updates are not atomic.
+    """
+
+    key_prefix = 'django_cas_ng:'
+
+    def __init__(self) -> None:
+        if not expires_at_is_tracked():
+            raise ImproperlyConfigured(
+                "CacheTicketStore requires 'django_cas_ng.middleware.CASMiddleware' in "
+                "MIDDLEWARE, to keep the tickets of extended sessions in the cache."
+            )
+
+    @property
+    def cache(self):
+        return caches[settings.CAS_TICKET_STORE_CACHE]
+
+    def _session_cache_key(self, session_key: str) -> str:
+        return self.key_prefix + 'session:' + get_digest(session_key[:SESSION_KEY_MAXLENGTH])
+
+    def _ticket_cache_key(self, ticket: str) -> str:
+        return self.key_prefix + 'ticket:' + get_digest(ticket)
+
+    def _pgtiou_cache_key(self, pgtiou: str) -> str:
+        return self.key_prefix + 'pgtiou:' + get_digest(pgtiou)
+
+    def _get_timeout(self, expires_at: datetime) -> int:
+        # The expiry date of a session is only recorded when it moved by
+        # CAS_SESSION_EXPIRY_REFRESH_INTERVAL, its tickets are kept for as long.
+        seconds = (expires_at - timezone.now()).total_seconds()
+        return max(int(seconds), 0) + settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL
+
+    def save_pgt(self, pgtiou: str, pgt: str) -> None:
+        self.cache.set(self._pgtiou_cache_key(pgtiou), pgt, ORPHANED_PGT_TIMEOUT)
+
+    def save_login(self, session_key: str, user, ticket: str, pgtiou: Optional[str],
+                   expires_at: datetime) -> None:
+        cache = self.cache
+        session_cache_key = self._session_cache_key(session_key)
+        # The entry is read, then replaced: logins of the same session take
+        # turns, unless one holds the lock for more than LOGIN_LOCK_TIMEOUT.
+        lock_key = session_cache_key + ':lock'
+        deadline = time.monotonic() + LOGIN_LOCK_TIMEOUT
+        while True:
+            locked = cache.add(lock_key, 1, LOGIN_LOCK_TIMEOUT)
+            if locked or time.monotonic() >= deadline:
+                break
+            time.sleep(_POLL_INTERVAL)
+
+        try:
+            entry = {'ticket': ticket, 'user': user.pk, 'pgt': None}
+            old_entry = cache.get(session_cache_key)
+            if old_entry is not None:
+                if old_entry['ticket'] != ticket:
+                    cache.delete(self._ticket_cache_key(old_entry['ticket']))
+                if old_entry['user'] == user.pk:
+                    entry['pgt'] = old_entry['pgt']
+            if pgtiou:
+                pgtiou_cache_key = self._pgtiou_cache_key(pgtiou)
+                entry['pgt'] = cache.get(pgtiou_cache_key)
+                cache.delete(pgtiou_cache_key)
+            cache.set_many({
+                session_cache_key: entry,
+                self._ticket_cache_key(ticket): session_key,
+            }, self._get_timeout(expires_at))
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    def touch(self, session_key: str, expires_at: datetime) -> None:
+        cache = self.cache
+        session_cache_key = self._session_cache_key(session_key)
+        entry = cache.get(session_cache_key)
+        if entry is None:
+            return
+        timeout = self._get_timeout(expires_at)
+        cache.touch(session_cache_key, timeout)
+        cache.touch(self._ticket_cache_key(entry['ticket']), timeout)
+
+    def get_ticket(self, session_key: Optional[str]) -> Optional[str]:
+        if session_key is None:
+            return None
+        entry = self.cache.get(self._session_cache_key(session_key))
+        return entry['ticket'] if entry is not None else None
+
+    def get_session_keys(self, tickets: Iterable[str]) -> Dict[str, str]:
+        cache_keys = {self._ticket_cache_key(ticket): ticket for ticket in tickets}
+        if not cache_keys:
+            return {}
+        return {
+            cache_keys[cache_key]: session_key
+            for cache_key, session_key in self.cache.get_many(cache_keys).items()
+        }
+
+    def get_pgt(self, session_key: Optional[str], user) -> Optional[str]:
+        if session_key is None:
+            return None
+        entry = self.cache.get(self._session_cache_key(session_key))
+        if entry is None or entry['user'] != user.pk:
+            return None
+        return entry['pgt']
+
+    def delete(self, session_keys: Iterable[str]) -> None:
+        cache = self.cache
+        cache_keys = [self._session_cache_key(session_key) for session_key in session_keys]
+        if not cache_keys:
+            return
+        entries = cache.get_many(cache_keys)
+        cache.delete_many(cache_keys + [
+            self._ticket_cache_key(entry['ticket']) for entry in entries.values()
+        ])
+
+
+@lru_cache(maxsize=None)
+def get_ticket_store() -> BaseTicketStore:
+    """Returns an instance of the ``CAS_TICKET_STORE`` class, cached until the setting changes."""
+    return import_string(settings.CAS_TICKET_STORE)()
+
+
+@receiver(setting_changed)
+def _clear_ticket_store(*, setting: str, **kwargs) -> None:
+    if setting in ('CAS_TICKET_STORE', 'MIDDLEWARE'):
+        get_ticket_store.cache_clear()
@@ -0,0 +1,546 @@
+"""Process-wide pooled HTTP transport used to talk to the CAS server"""
+
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .signals import cas_circuit_breaker_state_changed
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+__all__ = [
+    'CircuitBreaker',
+    'CircuitOpenError',
+    'circuit_breaker',
+    'get_async_client',
+    'get_pool_stats',
+    'get_session',
+    'get_timeout',
+    'awarmup',
+    'preconnect',
+    'reset_session',
+    'start_keepalive',
+    'warmup',
+]
+
+Timeout = Union[None, float, Tuple[Optional[float], Optional[float]]]
+
+# Last path segment of CAS server endpoints -> operation name used as key
+# of ``CAS_HTTP_TIMEOUTS``.
+_OPERATIONS = {
+    'validate': 'validate',
+    'serviceValidate': 'validate',
+    'proxyValidate': 'validate',
+    'samlValidate': 'validate',
+    'proxy': 'proxy',
+}
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_keepalive_pid: Optional[int] = None
+_preconnect_lock = threading.Lock()
+_preconnect_at = 0.0
+# Minimum number of seconds between two preconnects of a process.
+_PRECONNECT_INTERVAL = 5.0
+_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of contacting the CAS server while the circuit breaker is open."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Process-wide circuit breaker around the requests sent to the CAS server.
+
+    After ``CAS_CIRCUIT_BREAKER_THRESHOLD`` consecutive failures (connection
+    errors, timeouts or 5xx responses) the circuit opens and requests fail
+    immediately with :class:`CircuitOpenError`. After
+    ``CAS_CIRCUIT_BREAKER_RESET_TIMEOUT`` seconds a single probe request is let
+    through: its success closes the circuit, its failure opens it again.
+
+    Every transition sends the ``cas_circuit_breaker_state_changed`` signal.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.CAS_CIRCUIT_BREAKER_THRESHOLD)
+
+    def is_open(self) -> bool:
+        """Returns ``True`` if a request sent now would fail fast."""
+        if not self.enabled or self.state == self.CLOSED:
+            return False
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at < settings.CAS_CIRCUIT_BREAKER_RESET_TIMEOUT
+        return self._probing
+
+    def before_call(self) -> None:
+        """Raises :class:`CircuitOpenError` if the request must not be sent."""
+        if not self.enabled:
+            return
+        old_state = None
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < settings.CAS_CIRCUIT_BREAKER_RESET_TIMEOUT:
+                    raise CircuitOpenError('CAS server circuit breaker is open')
+                old_state = self._set_state(self.HALF_OPEN)
+            elif self._probing:
+                raise CircuitOpenError('CAS server circuit breaker is half-open, probe in progress')
+            self._probing = True
+        self._notify(old_state)
+
+    def record_success(self) -> None:
+        if not self.enabled:
+            return
+        old_state = None
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                old_state = self._set_state(self.CLOSED)
+        self._notify(old_state)
+
+    def record_failure(self) -> None:
+        if not self.enabled:
+            return
+        old_state = None
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED
+                    and self.failures >= settings.CAS_CIRCUIT_BREAKER_THRESHOLD):
+                self.opened_at = time.monotonic()
+                old_state = self._set_state(self.OPEN)
+        self._notify(old_state)
+
+    def release_probe(self) -> None:
+        """Lets another request probe the server, when the probe got no answer."""
+        with self._lock:
+            self._probing = False
+
+    def record_response(self, status_code: int) -> None:
+        if status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def _set_state(self, state: str) -> str:
+        old_state, self.state = self.state, state
+        return old_state
+
+    def _notify(self, old_state: Optional[str]) -> None:
+        if old_state is not None:
+            cas_circuit_breaker_state_changed.send(
+                sender=self.__class__,
+                breaker=self,
+                old_state=old_state,
+                new_state=self.state,
+                failures=self.failures,
+            )
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def get_timeout(url: str) -> Timeout:
+    """
+    Returns the timeout of the request to the CAS server ``url``:
+    ``CAS_HTTP_TIMEOUTS`` for its operation, or ``CAS_HTTP_TIMEOUT``.
+    """
+    path = url.split('?', 1)[0].rstrip('/')
+    operation = _OPERATIONS.get(path.rsplit('/', 1)[-1])
+    timeouts = settings.CAS_HTTP_TIMEOUTS
+    if operation in timeouts:
+        return timeouts[operation]
+    return settings.CAS_HTTP_TIMEOUT
+
+
+class _PoolStats:
+    """Thread-safe counters of connection reuse across all pools."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hits': self.requests - self.misses,
+                'misses': self.misses,
+            }
+
+
+_stats = _PoolStats()
+
+
+class _CountingPoolMixin:
+    """Counts every connection checkout, and the ones that had to open a new socket."""
+
+    def _get_conn(self, *args, **kwargs):
+        _stats.record_request()
+        return super()._get_conn(*args, **kwargs)
+
+    def _new_conn(self, *args, **kwargs):
+        _stats.record_miss()
+        return super()._new_conn(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    ``HTTPAdapter`` keeping connections to the CAS server alive between
+    requests, applying the ``CAS_HTTP_TIMEOUTS`` of the operation to requests
+    sent without timeout, and reporting to the circuit breaker.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        return _send(super().send, request, timeout, **kwargs)
+
+
+class CircuitBreakerAdapter(BaseAdapter):
+    """
+    Wraps the adapters of the session built by ``CAS_SESSION_FACTORY``,
+    applying the ``CAS_HTTP_TIMEOUTS`` and reporting to the circuit breaker
+    like :class:`PooledHTTPAdapter`.
+    """
+
+    def __init__(self, adapter: BaseAdapter) -> None:
+        super().__init__()
+        self.adapter = adapter
+
+    def send(self, request, timeout=None, **kwargs):
+        return _send(self.adapter.send, request, timeout, **kwargs)
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+def _send(send, request, timeout, **kwargs) -> requests.Response:
+    if timeout is None:
+        timeout = get_timeout(request.url)
+    circuit_breaker.before_call()
+    try:
+        response = send(request, timeout=timeout, **kwargs)
+    except Exception:
+        circuit_breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled, it tells nothing about the server
+        circuit_breaker.release_probe()
+        raise
+    circuit_breaker.record_response(response.status_code)
+    return response
+
+
+if httpx is not None:
+    class CircuitBreakerAsyncTransport(httpx.AsyncHTTPTransport):
+        """``httpx`` transport reporting to the circuit breaker."""
+
+        async def handle_async_request(self, request):
+            circuit_breaker.before_call()
+            try:
+                response = await super().handle_async_request(request)
+            except Exception:
+                circuit_breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled, it tells nothing about the server
+                circuit_breaker.release_probe()
+                raise
+            circuit_breaker.record_response(response.status_code)
+            return response
+
+
+def _build_session() -> requests.Session:
+    if settings.CAS_SESSION_FACTORY:
+        session = settings.CAS_SESSION_FACTORY()
+        for prefix, adapter in list(session.adapters.items()):
+            if not isinstance(adapter, (PooledHTTPAdapter, CircuitBreakerAdapter)):
+                session.mount(prefix, CircuitBreakerAdapter(adapter))
+        return session
+
+    session = requests.Session()
+    # The session is shared by every login in the process, never keep cookies
+    # set by the CAS server on one validation around for the next one.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = PooledHTTPAdapter(
+        pool_connections=settings.CAS_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.CAS_HTTP_POOL_MAXSIZE,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the ``requests.Session`` shared by every CAS client of the
+    current process.
+
+    The session is built on first use, either by ``CAS_SESSION_FACTORY`` or
+    with a pooled adapter configured by the ``CAS_HTTP_*`` settings.
+    """
+    global _session
+    session = _session
+    if session is None:
+        built = False
+        with _lock:
+            session = _session
+            if session is None:
+                session = _session = _build_session()
+                built = True
+        if built:
+            start_keepalive()
+    return session
+
+
+def get_async_client() -> Optional['httpx.AsyncClient']:
+    """
+    Returns the ``httpx.AsyncClient`` shared by the CAS clients running on the
+    current event loop, or ``None`` when httpx is not installed.
+
+    It honours the same ``CAS_HTTP_*`` and ``CAS_VERIFY_SSL_CERTIFICATE``
+    settings as the synchronous session. ``CAS_SESSION_FACTORY`` does not
+    apply to it.
+    """
+    if httpx is None:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=settings.CAS_HTTP_TIMEOUT,
+            transport=CircuitBreakerAsyncTransport(
+                verify=settings.CAS_VERIFY_SSL_CERTIFICATE,
+                limits=httpx.Limits(
+                    max_connections=settings.CAS_HTTP_POOL_MAXSIZE,
+                    max_keepalive_connections=settings.CAS_HTTP_POOL_MAXSIZE,
+                ),
+            ),
+            # See _build_session(): never keep cookies between validations.
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+    return client
+
+
+def reset_session() -> None:
+    """
+    Drops the shared session so that the next call to :func:`get_session`
+    builds a new one. Open connections are closed.
+
+    Async clients are dropped and closed as well, on their event loop.
+    """
+    global _session
+    with _lock:
+        session, _session = _session, None
+        async_clients = list(_async_clients.items())
+        _async_clients.clear()
+    if session is not None:
+        session.close()
+    for loop, client in async_clients:
+        _close_async_client(loop, client)
+
+
+def _close_async_client(loop: asyncio.AbstractEventLoop, client: 'httpx.AsyncClient') -> None:
+    if loop.is_closed():
+        # Too late, its sockets are closed when garbage collected.
+        return
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        loop.run_until_complete(client.aclose())
+    # else another event loop runs in this thread, and can't wait for this one.
+
+
+def _is_absolute(server_url: Optional[str]) -> bool:
+    return bool(server_url) and server_url.startswith(('http://', 'https://'))
+
+
+def warmup(server_url: Optional[str] = None, connections: int = 1) -> int:
+    """
+    Opens up to ``connections`` keep-alive connections from the shared
+    session to the CAS server, ``CAS_SERVER_URL`` by default, by sending
+    concurrent ``HEAD`` requests to it.
+
+    Does nothing when the server URL is relative. Errors are ignored.
+
+    :returns: [int] The number of successful requests.
+    """
+    server_url = server_url or settings.CAS_SERVER_URL
+    if not _is_absolute(server_url) or connections < 1:
+        return 0
+    session = get_session()
+
+    def ping(_) -> bool:
+        try:
+            response = session.head(server_url, allow_redirects=False,
+                                    verify=settings.CAS_VERIFY_SSL_CERTIFICATE)
+        except requests.RequestException:
+            return False
+        response.close()
+        return True
+
+    if connections == 1:
+        return int(ping(None))
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        return sum(executor.map(ping, range(connections)))
+
+
+async def awarmup(server_url: Optional[str] = None, connections: int = 1) -> int:
+    """
+    Asynchronous version of :func:`warmup` for the async client of the
+    running event loop, meant to be awaited from an ASGI lifespan startup
+    handler.
+
+    :returns: [int] The number of successful requests.
+    """
+    server_url = server_url or settings.CAS_SERVER_URL
+    client = get_async_client()
+    if client is None or not _is_absolute(server_url) or connections < 1:
+        return 0
+
+    async def ping() -> bool:
+        try:
+            await client.head(server_url)
+        except httpx.HTTPError:
+            return False
+        return True
+
+    return sum(await asyncio.gather(*(ping() for _ in range(connections))))
+
+
+def preconnect(server_url: Optional[str] = None) -> None:
+    """
+    Warms up a connection to the CAS server in a background thread, at most
+    once every few seconds, without blocking the caller.
+    """
+    global _preconnect_at
+    now = time.monotonic()
+    with _preconnect_lock:
+        if now - _preconnect_at < _PRECONNECT_INTERVAL:
+            return
+        _preconnect_at = now
+    threading.Thread(target=warmup, args=(server_url,),
+                     name='django-cas-ng-preconnect', daemon=True).start()
+
+
+def _keepalive_loop(pid: int) -> None:
+    while _keepalive_pid == pid and settings.CAS_HTTP_KEEPALIVE_INTERVAL:
+        time.sleep(settings.CAS_HTTP_KEEPALIVE_INTERVAL)
+        warmup()
+
+
+def start_keepalive() -> None:
+    """
+    Starts the thread pinging the CAS server every
+    ``CAS_HTTP_KEEPALIVE_INTERVAL`` seconds, once per process.
+    """
+    global _keepalive_pid
+    if not settings.CAS_HTTP_KEEPALIVE_INTERVAL or not _is_absolute(settings.CAS_SERVER_URL):
+        return
+    pid = os.getpid()
+    with _lock:
+        if _keepalive_pid == pid:
+            return
+        _keepalive_pid = pid
+    threading.Thread(target=_keepalive_loop, args=(pid,),
+                     name='django-cas-ng-keepalive', daemon=True).start()
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """
+    Returns the connection pool counters of the current process.
+
+    ``hits`` counts requests served over an already open connection,
+    ``misses`` requests that had to open a new one.
+    """
+    return _stats.snapshot()
+
+
+@receiver(setting_changed)
+def _reset_session_on_setting_changed(*, setting: str, **kwargs) -> None:
+    if setting in ('CAS_SESSION_FACTORY', 'CAS_VERIFY_SSL_CERTIFICATE') or setting.startswith('CAS_HTTP_'):
+        reset_session()
+    elif setting.startswith('CAS_CIRCUIT_BREAKER_'):
+        circuit_breaker.reset()
+
+
+def _after_fork_in_child() -> None:
+    # Sockets are shared with the parent process: forget them without
+    # closing, and start counting from scratch.
+    global _session, _lock, _stats, _preconnect_lock
+    _session = None
+    _preconnect_lock = threading.Lock()
+    _async_clients.clear()
+    circuit_breaker._lock = threading.Lock()
+    _lock = threading.Lock()
+    _stats = _PoolStats()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
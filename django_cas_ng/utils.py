@@ -1,20 +1,33 @@
+import copy
 import warnings
-from typing import Optional, Union
+from functools import lru_cache
+from importlib import import_module
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple, TypeVar, Union
 from urllib import parse as urllib_parse
 
-from cas import CASClient
+from asgiref.sync import sync_to_async
+from cas import CASClient, CASClientV1, CASClientV2, CASClientWithSAMLV1
 from django.conf import settings as django_settings
 from django.contrib.auth import (
     BACKEND_SESSION_KEY,
     REDIRECT_FIELD_NAME,
     SESSION_KEY,
+    get_user_model,
     load_backend,
 )
+from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.sessions.backends.base import SessionBase
+from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpRequest
 from django.shortcuts import resolve_url
 
+from .transport import get_async_client, get_session, get_timeout
+
+K = TypeVar('K')
+
 
 class RedirectException(Exception):
     """Signals that a redirect could not be handled."""
@@ -72,21 +85,28 @@ def get_service_url(request: HttpRequest, redirect_to: Optional[str] = None) ->
     return service
 
 
-def get_cas_client(
-    service_url: Optional[str] = None,
-    request: Optional[HttpRequest] = None,
-) -> CASClient:
-    """
-    initializes the CASClient according to
-    the CAS_* settings
-    """
+def _get_server_url(request: Optional[HttpRequest]) -> Tuple[Optional[str], Optional[str]]:
+    """Returns the CAS server URL and, if it is relative, the host it was resolved against."""
     # Handle CAS_SERVER_URL without protocol and hostname
     server_url = django_settings.CAS_SERVER_URL
     if server_url and request and server_url.startswith('/'):
         scheme = request.META.get("X-Forwarded-Proto", request.scheme)
-        server_url = scheme + "://" + request.META['HTTP_HOST'] + server_url
+        host = request.META['HTTP_HOST']
+        return scheme + "://" + host + server_url, host
     # assert server_url.startswith('http'), "settings.CAS_SERVER_URL invalid"
+    return server_url, None
+
 
+@lru_cache(maxsize=128)
+def _get_cas_client_template(
+    server_url: Optional[str],
+    version: Union[int, str],
+    host: Optional[str],
+) -> CASClient:
+    """
+    Builds a CASClient without service URL for the given server, version and
+    host. Results are cached until a ``CAS_*`` setting changes.
+    """
     if not django_settings.CAS_VERIFY_SSL_CERTIFICATE:
         warnings.warn(
             "`CAS_VERIFY_SSL_CERTIFICATE` is disabled, meaning that SSL certificates "
@@ -96,23 +116,77 @@ def get_cas_client(
         )
 
     kwargs = dict(
-        service_url=service_url,
-        version=django_settings.CAS_VERSION,
+        version=version,
         server_url=server_url,
         extra_login_params=django_settings.CAS_EXTRA_LOGIN_PARAMS,
         renew=django_settings.CAS_RENEW,
         username_attribute=django_settings.CAS_USERNAME_ATTRIBUTE,
         proxy_callback=django_settings.CAS_PROXY_CALLBACK,
-        verify_ssl_certificate=django_settings.CAS_VERIFY_SSL_CERTIFICATE
+        verify_ssl_certificate=django_settings.CAS_VERIFY_SSL_CERTIFICATE,
+        session=get_session(),
     )
-    if django_settings.CAS_SESSION_FACTORY:
-        kwargs['session'] = django_settings.CAS_SESSION_FACTORY()
-    if django_settings.CAS_VERSION == 1:
+    if version == 1:
         kwargs.pop('proxy_callback')
 
     return CASClient(**kwargs)
 
 
+def get_cas_client(
+    service_url: Optional[str] = None,
+    request: Optional[HttpRequest] = None,
+) -> CASClient:
+    """
+    initializes the CASClient according to
+    the CAS_* settings
+    """
+    server_url, host = _get_server_url(request)
+    template = _get_cas_client_template(server_url, django_settings.CAS_VERSION, host)
+
+    client = copy.copy(template)
+    client.service_url = service_url
+    client.session = get_session()
+    return client
+
+
+@receiver(setting_changed)
+def _clear_cas_client_templates(*, setting: str, **kwargs) -> None:
+    if setting.startswith('CAS_'):
+        _get_cas_client_template.cache_clear()
+
+
+async def averify_ticket(client: CASClient, ticket: str) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
+    """
+    Asynchronous counterpart of ``client.verify_ticket(ticket)``.
+
+    CAS 1.0, 2.0 and 3.0 tickets are validated with the shared
+    ``httpx.AsyncClient`` and the response is parsed by the client itself.
+    SAML clients, or any client when httpx is not installed, are validated in
+    a worker thread.
+    """
+    http = get_async_client()
+    if http is None or isinstance(client, CASClientWithSAMLV1):
+        return await sync_to_async(client.verify_ticket, thread_sensitive=False)(ticket)
+
+    if isinstance(client, CASClientV1):
+        url = urllib_parse.urljoin(client.server_url, 'validate')
+        response = await http.get(url, params={'ticket': ticket, 'service': client.service_url},
+                                  timeout=get_timeout(url))
+        lines = response.text.splitlines()
+        if len(lines) > 1 and lines[0].strip() == 'yes':
+            return lines[1].strip(), None, None
+        return None, None, None
+
+    if isinstance(client, CASClientV2):
+        params = {'ticket': ticket, 'service': client.service_url}
+        if client.proxy_callback:
+            params['pgtUrl'] = client.proxy_callback
+        url = urllib_parse.urljoin(client.server_url, client.url_suffix)
+        response = await http.get(url, params=params, timeout=get_timeout(url))
+        return client.verify_response(response.content)
+
+    return await sync_to_async(client.verify_ticket, thread_sensitive=False)(ticket)
+
+
 def get_user_from_session(session: SessionBase) -> Union[User, AnonymousUser]:
     """
     Get User object (or AnonymousUser() if not logged in) from session.
@@ -124,3 +198,89 @@ def get_user_from_session(session: SessionBase) -> Union[User, AnonymousUser]:
         return backend.get_user(user_id) or AnonymousUser()
     except KeyError:
         return AnonymousUser()
+
+
+def is_session_authenticated(session: Mapping[str, Any]) -> bool:
+    """
+    Returns whether a user is logged in ``session``, a session store or its
+    decoded data, without loading the user.
+    """
+    return SESSION_KEY in session and BACKEND_SESSION_KEY in session
+
+
+def get_users_from_session_data(
+    sessions: Mapping[K, Mapping[str, Any]],
+) -> Dict[K, Union[User, AnonymousUser]]:
+    """
+    Batch version of :func:`get_user_from_session` for ``sessions`` mapping
+    any key to a session store or its decoded data. The users of each
+    authentication backend are loaded with a single query when the backend
+    doesn't override ``ModelBackend.get_user``, or with its ``get_users``
+    method, taking user ids and returning the users found by user id.
+
+    :returns: The User object, or AnonymousUser(), of each key of ``sessions``.
+    """
+    users: Dict[K, Union[User, AnonymousUser]] = {}
+    by_backend: Dict[str, Dict[K, Any]] = {}
+    for key, session in sessions.items():
+        users[key] = AnonymousUser()
+        if is_session_authenticated(session):
+            by_backend.setdefault(session[BACKEND_SESSION_KEY], {})[key] = session[SESSION_KEY]
+
+    for backend_path, user_ids in by_backend.items():
+        try:
+            backend = load_backend(backend_path)
+        except ImportError:
+            continue
+        if hasattr(backend, 'get_users'):
+            found = backend.get_users(user_ids.values())
+        elif type(backend).get_user is not ModelBackend.get_user:
+            for key, user_id in user_ids.items():
+                users[key] = backend.get_user(user_id) or AnonymousUser()
+            continue
+        else:
+            found = _get_users_in_bulk(backend, user_ids.values())
+        for key, user_id in user_ids.items():
+            user = found.get(user_id)
+            if user is not None:
+                users[key] = user
+    return users
+
+
+def _get_users_in_bulk(backend: ModelBackend, user_ids: Iterable[Any]) -> Dict[Any, User]:
+    """
+    Loads the users of ``user_ids``, as stored in sessions, with a single
+    query, and returns those ``backend`` lets authenticate by user id.
+    """
+    UserModel = get_user_model()
+    pks = {}
+    for user_id in user_ids:
+        try:
+            pks[user_id] = UserModel._meta.pk.to_python(user_id)
+        except ValidationError:
+            pass
+    found = UserModel._default_manager.in_bulk(set(pks.values()))
+    return {
+        user_id: found[pk]
+        for user_id, pk in pks.items()
+        if pk in found and backend.user_can_authenticate(found[pk])
+    }
+
+
+def get_users_from_sessions(
+    sessions: Iterable[Union[SessionBase, str]],
+) -> Dict[str, Union[User, AnonymousUser]]:
+    """
+    Batch version of :func:`get_user_from_session` for session stores or
+    session keys, see :func:`get_users_from_session_data`.
+
+    :returns: The User object, or AnonymousUser(), of each session key.
+    """
+    SessionStore = import_module(django_settings.SESSION_ENGINE).SessionStore
+    stores = {}
+    for session in sessions:
+        if isinstance(session, str):
+            session = SessionStore(session_key=session)
+        # Read the key first: loading a missing session forgets it
+        stores[session.session_key] = session
+    return get_users_from_session_data(stores)
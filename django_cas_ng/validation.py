@@ -0,0 +1,353 @@
+"""CAS ticket validation shared by the authentication backend"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import time
+import weakref
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+from urllib import parse as urllib_parse
+from xml.etree.ElementTree import XMLParser
+
+from cas import CASClient, CASClientV2, CASClientV3, CASClientWithSAMLV1
+from django.conf import settings
+from django.core.cache import caches
+
+from .transport import get_async_client, get_timeout
+from .utils import averify_ticket as _averify_ticket
+
+__all__ = ['verify_ticket', 'averify_ticket', 'parse_json_response', 'parse_xml_response']
+
+ValidationResult = Tuple[Optional[str], Optional[Dict[str, Any]], Optional[str]]
+
+# How often a process waiting on a validation running in another process
+# polls the cache for its result.
+_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    """A validation in flight in this process."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[ValidationResult] = None
+        self.error: Optional[BaseException] = None
+
+
+_MISSING = object()
+
+_inflight: Dict[str, _Call] = {}
+_inflight_lock = threading.Lock()
+
+# The validations in flight on each event loop.
+_ainflight: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+_ATTRIBUTES_TAGS = frozenset(('attributes', 'norEduPerson'))
+_CHUNK_SIZE = 64 * 1024
+
+
+class _LocalNames(dict):
+    """Maps ``{namespace}tag`` to ``tag``, computing each distinct tag once."""
+
+    def __missing__(self, tag: str) -> str:
+        local = self[tag] = tag.rpartition('}')[2]
+        return local
+
+
+_local_names = _LocalNames()
+
+
+def parse_xml_response(chunks: Iterable[bytes], version: Union[int, str] = '3') -> ValidationResult:
+    """
+    Parses a CAS 2.0/3.0 XML validation response, fed as an iterable of
+    ``chunks``, into the ``(username, attributes, pgtiou)`` triple returned
+    by ``CASClientV2``/``CASClientV3.verify_response`` for the same document.
+
+    Chunks are fed to the parser as they arrive, so the raw response is never
+    held in memory along with the tree, and the tree is walked once.
+    """
+    parser = XMLParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    root = parser.close()
+
+    local_names = _local_names
+    is_v2 = str(version) == '2'
+    user = None
+    attributes: Dict[str, Any] = {}
+    pgtiou = None
+
+    success = root[0] if len(root) else None
+    if success is not None and local_names[success.tag] == 'authenticationSuccess':
+        for element in success.iter():
+            if local_names[element.tag] == 'user':
+                user = element.text
+                break
+        for element in success:
+            name = local_names[element.tag]
+            if name == 'proxyGrantingTicket':
+                pgtiou = element.text
+            elif name in _ATTRIBUTES_TAGS:
+                # Like python-cas, the last attributes element wins
+                attributes = {}
+                for attribute in element:
+                    name = local_names[attribute.tag]
+                    value = attributes.get(name, _MISSING)
+                    if value is _MISSING:
+                        if not (is_v2 and name == 'attraStyle'):
+                            attributes[name] = attribute.text
+                    elif type(value) is list:
+                        value.append(attribute.text)
+                    else:
+                        attributes[name] = [value, attribute.text]
+
+    if is_v2 and not attributes:
+        return user, None, pgtiou
+    return user, attributes, pgtiou
+
+
+def _uses_native_parser(client: CASClient) -> bool:
+    return (
+        settings.CAS_NATIVE_XML_PARSER
+        and isinstance(client, CASClientV2)
+        and not isinstance(client, CASClientWithSAMLV1)
+    )
+
+
+def _get_version(client: CASClient) -> str:
+    return '3' if isinstance(client, CASClientV3) else '2'
+
+
+def _get_xml_request(client: CASClient, ticket: str) -> Tuple[str, Dict[str, str]]:
+    params = {
+        'ticket': ticket,
+        'service': client.service_url,
+    }
+    if client.proxy_callback:
+        params['pgtUrl'] = client.proxy_callback
+    return urllib_parse.urljoin(client.server_url, client.url_suffix), params
+
+
+def _uses_json(client: CASClient) -> bool:
+    return settings.CAS_RESPONSE_FORMAT == 'JSON' and isinstance(client, CASClientV3)
+
+
+def _get_json_request(client: CASClient, ticket: str) -> Tuple[str, Dict[str, str]]:
+    params = {
+        'ticket': ticket,
+        'service': client.service_url,
+        'format': 'JSON',
+    }
+    if client.proxy_callback:
+        params['pgtUrl'] = client.proxy_callback
+    return urllib_parse.urljoin(client.server_url, client.url_suffix), params
+
+
+def parse_json_response(content: Union[str, bytes]) -> ValidationResult:
+    """
+    Parses a CAS 3.0 ``format=JSON`` validation response into the
+    ``(username, attributes, pgtiou)`` triple returned by ``CASClientV3``
+    for the equivalent XML document: single values are unwrapped from
+    their list, scalar values are converted to strings, ``null`` to ``None``,
+    and ``attributes`` is ``{}`` when there are none.
+    """
+    response = json.loads(content)['serviceResponse']
+    success = response.get('authenticationSuccess')
+    if not success:
+        return None, {}, None
+
+    attributes = success.get('attributes') or {}
+    for name, value in attributes.items():
+        if isinstance(value, list):
+            value = [_to_text(item) for item in value]
+            if len(value) == 1:
+                value = value[0]
+        else:
+            value = _to_text(value)
+        attributes[name] = value
+    return success.get('user'), attributes, success.get('proxyGrantingTicket')
+
+
+def _to_text(value: Any) -> Any:
+    # XML attribute values are strings, or None when empty
+    if value is None or isinstance(value, (str, dict)):
+        return value
+    if isinstance(value, bool):
+        return json.dumps(value)
+    return str(value)
+
+
+def _verify(client: CASClient, ticket: str) -> ValidationResult:
+    if _uses_native_parser(client) and not _uses_json(client):
+        url, params = _get_xml_request(client, ticket)
+        response = client.session.get(url, params=params, stream=True,
+                                      verify=client.verify_ssl_certificate)
+        try:
+            return parse_xml_response(response.iter_content(_CHUNK_SIZE), _get_version(client))
+        finally:
+            response.close()
+
+    if not _uses_json(client):
+        return client.verify_ticket(ticket)
+
+    url, params = _get_json_request(client, ticket)
+    response = client.session.get(url, params=params, verify=client.verify_ssl_certificate)
+    try:
+        return parse_json_response(response.content)
+    finally:
+        response.close()
+
+
+async def _averify(client: CASClient, ticket: str) -> ValidationResult:
+    http = get_async_client()
+    if http is not None and _uses_native_parser(client) and not _uses_json(client):
+        url, params = _get_xml_request(client, ticket)
+        response = await http.get(url, params=params, timeout=get_timeout(url))
+        return parse_xml_response((response.content,), _get_version(client))
+
+    if http is None or not _uses_json(client):
+        return await _averify_ticket(client, ticket)
+
+    url, params = _get_json_request(client, ticket)
+    response = await http.get(url, params=params, timeout=get_timeout(url))
+    return parse_json_response(response.content)
+
+
+def _cache_key(ticket: str, service: Optional[str]) -> str:
+    digest = hashlib.sha256('{}\0{}'.format(service, ticket).encode('utf-8')).hexdigest()
+    return 'django_cas_ng:validation:' + digest
+
+
+def verify_ticket(client: CASClient, ticket: str) -> ValidationResult:
+    """
+    Validates ``ticket`` with ``client`` and returns the
+    ``(username, attributes, pgtiou)`` triple.
+
+    With ``CAS_RESPONSE_FORMAT = 'JSON'``, CAS 3.0 tickets are validated
+    with ``format=JSON`` instead of parsing the XML response.
+
+    When ``CAS_TICKET_REPLAY_TIMEOUT`` is set, concurrent validations of the
+    same (ticket, service) in this process wait for the first one, other
+    processes wait for it through the ``CAS_TICKET_REPLAY_CACHE`` cache, and
+    its result is reused by duplicates for ``CAS_TICKET_REPLAY_TIMEOUT``
+    seconds.
+    """
+    if not settings.CAS_TICKET_REPLAY_TIMEOUT:
+        return _verify(client, ticket)
+
+    key = _cache_key(ticket, client.service_url)
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result)
+
+    try:
+        call.result = _verify_shared(client, ticket, key)
+        return copy.deepcopy(call.result)
+    except BaseException as error:
+        call.error = error
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call.done.set()
+
+
+def _verify_shared(client: CASClient, ticket: str, key: str) -> ValidationResult:
+    cache = caches[settings.CAS_TICKET_REPLAY_CACHE]
+    timeout = settings.CAS_TICKET_REPLAY_TIMEOUT
+    lock_key = key + ':lock'
+
+    deadline = time.monotonic() + timeout
+    while True:
+        result = cache.get(key)
+        if result is not None:
+            return tuple(result)
+        locked = cache.add(lock_key, 1, timeout)
+        if locked or time.monotonic() >= deadline:
+            break
+        # Another process is validating this ticket, wait for its result.
+        time.sleep(_POLL_INTERVAL)
+
+    try:
+        result = _verify(client, ticket)
+        cache.set(key, result, timeout)
+        return result
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+async def averify_ticket(client: CASClient, ticket: str) -> ValidationResult:
+    """
+    Asynchronous version of :func:`verify_ticket`. Concurrent validations
+    of the same (ticket, service) are coalesced per event loop.
+    """
+    if not settings.CAS_TICKET_REPLAY_TIMEOUT:
+        return await _averify(client, ticket)
+
+    key = _cache_key(ticket, client.service_url)
+    loop = asyncio.get_running_loop()
+    inflight = _ainflight.setdefault(loop, {})
+    while key in inflight:
+        future = inflight[key]
+        try:
+            return copy.deepcopy(await asyncio.shield(future))
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # The first validation was cancelled, take over.
+
+    future = inflight[key] = loop.create_future()
+    try:
+        result = await _averify_shared(client, ticket, key)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as error:
+        future.set_exception(error)
+        # Mark it retrieved, there may be no other caller.
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return copy.deepcopy(result)
+    finally:
+        del inflight[key]
+
+
+async def _averify_shared(client: CASClient, ticket: str, key: str) -> ValidationResult:
+    cache = caches[settings.CAS_TICKET_REPLAY_CACHE]
+    timeout = settings.CAS_TICKET_REPLAY_TIMEOUT
+    lock_key = key + ':lock'
+
+    deadline = time.monotonic() + timeout
+    while True:
+        result = await cache.aget(key)
+        if result is not None:
+            return tuple(result)
+        locked = await cache.aadd(lock_key, 1, timeout)
+        if locked or time.monotonic() >= deadline:
+            break
+        # Another process is validating this ticket, wait for its result.
+        await asyncio.sleep(_POLL_INTERVAL)
+
+    try:
+        result = await _averify(client, ticket)
+        await cache.aset(key, result, timeout)
+        return result
+    finally:
+        if locked:
+            await cache.adelete(lock_key)
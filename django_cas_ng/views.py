@@ -1,41 +1,91 @@
 """CAS login/logout replacement views"""
 
 
-from datetime import timedelta
+import inspect
 from importlib import import_module
-from typing import Any
+from typing import Any, Optional, Tuple
 from urllib import parse as urllib_parse
 
+import django
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
+from django.contrib.auth import (
+    _clean_credentials,
+    _get_backends,
+    authenticate,
+    login as auth_login,
+    logout as auth_logout,
+)
+from django.contrib.auth.signals import user_login_failed
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.http import (
     HttpRequest,
     HttpResponse,
     HttpResponseBadRequest,
     HttpResponseRedirect,
 )
-from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import SESSION_KEY_MAXLENGTH, ProxyGrantingTicket, SessionTicket
+from .deferred import defer_write
+from .models import EXPIRES_AT_SESSION_KEY, SESSION_KEY_MAXLENGTH
 from .signals import cas_user_logout
+from .stores import get_ticket_store
+from .transport import CircuitOpenError, preconnect
 from .utils import (
     RedirectException,
     get_cas_client,
     get_protocol,
     get_redirect_url,
     get_service_url,
-    get_user_from_session,
+    get_users_from_session_data,
 )
 
 SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
-__all__ = ['LoginView', 'LogoutView', 'CallbackView']
+
+async def _aauthenticate(request: Optional[HttpRequest] = None, **credentials: Any):
+    """
+    ``aauthenticate`` of Django 5.2: the ``aauthenticate`` method of the
+    backends is awaited, other backends are called in a worker thread.
+    Before 5.2, ``django.contrib.auth.aauthenticate`` calls ``authenticate``
+    in a worker thread, which would hold it during the validation.
+    """
+    for backend, backend_path in _get_backends(return_tuples=True):
+        try:
+            inspect.signature(backend.authenticate).bind(request, **credentials)
+        except TypeError:
+            # This backend doesn't accept these credentials as arguments.
+            continue
+        try:
+            if hasattr(backend, 'aauthenticate'):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(request, **credentials)
+        except PermissionDenied:
+            # This backend says to stop in our tracks - this user should not be allowed in at all.
+            break
+        if user is None:
+            continue
+        user.backend = backend_path
+        return user
+
+    # Signal.asend() is only available since Django 5.0.
+    await sync_to_async(user_login_failed.send)(
+        sender=__name__, credentials=_clean_credentials(credentials), request=request)
+    return None
+
+
+if django.VERSION >= (5, 2):
+    from django.contrib.auth import aauthenticate
+else:
+    aauthenticate = _aauthenticate
+
+__all__ = ['LoginView', 'AsyncLoginView', 'LogoutView', 'CallbackView']
 
 
 def clean_next_page(request, next_page):
@@ -100,6 +150,40 @@ class LoginView(View):
         :param request:
         :return:
         """
+        next_page, service_url = self._get_next_page(request)
+
+        if request.user.is_authenticated:
+            return self._already_logged_in(request, next_page)
+
+        client = get_cas_client(service_url=service_url, request=request)
+        ticket = request.GET.get('ticket')
+        if not ticket:
+            return self._redirect_to_login(request, client, next_page)
+
+        try:
+            user = authenticate(ticket=ticket,
+                                service=service_url,
+                                request=request)
+        except CircuitOpenError:
+            return self.circuit_open(request)
+        return self._finish_login(request, client, user, ticket, next_page)
+
+    def circuit_open(self, request: HttpRequest) -> HttpResponse:
+        """
+        This method is called instead of validating the ticket while the
+        circuit breaker around the CAS server is open. Override this method,
+        or set ``CAS_CIRCUIT_OPEN_RESPONSE``, to customize the response.
+
+        :param request:
+        :return:
+        """
+        if settings.CAS_CIRCUIT_OPEN_RESPONSE is not None:
+            return settings.CAS_CIRCUIT_OPEN_RESPONSE(request)
+        return HttpResponse(_('The authentication service is temporarily unavailable.'),
+                            status=503, content_type="text/plain")
+
+    def _get_next_page(self, request: HttpRequest) -> Tuple[str, str]:
+        """Returns the page to redirect to after login, and the CAS service URL."""
         next_url = getattr(
             settings,
             "CAS_LOGIN_NEXT_PAGE",
@@ -107,10 +191,7 @@ class LoginView(View):
         )
         next_page = clean_next_page(request, next_url)
 
-        required = request.GET.get('required', False)
-
         service_url = get_service_url(request, next_page)
-        client = get_cas_client(service_url=service_url, request=request)
 
         if not next_page and settings.CAS_STORE_NEXT and 'CASNEXT' in request.session:
             next_page = request.session['CASNEXT']
@@ -119,61 +200,49 @@ class LoginView(View):
         if not next_page:
             next_page = get_redirect_url(request)
 
-        if request.user.is_authenticated:
-            if settings.CAS_LOGGED_MSG is not None:
-                message = settings.CAS_LOGGED_MSG % request.user.get_username()
-                messages.success(request, message)
-            return self.successful_login(request=request, next_page=next_page)
-
-        ticket = request.GET.get('ticket')
-        if not ticket:
-            if settings.CAS_STORE_NEXT:
-                request.session['CASNEXT'] = next_page
-            return HttpResponseRedirect(client.get_login_url())
+        return next_page, service_url
+
+    def _already_logged_in(self, request: HttpRequest, next_page: str) -> HttpResponse:
+        if settings.CAS_LOGGED_MSG is not None:
+            message = settings.CAS_LOGGED_MSG % request.user.get_username()
+            messages.success(request, message)
+        return self.successful_login(request=request, next_page=next_page)
+
+    def _redirect_to_login(self, request: HttpRequest, client, next_page: str) -> HttpResponse:
+        if settings.CAS_STORE_NEXT:
+            request.session['CASNEXT'] = next_page
+        if settings.CAS_HTTP_PRECONNECT:
+            # Warm a connection up for the validation of the ticket the
+            # user will come back with.
+            preconnect(client.server_url)
+        return HttpResponseRedirect(client.get_login_url())
 
-        user = authenticate(ticket=ticket,
-                            service=service_url,
-                            request=request)
-        pgtiou = request.session.get("pgtiou")
-        if user is not None:
-            auth_login(request, user)
+    def _persist_login(self, request: HttpRequest, user, ticket: str, pgtiou: Optional[str]) -> None:
+        """Logs ``user`` in and records the tickets of its session."""
+        auth_login(request, user)
 
-            # from https://code.djangoproject.com/ticket/19147
-            if not request.session.session_key:
-                request.session.save()
+        # from https://code.djangoproject.com/ticket/19147
+        if not request.session.session_key:
+            request.session.save()
 
-            # Truncate session key to a max of its value length.
-            # When using the signed_cookies session backend, the
-            # session key can potentially be longer than this.
-            session_key = request.session.session_key[:SESSION_KEY_MAXLENGTH]
+        # Truncate session key to a max of its value length.
+        # When using the signed_cookies session backend, the
+        # session key can potentially be longer than this.
+        session_key = request.session.session_key[:SESSION_KEY_MAXLENGTH]
 
-            if not request.session.exists(session_key):
-                request.session.create()
-
-            try:
-                st = SessionTicket.objects.get(session_key=session_key)
-                st.ticket = ticket
-                st.save()
-            except SessionTicket.DoesNotExist:
-                SessionTicket.objects.create(
-                    session_key=session_key,
-                    ticket=ticket
-                )
+        expires_at = request.session.get_expiry_date()
+        if not settings.CAS_PROXY_CALLBACK:
+            pgtiou = None
+        defer_write(get_ticket_store().save_login, session_key, user, ticket, pgtiou, expires_at)
+        request.session[EXPIRES_AT_SESSION_KEY] = expires_at.timestamp()
 
-            if pgtiou and settings.CAS_PROXY_CALLBACK:
-                # Delete old PGT
-                ProxyGrantingTicket.objects.filter(
-                    user=user,
-                    session_key=session_key
-                ).delete()
-                # Set new PGT ticket
-                try:
-                    pgt = ProxyGrantingTicket.objects.get(pgtiou=pgtiou)
-                    pgt.user = user
-                    pgt.session_key = session_key
-                    pgt.save()
-                except ProxyGrantingTicket.DoesNotExist:
-                    pass
+    def _finish_login(self, request: HttpRequest, client, user, ticket: str, next_page: str) -> HttpResponse:
+        """Logs the authenticated ``user`` in and records its tickets, or handles the failed login."""
+        required = request.GET.get('required', False)
+        pgtiou = request.session.get("pgtiou")
+        if user is not None:
+            with transaction.atomic():
+                self._persist_login(request, user, ticket, pgtiou)
 
             if settings.CAS_LOGIN_MSG is not None:
                 name = user.get_username()
@@ -188,6 +257,48 @@ class LoginView(View):
         raise PermissionDenied(_('Login failed.'))
 
 
+class AsyncLoginView(LoginView):
+    """
+    ``LoginView`` for ASGI deployments.
+
+    The CAS ticket is validated on the event loop through
+    ``CASBackend.aauthenticate``, so no thread is held while waiting for the
+    CAS server. Session and database work still runs in worker threads.
+    """
+
+    async def post(self, request: HttpRequest) -> HttpResponse:
+        return await sync_to_async(super().post)(request)
+
+    async def get(self, request: HttpRequest) -> HttpResponse:
+        """
+        Forwards to CAS login URL or verifies CAS ticket
+
+        :param request:
+        :return:
+        """
+        ticket = request.GET.get('ticket')
+        if not ticket:
+            return await sync_to_async(super().get)(request)
+
+        next_page, service_url, is_authenticated = await sync_to_async(self._aget_context)(request)
+
+        if is_authenticated:
+            return await sync_to_async(self._already_logged_in)(request, next_page)
+
+        client = get_cas_client(service_url=service_url, request=request)
+        try:
+            user = await aauthenticate(ticket=ticket,
+                                       service=service_url,
+                                       request=request)
+        except CircuitOpenError:
+            return self.circuit_open(request)
+        return await sync_to_async(self._finish_login)(request, client, user, ticket, next_page)
+
+    def _aget_context(self, request: HttpRequest) -> Tuple[str, str, bool]:
+        next_page, service_url = self._get_next_page(request)
+        return next_page, service_url, request.user.is_authenticated
+
+
 class LogoutView(View):
     def get(self, request: HttpRequest) -> HttpResponse:
         """
@@ -212,23 +323,21 @@ class LogoutView(View):
         if request.session and request.session.session_key:
             session_key = request.session.session_key[:SESSION_KEY_MAXLENGTH]
 
-        try:
-            st = SessionTicket.objects.get(session_key=session_key)
-            ticket = st.ticket
-        except SessionTicket.DoesNotExist:
-            ticket = None
-        # send logout signal
-        cas_user_logout.send(
-            sender="manual",
-            user=request.user,
-            session=request.session,
-            ticket=ticket,
-        )
+        store = get_ticket_store()
+        with transaction.atomic():
+            ticket = store.get_ticket(session_key)
+            # send logout signal
+            cas_user_logout.send(
+                sender="manual",
+                user=request.user,
+                session=request.session,
+                ticket=ticket,
+            )
 
-        # clean current session ProxyGrantingTicket and SessionTicket
-        ProxyGrantingTicket.objects.filter(session_key=session_key).delete()
-        SessionTicket.objects.filter(session_key=session_key).delete()
-        auth_logout(request)
+            # clean current session ProxyGrantingTicket and SessionTicket
+            if session_key is not None:
+                store.delete([session_key])
+            auth_logout(request)
 
         next_page = next_page or get_redirect_url(request)
         if settings.CAS_LOGOUT_COMPLETELY:
@@ -275,13 +384,7 @@ class CallbackView(View):
         pgtid = request.GET.get('pgtId')
         pgtiou = request.GET.get('pgtIou')
 
-        pgt = ProxyGrantingTicket.objects.create(pgtiou=pgtiou, pgt=pgtid)
-        pgt.save()
-
-        ProxyGrantingTicket.objects.filter(
-            session_key=None,
-            date__lt=(timezone.now() - timedelta(seconds=60))
-        ).delete()
+        get_ticket_store().save_pgt(pgtiou, pgtid)
 
         return HttpResponse("{}\n".format(_('ok')), content_type="text/plain")
 
@@ -290,20 +393,24 @@ def clean_sessions(client, request):
     if not hasattr(client, 'get_saml_slos'):
         return
 
-    for slo in client.get_saml_slos(request.POST.get('logoutRequest')):
-        try:
-            st = SessionTicket.objects.get(ticket=slo.text)
-            session = SessionStore(session_key=st.session_key)
-            # send logout signal
-            cas_user_logout.send(
-                sender="slo",
-                user=get_user_from_session(session),
-                session=session,
-                ticket=slo.text,
-            )
-            session.flush()
-            # clean logout session ProxyGrantingTicket and SessionTicket
-            ProxyGrantingTicket.objects.filter(session_key=st.session_key).delete()
-            SessionTicket.objects.filter(session_key=st.session_key).delete()
-        except SessionTicket.DoesNotExist:
-            pass
+    tickets = [slo.text for slo in client.get_saml_slos(request.POST.get('logoutRequest')) or []]
+    store = get_ticket_store()
+    session_keys = store.get_session_keys(tickets)
+    if not session_keys:
+        return
+    sessions = {
+        ticket: SessionStore(session_key=session_key)
+        for ticket, session_key in session_keys.items()
+    }
+    users = get_users_from_session_data(sessions)
+    for ticket, session in sessions.items():
+        # send logout signal
+        cas_user_logout.send(
+            sender="slo",
+            user=users[ticket],
+            session=session,
+            ticket=ticket,
+        )
+        session.flush()
+    # clean logout sessions ProxyGrantingTicket and SessionTicket
+    store.delete(session_keys.values())
@@ -50,5 +50,8 @@ setup(
         'Django>=4.2',
         'python-cas>=1.6.0',
     ],
+    extras_require={
+        'async': ['httpx>=0.23'],
+    },
     zip_safe=False,  # dot not package as egg or django will not found management commands
 )
@@ -0,0 +1,57 @@
+"""
+Benchmark of the parsing of large CAS 3.0 validation responses: python-cas
+XML parsing, ``parse_xml_response`` and ``parse_json_response``.
+
+Not collected by pytest, run it with::
+
+    python -m tests.bench_validation
+"""
+
+import os
+import timeit
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+django.setup()
+
+from cas import CASClientV3  # noqa: E402
+
+from django_cas_ng import validation  # noqa: E402
+from tests.test_validation import make_json_response, make_xml_response  # noqa: E402
+
+SIZES = (10, 100, 1000)
+NUMBER = 200
+
+
+def make_attributes(size):
+    return {
+        'email': ['test@example.com'],
+        'displayName': ['Test User'],
+        'memberOf': ['cn=group%d,ou=groups,dc=example,dc=com' % i for i in range(size)],
+    }
+
+
+def main():
+    print('{:>8} {:>12} {:>12} {:>12}'.format('memberOf', 'XML (ms)', 'native (ms)', 'JSON (ms)'))
+    for size in SIZES:
+        attributes = make_attributes(size)
+        xml = make_xml_response(attributes)
+        content = make_json_response(attributes)
+        expected = CASClientV3.verify_response(xml)
+        assert validation.parse_xml_response([xml]) == expected
+        assert validation.parse_json_response(content) == expected
+
+        timings = [
+            timeit.timeit(parse, number=NUMBER) / NUMBER * 1000
+            for parse in (
+                lambda: CASClientV3.verify_response(xml),
+                lambda: validation.parse_xml_response([xml]),
+                lambda: validation.parse_json_response(content),
+            )
+        ]
+        print('{:>8} {:>12.3f} {:>12.3f} {:>12.3f}'.format(size, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse as urllib_parse
+
+import pytest
+
+SERVICE_VALIDATE_SUCCESS = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+    <cas:authenticationSuccess>
+        <cas:user>test@example.com</cas:user>
+        <cas:attributes>
+            <cas:email>test@example.com</cas:email>
+            <cas:affiliation>staff</cas:affiliation>
+            <cas:affiliation>faculty</cas:affiliation>
+        </cas:attributes>
+    </cas:authenticationSuccess>
+</cas:serviceResponse>
+"""
+
+SERVICE_VALIDATE_FAILURE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+    <cas:authenticationFailure code="INVALID_TICKET">
+        Ticket {ticket} not recognized
+    </cas:authenticationFailure>
+</cas:serviceResponse>
+"""
+
+SERVICE_VALIDATE_JSON_SUCCESS = {
+    'serviceResponse': {
+        'authenticationSuccess': {
+            'user': 'test@example.com',
+            'attributes': {
+                'email': ['test@example.com'],
+                'affiliation': ['staff', 'faculty'],
+            },
+        },
+    },
+}
+
+PROXY_SUCCESS = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+    <cas:proxySuccess><cas:proxyTicket>PT-{service}</cas:proxyTicket></cas:proxySuccess>
+</cas:serviceResponse>
+"""
+
+PROXY_FAILURE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+    <cas:authenticationFailure code="INVALID_TICKET">PGT {pgt} not recognized</cas:authenticationFailure>
+</cas:serviceResponse>
+"""
+
+
+class StubCASHandler(BaseHTTPRequestHandler):
+    """
+    Minimal CAS server: service tickets starting with ``ST-`` and proxy
+    granting tickets starting with ``PGT-`` are valid. Proxy and ``HEAD``
+    requests take ``proxy_delay`` and ``head_delay`` seconds.
+
+    ``/backend/`` is a service proxied through it: ``/backend/login`` accepts
+    proxy tickets and sets a session cookie listed in ``backend_sessions``,
+    other pages redirect to the CAS login page (``/backend/api/`` answers
+    ``401``) without one, for ``GET`` and ``POST`` requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib_parse.urlparse(self.path)
+        params = dict(urllib_parse.parse_qsl(url.query))
+        self.server.requests.append((url.path, params))
+        ticket = params.get('ticket', '')
+        valid = ticket.startswith('ST-')
+
+        if url.path.startswith('/backend/'):
+            self.do_backend(url, params)
+            return
+        if url.path.endswith('/validate'):
+            body = 'yes\ntest@example.com\n' if valid else 'no\n\n'
+        elif url.path.endswith('/proxy'):
+            time.sleep(self.server.proxy_delay)
+            if params.get('pgt', '').startswith('PGT-'):
+                body = PROXY_SUCCESS.format(service=params['targetService'])
+            else:
+                body = PROXY_FAILURE.format(pgt=params.get('pgt'))
+        elif url.path.endswith('serviceValidate') and params.get('format') == 'JSON':
+            if valid:
+                body = json.dumps(SERVICE_VALIDATE_JSON_SUCCESS)
+            else:
+                body = json.dumps({'serviceResponse': {'authenticationFailure': {
+                    'code': 'INVALID_TICKET', 'description': 'Ticket not recognized'}}})
+        elif url.path.endswith('serviceValidate'):
+            template = SERVICE_VALIDATE_SUCCESS if valid else SERVICE_VALIDATE_FAILURE
+            body = template.format(ticket=ticket)
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Set-Cookie', 'TGC=leaked; Path=/')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        url = urllib_parse.urlparse(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((url.path, {}))
+        if not url.path.startswith('/backend/'):
+            self.send_error(404)
+            return
+        self.do_backend(url, {})
+
+    def do_backend(self, url, params):
+        cookie = SimpleCookie(self.headers.get('Cookie', '')).get('backend')
+        if url.path == '/backend/login' and params.get('ticket', '').startswith('PT-'):
+            session_id = str(len(self.server.backend_sessions) + 1)
+            self.server.backend_sessions.add(session_id)
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'backend=%s; Path=/backend/' % session_id)
+        elif cookie is not None and cookie.value in self.server.backend_sessions:
+            self.send_response(200)
+        elif url.path.startswith('/backend/api/'):
+            self.send_response(401)
+        else:
+            self.send_response(302)
+            self.send_header('Location', '/cas/login?service=%s' % urllib_parse.quote(url.path))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append((self.path, {}))
+        time.sleep(self.server.head_delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_cas_server():
+    """Runs a stub CAS server, its ``requests`` lists the (path, params) received."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCASHandler)
+    server.requests = []
+    server.proxy_delay = 0
+    server.head_delay = 0
+    server.backend_sessions = set()
+    server.url = 'http://127.0.0.1:%d/cas/' % server.server_port
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cas_server(stub_cas_server):
+    """Runs a stub CAS server, yields its ``CAS_SERVER_URL``."""
+    return stub_cas_server.url
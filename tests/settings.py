@@ -17,7 +17,15 @@ INSTALLED_APPS = (
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
+        # Threads of the tests of parallel cleanups share an in-memory
+        # database through a shared cache, whose table locks fail right
+        # away instead of waiting.
+        'TEST': {'NAME': 'test_django_cas_ng.sqlite3'},
     }
 }
 
 ROOT_URLCONF = 'tests.urls'
+
+# Tests run in transactions the background janitor can't see or lock,
+# tests of the janitor enable it.
+CAS_JANITOR_INTERVAL = None
@@ -1,7 +1,13 @@
 import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django_cas_ng import backends
+from django_cas_ng.signals import cas_user_logout
 
 
 @pytest.mark.django_db
@@ -522,3 +528,267 @@ def test_backend_user_can_map_cas_affils(monkeypatch, settings):
     group_names = [g.name for g in user.groups.all()]
     assert 'affil_group1' in group_names
     assert 'affil_group2' in group_names
+
+
+@pytest.mark.django_db
+def test_backend_aauthenticate_against_cas_server(django_user_model, settings, cas_server):
+    """
+    Test the asynchronous authentication path against a stub CAS server.
+    """
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_VERSION = '3'
+    factory = RequestFactory()
+    request = factory.get('/login/')
+    request.session = {}
+
+    user = async_to_sync(backends.CASBackend().aauthenticate)(
+        request, ticket='ST-fake-ticket', service='http://testserver/login/',
+    )
+
+    assert user is not None
+    assert user.username == 'test@example.com'
+    assert request.session['attributes']['affiliation'] == ['staff', 'faculty']
+    assert django_user_model.objects.filter(username='test@example.com').exists()
+
+
+@pytest.mark.django_db
+def test_backend_aauthenticate_existing_user(django_user_model, settings, cas_server):
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_CREATE_USER = False
+    request = RequestFactory().get('/login/')
+    request.session = {}
+    service = 'http://testserver/login/'
+
+    assert async_to_sync(backends.CASBackend().aauthenticate)(
+        request, ticket='ST-fake-ticket', service=service) is None
+
+    existing = django_user_model.objects.create_user('test@example.com', '')
+    user = async_to_sync(backends.CASBackend().aauthenticate)(
+        request, ticket='ST-fake-ticket', service=service)
+    assert user == existing
+
+
+@pytest.mark.django_db
+def test_backend_aauthenticate_invalid_ticket(django_user_model, settings, cas_server):
+    settings.CAS_SERVER_URL = cas_server
+    factory = RequestFactory()
+    request = factory.get('/login/')
+    request.session = {}
+
+    user = async_to_sync(backends.CASBackend().aauthenticate)(
+        request, ticket='bad-ticket', service='http://testserver/login/',
+    )
+
+    assert user is None
+    assert not django_user_model.objects.exists()
+
+
+@pytest.fixture
+def user_cache(settings):
+    settings.CAS_USER_CACHE_TIMEOUT = 60
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_backend_get_user_cached(user_cache, django_user_model, django_assert_num_queries):
+    user = django_user_model.objects.create_user('test@example.com', '')
+    backend = backends.CASBackend()
+
+    # Missing users aren't cached
+    with django_assert_num_queries(2):
+        assert backend.get_user(str(user.pk)) == user
+        assert backend.get_user(str(user.pk)) == user
+        assert backend.get_user(str(user.pk + 1)) is None
+
+    # Saving the user clears it from the cache
+    user.first_name = 'Test'
+    user.save()
+    with django_assert_num_queries(1):
+        assert backend.get_user(str(user.pk)).first_name == 'Test'
+
+    cas_user_logout.send(sender='manual', user=user, session=None, ticket=None)
+    with django_assert_num_queries(1):
+        assert backend.get_user(str(user.pk)) == user
+
+    user_id = str(user.pk)
+    user.delete()
+    assert backend.get_user(user_id) is None
+
+
+@pytest.mark.django_db
+def test_backend_aget_user_cached(user_cache, django_user_model, django_assert_num_queries):
+    user = django_user_model.objects.create_user('test@example.com', '')
+    backend = backends.CASBackend()
+
+    with django_assert_num_queries(1):
+        assert async_to_sync(backend.aget_user)(str(user.pk)) == user
+    with django_assert_num_queries(0):
+        assert async_to_sync(backend.aget_user)(str(user.pk)) == user
+        assert backend.get_user(str(user.pk)) == user
+
+    user.is_active = False
+    user.save()
+    with django_assert_num_queries(1):
+        assert async_to_sync(backend.aget_user)(str(user.pk)) is None
+
+
+@pytest.mark.django_db
+def test_backend_get_user_not_cached(django_user_model, django_assert_num_queries):
+    user = django_user_model.objects.create_user('test@example.com', '')
+    backend = backends.CASBackend()
+
+    with django_assert_num_queries(2):
+        assert backend.get_user(str(user.pk)) == user
+        assert backend.get_user(str(user.pk)) == user
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('timeout', [None, 60])
+def test_backend_get_users(user_cache, settings, django_user_model, django_assert_num_queries, timeout):
+    settings.CAS_USER_CACHE_TIMEOUT = timeout
+    alice = django_user_model.objects.create_user('alice', '')
+    bob = django_user_model.objects.create_user('bob', '')
+    backend = backends.CASBackend()
+    backend.get_user(str(alice.pk))
+
+    with django_assert_num_queries(1):
+        users = backend.get_users([str(alice.pk), str(bob.pk), 'x', str(bob.pk + 1)])
+    assert users == {str(alice.pk): alice, str(bob.pk): bob}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('prune', [None, r'affil_\d+'])
+def test_backend_sync_affiliation_groups(settings, django_user_model, django_assert_max_num_queries,
+                                         prune):
+    settings.CAS_AFFILIATIONS_PRUNE_GROUPS = prune
+    user = django_user_model.objects.create_user('test@example.com', '')
+    manual = Group.objects.create(name='manual')
+    user.groups.add(manual, Group.objects.create(name='affil_0'))
+    affils = ['affil_%d' % i for i in range(200)] + ['']
+
+    with django_assert_max_num_queries(6):
+        backends.CASBackend().sync_affiliation_groups(user, affils)
+    names = set(user.groups.values_list('name', flat=True))
+    assert names == set(affils[:200]) | {'manual'}
+    assert Group.objects.count() == 201
+
+    # Groups granted in Django are never pruned
+    with django_assert_max_num_queries(3):
+        backends.CASBackend().sync_affiliation_groups(user, affils[100:])
+    names = set(user.groups.values_list('name', flat=True))
+    assert names == set(affils[:200] if not prune else affils[100:200]) | {'manual'}
+
+
+@pytest.mark.django_db
+def test_backend_sync_affiliation_groups_cache(settings, django_user_model, django_assert_num_queries,
+                                               monkeypatch):
+    settings.CAS_AFFILIATIONS_CACHE_GROUPS = True
+    monkeypatch.setattr(backends, '_group_ids', {})
+    alice = django_user_model.objects.create_user('alice', '')
+    bob = django_user_model.objects.create_user('bob', '')
+    backends.CASBackend().sync_affiliation_groups(alice, ['staff', 'faculty'])
+
+    # Current groups of bob, a check of the cached ids of the groups to add
+    # and the new membership rows
+    with django_assert_num_queries(3):
+        backends.CASBackend().sync_affiliation_groups(bob, ['staff', 'faculty'])
+    assert set(bob.groups.values_list('name', flat=True)) == {'staff', 'faculty'}
+
+    # Nothing to add: only the current groups
+    with django_assert_num_queries(1):
+        backends.CASBackend().sync_affiliation_groups(bob, ['staff', 'faculty'])
+
+    # Deleted groups are forgotten
+    Group.objects.get(name='staff').delete()
+    backends.CASBackend().sync_affiliation_groups(bob, ['staff', 'faculty'])
+    assert set(bob.groups.values_list('name', flat=True)) == {'staff', 'faculty'}
+
+
+@pytest.mark.django_db
+def test_backend_sync_affiliation_groups_stale_cache(settings, django_user_model, monkeypatch):
+    settings.CAS_AFFILIATIONS_CACHE_GROUPS = True
+    monkeypatch.setattr(backends, '_group_ids', {})
+    alice = django_user_model.objects.create_user('alice', '')
+    bob = django_user_model.objects.create_user('bob', '')
+    backends.CASBackend().sync_affiliation_groups(alice, ['staff', 'faculty'])
+    cached = dict(backends._group_ids)
+
+    # Another process deletes a group and renames the other one
+    Group.objects.get(name='staff').delete()
+    Group.objects.filter(name='faculty').update(name='former-faculty')
+    backends._group_ids.update(cached)
+
+    backends.CASBackend().sync_affiliation_groups(bob, ['staff', 'faculty'])
+    assert set(bob.groups.values_list('name', flat=True)) == {'staff', 'faculty'}
+    assert backends._group_ids.keys() == {'staff', 'faculty'}
+    assert backends._group_ids != cached
+
+
+@pytest.mark.django_db
+def test_backend_saves_changed_fields_once(monkeypatch, settings):
+    """
+    Staff and admin affiliations, attributes and configure_user changes are
+    saved with a single UPDATE of the changed fields, or not at all.
+    """
+    request = RequestFactory().get('/login/')
+    request.session = {}
+    settings.CAS_STAFF_AFFILIATION = 'staff'
+    settings.CAS_ADMIN_AFFILIATION = 'admin'
+    settings.CAS_APPLY_ATTRIBUTES_TO_USER = True
+
+    def mock_verify(ticket, service):
+        return 'test@example.com', {'affiliation': ['staff', 'admin'],
+                                    'first_name': 'Test', 'last_name': 'User'}, None
+
+    monkeypatch.setattr('cas.CASClientV2.verify_ticket', mock_verify)
+
+    class ConfiguringBackend(backends.CASBackend):
+        def configure_user(self, user):
+            user.email = 'test@example.com'
+            return user
+
+    def authenticate(backend):
+        with CaptureQueriesContext(connection) as context:
+            user = backend.authenticate(request, ticket='fake-ticket', service='fake-service')
+        return user, [query['sql'] for query in context.captured_queries
+                      if query['sql'].startswith('UPDATE')]
+
+    user, updates = authenticate(ConfiguringBackend())
+    assert len(updates) == 1
+    for column in ('is_staff', 'is_superuser', 'first_name', 'last_name', 'email'):
+        assert '"%s"' % column in updates[0]
+    assert '"username"' not in updates[0]
+    user.refresh_from_db()
+    assert (user.is_staff, user.is_superuser, user.first_name, user.email) == (
+        True, True, 'Test', 'test@example.com')
+
+    user, updates = authenticate(backends.CASBackend())
+    assert updates == []
+
+
+@pytest.mark.django_db
+def test_backend_attribute_plan(monkeypatch, settings):
+    request = RequestFactory().get('/login/')
+    request.session = {}
+    settings.CAS_APPLY_ATTRIBUTES_TO_USER = True
+    settings.CAS_RENAME_ATTRIBUTES = {'givenName': 'first_name', 'sn': 'sn'}
+
+    def mock_verify(ticket, service):
+        return 'test@example.com', {'givenName': 'Test', 'sn': 'User', 'last_name': None,
+                                    'is_staff': 'True', 'is_active': 'true'}, None
+
+    monkeypatch.setattr('cas.CASClientV2.verify_ticket', mock_verify)
+    backend = backends.CASBackend()
+    user = backend.authenticate(request, ticket='fake-ticket', service='fake-service')
+    assert request.session['attributes'] == {'first_name': 'Test', 'sn': 'User', 'last_name': '',
+                                             'is_staff': True, 'is_active': False}
+    assert (user.first_name, user.last_name, user.is_staff) == ('Test', '', True)
+
+    # Compiled once, until the settings change
+    misses = backends._get_attribute_plan.cache_info().misses
+    backend.authenticate(request, ticket='fake-ticket', service='fake-service')
+    assert backends._get_attribute_plan.cache_info().misses == misses
+    settings.CAS_RENAME_ATTRIBUTES = {'sn': 'last_name'}
+    assert backends._get_attribute_plan().renames == (('sn', 'last_name'),)
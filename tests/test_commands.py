@@ -1,11 +1,18 @@
 """Tests for the management commands"""
 
+import itertools
+import json
+import time
+from datetime import timedelta
 from importlib import import_module
+from io import StringIO
 
 import pytest
 from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
 from django.core import management
-from django_cas_ng.models import ProxyGrantingTicket, SessionTicket
+from django.utils import timezone
+from django_cas_ng.models import ProxyGrantingTicket, SessionTicket, get_digest
 
 SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
@@ -48,3 +55,85 @@ def test_command_clean_session(django_user_model):
     assert ProxyGrantingTicket.objects.filter(session_key=session.session_key,
                                               user=user, pgtiou='fake-ticket-iou',
                                               pgt='fake-ticket').exists() is False
+
+
+@pytest.mark.django_db
+def test_command_clean_session_dry_run(django_user_model):
+    user = django_user_model.objects.create(username='test-user', email='test@example.com')
+    for i in range(5):
+        SessionTicket.objects.create(session_key='deleted-%d' % i, ticket='ST-%d' % i)
+        ProxyGrantingTicket.objects.create(session_key='deleted-%d' % i, user=user, pgt='PGT-%d' % i)
+
+    out = StringIO()
+    management.call_command('django_cas_ng_clean_sessions', '--dry-run', '--batch-size=2', stdout=out)
+
+    assert SessionTicket.objects.count() == 5
+    assert ProxyGrantingTicket.objects.count() == 5
+    assert 'SessionTicket: 5 rows scanned, 5 to delete' in out.getvalue()
+    assert 'ProxyGrantingTicket: 5 rows scanned, 5 to delete' in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_command_clean_session_resume(tmp_path):
+    tickets = [SessionTicket.objects.create(session_key='deleted-%d' % i, ticket='ST-%d' % i)
+               for i in range(6)]
+    state_file = tmp_path / 'state.json'
+    state_file.write_text(json.dumps({'SessionTicket': tickets[2].pk}))
+
+    # Nothing is done past the deadline
+    management.call_command('django_cas_ng_clean_sessions', '--max-runtime=0',
+                            '--state-file', str(state_file), stdout=StringIO())
+    assert SessionTicket.objects.count() == 6
+
+    out = StringIO()
+    management.call_command('django_cas_ng_clean_sessions', '--batch-size=2',
+                            '--state-file', str(state_file), stdout=out)
+
+    assert 'SessionTicket: resuming after primary key {}'.format(tickets[2].pk) in out.getvalue()
+    assert list(SessionTicket.objects.order_by('pk')) == tickets[:3]
+    # A complete run starts from the beginning next time
+    assert json.loads(state_file.read_text()) == {}
+
+
+@pytest.mark.django_db
+def test_command_clean_session_max_runtime_expired_rows(settings, monkeypatch):
+    settings.MIDDLEWARE = ['django_cas_ng.middleware.CASMiddleware']
+    # Each reading of the clock takes a second
+    monkeypatch.setattr(time, 'monotonic', itertools.count().__next__)
+    expires_at = timezone.now() - timedelta(days=1)
+    SessionTicket.objects.bulk_create([
+        SessionTicket(session_key='expired-%d' % i, session_key_hash=get_digest('expired-%d' % i),
+                      ticket='ST-%d' % i, ticket_hash=get_digest('ST-%d' % i),
+                      expires_at=expires_at)
+        for i in range(100)
+    ])
+
+    out = StringIO()
+    management.call_command('django_cas_ng_clean_sessions', '--batch-size=1',
+                            '--max-runtime=20', stdout=out)
+
+    # Stopped during the expired rows of the second table
+    assert 0 < SessionTicket.objects.count() < 100
+    assert 'Stopped after --max-runtime' in out.getvalue()
+    assert 'SessionTicket: done' not in out.getvalue()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_command_clean_session_workers(django_user_model):
+    user = django_user_model.objects.create(username='test-user', email='test@example.com')
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session.save()
+    for i in range(20):
+        session_key = session.session_key if i % 2 else 'deleted-%d' % i
+        ProxyGrantingTicket.objects.create(session_key=session_key, pgt='PGT-%d' % i)
+
+    out = StringIO()
+    management.call_command('django_cas_ng_clean_sessions', '--workers=3', '--batch-size=3',
+                            stdout=out)
+
+    assert ProxyGrantingTicket.objects.count() == 10
+    assert not ProxyGrantingTicket.objects.exclude(session_key=session.session_key).exists()
+    assert 'ProxyGrantingTicket: 20 rows scanned, 10 deleted' in out.getvalue()
+    assert 'ProxyGrantingTicket: done' in out.getvalue()
@@ -0,0 +1,111 @@
+"""Tests for the deferred ticket writes"""
+
+import threading
+import time
+
+import pytest
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import IntegrityError, OperationalError
+from django.test import RequestFactory
+from django_cas_ng import deferred
+from django_cas_ng.models import SessionTicket
+from django_cas_ng.views import LoginView
+
+
+@pytest.fixture
+def deferred_writes(transactional_db, settings, monkeypatch):
+    settings.CAS_DEFERRED_TICKET_WRITES = True
+    monkeypatch.setattr(deferred, '_queue', None)
+    monkeypatch.setattr(deferred, '_sleep', lambda seconds: None)
+    yield
+    assert deferred.flush(timeout=5)
+
+
+def wait_for_queue_size(size, timeout=5):
+    deadline = time.monotonic() + timeout
+    while deferred._queue.qsize() > size:
+        assert time.monotonic() < deadline, 'The worker thread is stuck'
+        time.sleep(0.001)
+
+
+def test_defer_write_disabled():
+    calls = []
+    deferred.defer_write(calls.append, 1)
+    assert calls == [1]
+    assert deferred._queue is None
+
+
+def test_defer_write(deferred_writes):
+    calls = []
+    thread_names = []
+    release = threading.Event()
+
+    def write(value):
+        release.wait(5)
+        thread_names.append(threading.current_thread().name)
+        calls.append(value)
+
+    deferred.defer_write(write, 1)
+    deferred.defer_write(write, 2)
+    assert calls == []
+    # Wait for the worker to take the first write
+    wait_for_queue_size(1)
+    release.set()
+    assert deferred.flush(timeout=5)
+    assert calls == [1, 2]
+    assert thread_names[0] == 'django-cas-ng-deferred-writes'
+
+
+def test_defer_write_queue_full(settings, deferred_writes):
+    settings.CAS_DEFERRED_TICKET_WRITES_QUEUE_SIZE = 1
+    release = threading.Event()
+    calls = []
+    deferred.defer_write(release.wait, 5)
+    # Wait for the worker to take the first write
+    wait_for_queue_size(0)
+    deferred.defer_write(calls.append, 1)
+    deferred.defer_write(calls.append, 2)
+    # The queue was full, the third write ran right away
+    assert calls == [2]
+    release.set()
+    assert deferred.flush(timeout=5)
+    assert calls == [2, 1]
+
+
+def test_defer_write_retries(deferred_writes):
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        raise OperationalError('database is locked')
+
+    deferred.defer_write(write)
+    assert deferred.flush(timeout=5)
+    assert len(attempts) == deferred.DEFERRED_WRITE_RETRIES + 1
+
+
+def test_defer_write_integrity_error_not_retried(deferred_writes):
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        raise IntegrityError('UNIQUE constraint failed')
+
+    deferred.defer_write(write)
+    assert deferred.flush(timeout=5)
+    assert len(attempts) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_login_deferred_writes(deferred_writes, monkeypatch, django_user_model, settings):
+    settings.CAS_LOGIN_MSG = None
+    user = django_user_model.objects.create_user('test@example.com', '')
+    monkeypatch.setattr('django_cas_ng.views.authenticate', lambda **kwargs: user)
+    request = RequestFactory().get('/login/', {'ticket': 'ST-1'})
+    SessionMiddleware(lambda r: None).process_request(request)
+    AuthenticationMiddleware(lambda r: None).process_request(request)
+
+    assert LoginView().get(request).status_code == 302
+    assert deferred.flush(timeout=5)
+    assert SessionTicket.objects.for_session_key(request.session.session_key).get().ticket == 'ST-1'
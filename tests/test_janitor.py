@@ -0,0 +1,136 @@
+"""Tests for the background janitor"""
+
+import threading
+from datetime import timedelta
+from importlib import import_module
+
+import pytest
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.test import RequestFactory
+from django.utils import timezone
+from django_cas_ng import janitor
+from django_cas_ng.models import ProxyGrantingTicket, SessionTicket
+from django_cas_ng.views import CallbackView, LoginView
+
+SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+
+
+@pytest.fixture
+def janitor_runs(settings, monkeypatch):
+    """Enables the janitor and records its runs instead of running them."""
+    settings.CAS_JANITOR_INTERVAL = 60
+    monkeypatch.setattr(janitor, '_next_run', 0.0)
+    cache.delete(janitor._CACHE_KEY)
+    runs = []
+    monkeypatch.setattr(janitor, 'run_janitor', lambda: runs.append(1))
+    yield runs
+    cache.delete(janitor._CACHE_KEY)
+
+
+def join_janitor():
+    for thread in threading.enumerate():
+        if thread.name == 'django-cas-ng-janitor':
+            thread.join()
+
+
+@pytest.mark.django_db
+def test_run_janitor(settings):
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    now = timezone.now()
+    old = now - timedelta(days=1)
+    for i in range(3):
+        ProxyGrantingTicket.objects.create(pgtiou='PGTIOU-%d' % i, pgt='PGT-%d' % i)
+    ProxyGrantingTicket.objects.update(date=old)
+    pgt = ProxyGrantingTicket.objects.create(pgtiou='PGTIOU-new', pgt='PGT-new')
+    ProxyGrantingTicket.objects.create(session_key='expired', pgt='PGT-expired', expires_at=old)
+    ProxyGrantingTicket.objects.create(session_key='live', pgt='PGT-live', expires_at=now)
+    SessionTicket.objects.create(session_key='expired', ticket='ST-1', expires_at=old)
+    SessionTicket.objects.create(session_key='live', ticket='ST-2', expires_at=now)
+
+    assert janitor.run_janitor(batch_size=2) == {
+        'orphaned_pgts': 2,
+        'expired_pgts': 1,
+        'expired_session_tickets': 1,
+    }
+    assert janitor.run_janitor() == {
+        'orphaned_pgts': 1,
+        'expired_pgts': 0,
+        'expired_session_tickets': 0,
+    }
+    assert sorted(ProxyGrantingTicket.objects.values_list('pgt', flat=True)) == ['PGT-live', pgt.pgt]
+    assert SessionTicket.objects.get().ticket == 'ST-2'
+
+
+@pytest.mark.django_db
+def test_run_janitor_keeps_extended_sessions(settings, django_user_model):
+    settings.MIDDLEWARE = []
+    settings.SESSION_SAVE_EVERY_REQUEST = True
+    user = django_user_model.objects.create_user('test@example.com', '')
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session.save()
+    logged_in_at = timezone.now() - timedelta(days=1)
+    ProxyGrantingTicket.objects.create(session_key=session.session_key, user=user, pgt='PGT-1',
+                                       expires_at=logged_in_at)
+    SessionTicket.objects.create(session_key=session.session_key, ticket='ST-1',
+                                 expires_at=logged_in_at)
+
+    assert janitor.run_janitor() == {
+        'orphaned_pgts': 0,
+        'expired_pgts': 0,
+        'expired_session_tickets': 0,
+    }
+    assert SessionTicket.objects.get().expires_at is None
+    assert ProxyGrantingTicket.objects.get().expires_at is None
+
+
+def test_schedule_janitor_is_rate_limited(janitor_runs, monkeypatch):
+    assert janitor.schedule_janitor() is True
+    assert janitor.schedule_janitor() is False
+    join_janitor()
+    assert janitor_runs == [1]
+
+    # Another process already ran it
+    monkeypatch.setattr(janitor, '_next_run', 0.0)
+    assert janitor.schedule_janitor() is False
+
+
+def test_schedule_janitor_disabled(janitor_runs, settings):
+    settings.CAS_JANITOR_INTERVAL = None
+
+    assert janitor.schedule_janitor() is False
+    assert janitor_runs == []
+
+
+@pytest.mark.django_db
+def test_callback_schedules_janitor(janitor_runs, django_assert_num_queries):
+    request = RequestFactory().get('/callback/', {'pgtId': 'PGT-1', 'pgtIou': 'PGTIOU-1'})
+
+    with django_assert_num_queries(1):
+        response = CallbackView().get(request)
+    join_janitor()
+
+    assert response.status_code == 200
+    assert ProxyGrantingTicket.objects.filter(pgt='PGT-1', pgtiou='PGTIOU-1').exists()
+    assert janitor_runs == [1]
+
+
+@pytest.mark.django_db
+def test_login_schedules_janitor(janitor_runs, monkeypatch, django_user_model, settings):
+    settings.CAS_LOGIN_MSG = None
+    user = django_user_model.objects.create_user('test@example.com', '')
+    monkeypatch.setattr('django_cas_ng.views.authenticate', lambda **kwargs: user)
+    request = RequestFactory().get('/login/', {'ticket': 'ST-1'})
+    SessionMiddleware(lambda r: None).process_request(request)
+    AuthenticationMiddleware(lambda r: None).process_request(request)
+
+    assert LoginView().get(request).status_code == 302
+    join_janitor()
+
+    assert not ProxyGrantingTicket.objects.exists()
+    assert janitor_runs == [1]
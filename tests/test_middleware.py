@@ -1,7 +1,15 @@
+from importlib import import_module
+
+import pytest
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
 from django.test import RequestFactory
 from django_cas_ng import views
 from django_cas_ng.middleware import CASMiddleware
+from django_cas_ng.models import EXPIRES_AT_SESSION_KEY, SessionTicket
+
+SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
 
 def _process_view_with_middleware(
@@ -30,3 +38,22 @@ def test_root_as_cas_admin_prefix_with_cas_logout(monkeypatch, settings):
     response = _process_view_with_middleware(
         CASMiddleware, '/logout/', views.LogoutView)
     assert response is None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('modified', [True, False])
+def test_process_response_refreshes_expires_at(settings, modified):
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    request = RequestFactory().get('/')
+    request.session = SessionStore()
+    request.session[EXPIRES_AT_SESSION_KEY] = 0
+    request.session.save()
+    SessionTicket.upsert(request.session.session_key, 'ST-1')
+    request.session = SessionStore(request.session.session_key)
+    if modified:
+        request.session['foo'] = 'bar'
+
+    response = CASMiddleware(lambda r: None).process_response(request, HttpResponse())
+
+    assert response.status_code == 200
+    assert (SessionTicket.objects.get().expires_at is not None) == modified
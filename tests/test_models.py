@@ -0,0 +1,302 @@
+"""Tests for the models"""
+
+import time
+from datetime import timedelta
+from importlib import import_module
+from unittest.mock import Mock
+
+import pytest
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends import cache, signed_cookies
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from django_cas_ng import models
+from django_cas_ng.models import (
+    SESSION_KEY_MAXLENGTH,
+    ProxyError,
+    ProxyGrantingTicket,
+    SessionTicket,
+    get_digest,
+)
+
+SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+
+SERVICES = ['http://a.example.com/', 'http://b.example.com/', 'http://c.example.com/',
+            'http://d.example.com/']
+
+
+@pytest.fixture
+def proxy_request(django_user_model):
+    request = RequestFactory().get('/')
+    SessionMiddleware(lambda r: None).process_request(request)
+    request.session.save()
+    request.user = django_user_model.objects.create_user('test@example.com', '')
+    return request
+
+
+@pytest.mark.django_db
+def test_retrieve_pt(settings, cas_server, proxy_request):
+    settings.CAS_SERVER_URL = cas_server
+    ProxyGrantingTicket.objects.create(session_key=proxy_request.session.session_key,
+                                       user=proxy_request.user, pgt='PGT-1')
+
+    assert ProxyGrantingTicket.retrieve_pt(proxy_request, SERVICES[0]) == 'PT-' + SERVICES[0]
+
+
+@pytest.mark.django_db
+def test_retrieve_pts_concurrently(settings, stub_cas_server, proxy_request,
+                                   django_assert_num_queries):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+    stub_cas_server.proxy_delay = 0.3
+    ProxyGrantingTicket.objects.create(session_key=proxy_request.session.session_key,
+                                       user=proxy_request.user, pgt='PGT-1')
+
+    start = time.monotonic()
+    with django_assert_num_queries(1):
+        tickets = ProxyGrantingTicket.retrieve_pts(proxy_request, SERVICES)
+    elapsed = time.monotonic() - start
+
+    assert tickets == {service: 'PT-' + service for service in SERVICES}
+    # Sequential retrieval would take 4 * 0.3s
+    assert elapsed < 0.9
+
+
+@pytest.mark.django_db
+def test_retrieve_pts_errors_per_service(settings, cas_server, proxy_request, monkeypatch):
+    settings.CAS_SERVER_URL = cas_server
+    ProxyGrantingTicket.objects.create(session_key=proxy_request.session.session_key,
+                                       user=proxy_request.user, pgt='PGT-1')
+    get_proxy_ticket = ProxyGrantingTicket._get_proxy_ticket
+
+    def fail_on_b(request, pgt, service):
+        if service == SERVICES[1]:
+            pgt = 'bad-pgt'
+        return get_proxy_ticket(request, pgt, service)
+    monkeypatch.setattr(ProxyGrantingTicket, '_get_proxy_ticket', staticmethod(fail_on_b))
+
+    tickets = ProxyGrantingTicket.retrieve_pts(proxy_request, SERVICES[:3])
+
+    assert tickets[SERVICES[0]] == 'PT-' + SERVICES[0]
+    assert isinstance(tickets[SERVICES[1]], ProxyError)
+    assert tickets[SERVICES[1]].args[0] == 'INVALID_TICKET'
+    assert tickets[SERVICES[2]] == 'PT-' + SERVICES[2]
+
+
+@pytest.mark.django_db
+def test_retrieve_pts_without_pgt(proxy_request):
+    tickets = ProxyGrantingTicket.retrieve_pts(proxy_request, SERVICES[:2])
+
+    assert set(tickets) == set(SERVICES[:2])
+    assert all(isinstance(error, ProxyError) for error in tickets.values())
+    assert ProxyGrantingTicket.retrieve_pts(proxy_request, []) == {}
+
+
+@pytest.mark.django_db
+def test_session_ticket_digests():
+    st = SessionTicket.objects.create(session_key='k' * SESSION_KEY_MAXLENGTH, ticket='ST-1')
+
+    assert st.session_key_hash == get_digest('k' * SESSION_KEY_MAXLENGTH)
+    assert st.ticket_hash == get_digest('ST-1')
+    # Longer session keys are truncated, like when they are stored
+    assert SessionTicket.objects.for_session_key('k' * 800).get() == st
+    assert SessionTicket.objects.for_ticket('ST-1').get() == st
+    assert not SessionTicket.objects.for_ticket('ST-2').exists()
+
+    st.ticket = 'ST-2'
+    st.save(update_fields=['ticket'])
+    assert SessionTicket.objects.for_ticket('ST-2').get() == st
+
+
+@pytest.mark.django_db
+def test_proxy_granting_ticket_digest():
+    pgt = ProxyGrantingTicket.objects.create(pgtiou='PGTIOU-1', pgt='PGT-1')
+    assert pgt.session_key_hash is None
+    assert ProxyGrantingTicket.objects.for_session_key(None).get() == pgt
+
+    pgt.session_key = 'key'
+    pgt.save()
+    assert ProxyGrantingTicket.objects.for_session_key('key').get() == pgt
+    assert not ProxyGrantingTicket.objects.for_session_key(None).exists()
+
+
+@pytest.mark.django_db
+def test_migration_backfills_digests():
+    migration = import_module('django_cas_ng.migrations.0004_digest_columns')
+    SessionTicket.objects.create(session_key='key', ticket='ST-1')
+    ProxyGrantingTicket.objects.create(session_key='key', pgt='PGT-1')
+    SessionTicket.objects.update(session_key_hash='', ticket_hash='')
+    ProxyGrantingTicket.objects.update(session_key_hash=None)
+
+    migration.backfill_digests(apps, None)
+
+    assert SessionTicket.objects.for_session_key('key').for_ticket('ST-1').exists()
+    assert ProxyGrantingTicket.objects.for_session_key('key').exists()
+
+
+@pytest.mark.django_db
+def test_session_ticket_upsert(django_assert_num_queries):
+    with django_assert_num_queries(1):
+        SessionTicket.upsert('key', 'ST-1')
+    with django_assert_num_queries(1):
+        SessionTicket.upsert('key', 'ST-2')
+
+    st = SessionTicket.objects.get()
+    assert (st.session_key, st.ticket) == ('key', 'ST-2')
+    assert SessionTicket.objects.for_ticket('ST-2').get() == st
+
+
+@pytest.mark.django_db
+def test_session_ticket_upsert_without_on_conflict(monkeypatch):
+    features = connection.features
+    monkeypatch.setattr(features, 'supports_update_conflicts', False)
+    monkeypatch.setattr(features, 'supports_update_conflicts_with_target', False)
+
+    SessionTicket.upsert('key', 'ST-1')
+    SessionTicket.upsert('key', 'ST-2')
+
+    st = SessionTicket.objects.get()
+    assert (st.session_key, st.ticket) == ('key', 'ST-2')
+    assert SessionTicket.objects.for_ticket('ST-2').get() == st
+
+
+@pytest.mark.django_db
+def test_session_ticket_unique_session_key():
+    SessionTicket.objects.create(session_key='key', ticket='ST-1')
+
+    with pytest.raises(IntegrityError), transaction.atomic():
+        SessionTicket.objects.create(session_key='key', ticket='ST-2')
+
+
+def make_session(user=None, expired=False):
+    session = SessionStore()
+    if user is not None:
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    if expired:
+        session.set_expiry(-1)
+    session.save()
+    return session.session_key
+
+
+@pytest.mark.django_db
+def test_clean_deleted_sessions(django_user_model, django_assert_max_num_queries):
+    user = django_user_model.objects.create_user('test@example.com', '')
+    kept = [make_session(user) for _ in range(3)]
+    stale = [make_session(), make_session(user, expired=True), 'missing-session-key']
+    for i, session_key in enumerate(kept + stale):
+        SessionTicket.objects.create(session_key=session_key, ticket='ST-%d' % i)
+        ProxyGrantingTicket.objects.create(session_key=session_key, user=user, pgt='PGT-%d' % i)
+    ProxyGrantingTicket.objects.create(pgtiou='PGTIOU-1', pgt='PGT-pending')
+
+    # Two chunks of 4 rows: a primary key range lookup and at most 3
+    # statements each, users are not loaded
+    with django_assert_max_num_queries(2 * 4 + 1):
+        assert SessionTicket.objects.clean_deleted_sessions(batch_size=4) == 3
+    assert ProxyGrantingTicket.clean_deleted_sessions() == 4
+
+    assert sorted(SessionTicket.objects.values_list('session_key', flat=True)) == sorted(kept)
+    assert sorted(ProxyGrantingTicket.objects.values_list('session_key', flat=True)) == sorted(kept)
+
+
+@pytest.mark.django_db
+def test_clean_deleted_sessions_signed_cookies(monkeypatch):
+    monkeypatch.setattr(models, 'SessionStore', signed_cookies.SessionStore)
+    SessionTicket.objects.create(session_key='cookie-session', ticket='ST-1')
+
+    assert SessionTicket.clean_deleted_sessions() == 1
+    assert not SessionTicket.objects.exists()
+
+
+@pytest.mark.django_db
+def test_clean_deleted_sessions_cache(django_user_model, monkeypatch,
+                                      django_assert_max_num_queries):
+    monkeypatch.setattr(models, 'SessionStore', cache.SessionStore)
+    session_cache = caches[settings.SESSION_CACHE_ALIAS]
+    get_many = Mock(wraps=session_cache.get_many)
+    monkeypatch.setattr(session_cache, 'get_many', get_many)
+    user = django_user_model.objects.create_user('test@example.com', '')
+
+    def make_cache_session(authenticated):
+        session = cache.SessionStore()
+        if authenticated:
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session.save()
+        return session.session_key
+
+    kept = [make_cache_session(True) for _ in range(3)]
+    stale = [make_cache_session(False), 'missing-session-key']
+    for i, session_key in enumerate(kept + stale):
+        SessionTicket.objects.create(session_key=session_key, ticket='ST-%d' % i)
+
+    # Per chunk: a primary key range lookup, the rows and a bulk delete
+    with django_assert_max_num_queries(3 * 3 + 1):
+        assert SessionTicket.objects.clean_deleted_sessions(batch_size=2) == 2
+
+    assert get_many.call_count == 3
+    assert sorted(SessionTicket.objects.values_list('session_key', flat=True)) == sorted(kept)
+
+
+@pytest.mark.django_db
+def test_clean_expired_sessions(settings):
+    settings.MIDDLEWARE = ['django_cas_ng.middleware.CASMiddleware']
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    now = timezone.now()
+    for i, expires_at in enumerate([None, now, now - timedelta(seconds=30),
+                                    now - timedelta(seconds=90), now - timedelta(days=1)]):
+        SessionTicket.objects.create(session_key='key-%d' % i, ticket='ST-%d' % i,
+                                     expires_at=expires_at)
+
+    assert SessionTicket.objects.clean_expired_sessions(dry_run=True) == 2
+    # Expired for longer than the refresh interval
+    assert SessionTicket.objects.clean_expired_sessions(batch_size=1) == 2
+    assert sorted(SessionTicket.objects.values_list('ticket', flat=True)) == ['ST-0', 'ST-1', 'ST-2']
+
+
+@pytest.mark.django_db
+def test_clean_expired_sessions_without_middleware(settings, django_user_model):
+    # Sessions are extended on every request, but nothing updates expires_at
+    settings.MIDDLEWARE = ['django.contrib.sessions.middleware.SessionMiddleware']
+    settings.SESSION_SAVE_EVERY_REQUEST = True
+    user = django_user_model.objects.create_user('test@example.com', '')
+    live = make_session(user)
+    logged_in_at = timezone.now() - timedelta(days=1)
+    SessionTicket.objects.create(session_key=live, ticket='ST-1', expires_at=logged_in_at)
+    SessionTicket.objects.create(session_key='missing-session-key', ticket='ST-2',
+                                 expires_at=logged_in_at)
+
+    assert SessionTicket.objects.clean_expired_sessions(dry_run=True) == 1
+    assert SessionTicket.objects.clean_expired_sessions() == 1
+
+    ticket = SessionTicket.objects.get()
+    assert ticket.session_key == live
+    # Left to clean_deleted_sessions
+    assert ticket.expires_at is None
+
+
+@pytest.mark.django_db
+def test_record_expires_at(settings, django_assert_num_queries):
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    session = SessionStore()
+    session.save()
+    SessionTicket.upsert(session.session_key, 'ST-1', timezone.now())
+    ProxyGrantingTicket.objects.create(session_key=session.session_key, pgt='PGT-1')
+
+    with django_assert_num_queries(2):
+        models.record_expires_at(session)
+    expires_at = session.get_expiry_date()
+    assert SessionTicket.objects.get().expires_at.timestamp() == pytest.approx(expires_at.timestamp(), abs=1)
+    assert ProxyGrantingTicket.objects.get().expires_at == SessionTicket.objects.get().expires_at
+
+    # Not refreshed until the expiry date moves by the refresh interval
+    with django_assert_num_queries(0):
+        models.record_expires_at(session)
+    session.set_expiry(settings.SESSION_COOKIE_AGE + 120)
+    with django_assert_num_queries(2):
+        models.record_expires_at(session)
+    assert SessionTicket.objects.get().expires_at > expires_at
@@ -0,0 +1,135 @@
+"""Tests for the proxied backend sessions"""
+
+import gc
+
+import pytest
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.test import RequestFactory
+from django_cas_ng import proxy
+from django_cas_ng.models import ProxyError, ProxyGrantingTicket
+from django_cas_ng.signals import cas_user_logout
+
+
+@pytest.fixture
+def proxy_request(settings, stub_cas_server, django_user_model):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+    request = RequestFactory().get('/')
+    SessionMiddleware(lambda r: None).process_request(request)
+    request.session.save()
+    request.user = django_user_model.objects.create_user('test@example.com', '')
+    ProxyGrantingTicket.objects.create(session_key=request.session.session_key,
+                                       user=request.user, pgt='PGT-1')
+    yield request
+    proxy.clear_proxied_sessions(request.session.session_key)
+
+
+def backend_url(stub_cas_server, path):
+    return stub_cas_server.url.replace('/cas/', '/backend/') + path
+
+
+def proxy_requests(stub_cas_server):
+    return [path for path, _ in stub_cas_server.requests if path.endswith('/proxy')]
+
+
+@pytest.mark.django_db
+def test_proxied_session_reuses_backend_session(stub_cas_server, proxy_request):
+    service = backend_url(stub_cas_server, 'login')
+
+    for _ in range(3):
+        session = proxy.get_proxied_session(proxy_request, service)
+        response = session.get(backend_url(stub_cas_server, 'data'))
+        assert response.status_code == 200
+
+    assert len(proxy_requests(stub_cas_server)) == 1
+    assert stub_cas_server.backend_sessions == {'1'}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('path', ['data', 'api/data'])
+def test_proxied_session_logs_in_again(stub_cas_server, proxy_request, path):
+    session = proxy.get_proxied_session(proxy_request, backend_url(stub_cas_server, 'login'))
+    session.get(backend_url(stub_cas_server, path))
+
+    # The backend session expires: redirect to the CAS login page or 401
+    stub_cas_server.backend_sessions.clear()
+    response = session.get(backend_url(stub_cas_server, path))
+
+    assert response.status_code == 200
+    assert len(proxy_requests(stub_cas_server)) == 2
+    assert stub_cas_server.backend_sessions == {'1'}
+
+
+@pytest.mark.django_db
+def test_proxied_session_does_not_replay_post(stub_cas_server, proxy_request):
+    session = proxy.get_proxied_session(proxy_request, backend_url(stub_cas_server, 'login'))
+    session.get(backend_url(stub_cas_server, 'api/data'))
+    stub_cas_server.backend_sessions.clear()
+
+    response = session.post(backend_url(stub_cas_server, 'api/data'), data={'a': '1'})
+
+    assert response.status_code == 401
+    assert len(proxy_requests(stub_cas_server)) == 1
+    assert [path for path, _ in stub_cas_server.requests].count('/backend/api/data') == 2
+    # The next request logs in first
+    assert session.get(backend_url(stub_cas_server, 'api/data')).status_code == 200
+    assert len(proxy_requests(stub_cas_server)) == 2
+
+
+@pytest.mark.django_db
+def test_proxied_session_without_session_key(stub_cas_server):
+    request = RequestFactory().get('/')
+    SessionMiddleware(lambda r: None).process_request(request)
+
+    first = proxy.get_proxied_session(request, 'http://a.example.com/')
+
+    assert proxy.get_proxied_session(request, 'http://a.example.com/') is not first
+    assert not proxy._sessions
+
+
+@pytest.mark.django_db
+def test_proxied_session_does_not_keep_request(stub_cas_server, proxy_request):
+    request = RequestFactory().get('/')
+    request.session = proxy_request.session
+    session = proxy.get_proxied_session(request, backend_url(stub_cas_server, 'login'))
+    assert session._http_request() is request
+
+    del request
+    gc.collect()
+
+    assert session._http_request() is None
+    with pytest.raises(ProxyError):
+        session.login()
+    session.login(proxy_request)
+    assert len(proxy_requests(stub_cas_server)) == 1
+
+
+@pytest.mark.django_db
+def test_proxied_session_without_pgt(stub_cas_server, proxy_request):
+    ProxyGrantingTicket.objects.all().delete()
+    session = proxy.get_proxied_session(proxy_request, backend_url(stub_cas_server, 'login'))
+
+    with pytest.raises(ProxyError):
+        session.get(backend_url(stub_cas_server, 'data'))
+
+
+@pytest.mark.django_db
+def test_proxied_sessions_are_bounded(settings, stub_cas_server, proxy_request):
+    settings.CAS_PROXIED_SESSIONS_MAXSIZE = 2
+    first = proxy.get_proxied_session(proxy_request, 'http://a.example.com/')
+    proxy.get_proxied_session(proxy_request, 'http://b.example.com/')
+    assert proxy.get_proxied_session(proxy_request, 'http://a.example.com/') is first
+
+    proxy.get_proxied_session(proxy_request, 'http://c.example.com/')
+
+    assert proxy.get_proxied_session(proxy_request, 'http://a.example.com/') is first
+    assert len(proxy._sessions) == 2
+
+
+@pytest.mark.django_db
+def test_proxied_sessions_cleared_on_logout(stub_cas_server, proxy_request):
+    first = proxy.get_proxied_session(proxy_request, 'http://a.example.com/')
+
+    cas_user_logout.send(sender='manual', user=proxy_request.user,
+                         session=proxy_request.session, ticket=None)
+
+    assert proxy.get_proxied_session(proxy_request, 'http://a.example.com/') is not first
@@ -0,0 +1,183 @@
+"""Tests for the ticket stores"""
+
+import threading
+from datetime import timedelta
+from importlib import import_module
+
+import pytest
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils import timezone
+from django_cas_ng import stores
+from django_cas_ng.middleware import CASMiddleware
+from django_cas_ng.models import ProxyGrantingTicket, SessionTicket
+from django_cas_ng.views import CallbackView, LoginView
+
+SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+
+SLO = ('<samlp:LogoutRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol">'
+       '<samlp:SessionIndex>{}</samlp:SessionIndex></samlp:LogoutRequest>')
+
+
+@pytest.fixture
+def cache_store(settings):
+    settings.MIDDLEWARE = ['django_cas_ng.middleware.CASMiddleware']
+    settings.CAS_TICKET_STORE = 'django_cas_ng.stores.CacheTicketStore'
+    cache.clear()
+    yield stores.get_ticket_store()
+    cache.clear()
+
+
+def test_get_ticket_store(settings):
+    assert isinstance(stores.get_ticket_store(), stores.DatabaseTicketStore)
+    assert stores.get_ticket_store() is stores.get_ticket_store()
+    settings.CAS_TICKET_STORE = 'django_cas_ng.stores.CacheTicketStore'
+    settings.MIDDLEWARE = ['django_cas_ng.middleware.CASMiddleware']
+    assert isinstance(stores.get_ticket_store(), stores.CacheTicketStore)
+
+
+def test_cache_store_requires_middleware(settings):
+    # Without CASMiddleware, extended sessions would outlive their tickets in
+    # the cache and single logout requests would no longer find them.
+    settings.CAS_TICKET_STORE = 'django_cas_ng.stores.CacheTicketStore'
+    settings.MIDDLEWARE = []
+    with pytest.raises(ImproperlyConfigured):
+        stores.get_ticket_store()
+
+
+def test_cache_store(cache_store, django_user_model):
+    alice = django_user_model(pk=1)
+    bob = django_user_model(pk=2)
+    expires_at = timezone.now() + timedelta(hours=1)
+
+    cache_store.save_pgt('PGTIOU-1', 'PGT-1')
+    cache_store.save_login('session-1', alice, 'ST-1', 'PGTIOU-1', expires_at)
+    cache_store.save_login('session-2', bob, 'ST-2', None, expires_at)
+    assert cache_store.get_ticket('session-1') == 'ST-1'
+    assert cache_store.get_ticket(None) is None
+    assert cache_store.get_pgt('session-1', alice) == 'PGT-1'
+    assert cache_store.get_pgt('session-1', bob) is None
+    assert cache_store.get_pgt('session-2', bob) is None
+    assert cache_store.get_session_keys(['ST-1', 'ST-2', 'ST-3']) == {
+        'ST-1': 'session-1', 'ST-2': 'session-2'}
+
+    # A new login replaces the ticket and keeps the PGT of the same user
+    cache_store.save_login('session-1', alice, 'ST-3', None, expires_at)
+    assert cache_store.get_session_keys(['ST-1', 'ST-3']) == {'ST-3': 'session-1'}
+    assert cache_store.get_pgt('session-1', alice) == 'PGT-1'
+
+    cache_store.delete(['session-1', 'session-3'])
+    assert cache_store.get_ticket('session-1') is None
+    assert cache_store.get_session_keys(['ST-3']) == {}
+    assert cache_store.get_ticket('session-2') == 'ST-2'
+
+
+def test_cache_store_waits_for_other_login(cache_store, django_user_model, monkeypatch):
+    monkeypatch.setattr(stores, '_POLL_INTERVAL', 0.01)
+    alice = django_user_model(pk=1)
+    expires_at = timezone.now() + timedelta(hours=1)
+    lock_key = cache_store._session_cache_key('session-1') + ':lock'
+    # Another login of the session holds the lock, then saves its ticket
+    cache.add(lock_key, 1)
+
+    def other_login():
+        cache.set(cache_store._session_cache_key('session-1'),
+                  {'ticket': 'ST-1', 'user': 1, 'pgt': 'PGT-1'})
+        cache.set(cache_store._ticket_cache_key('ST-1'), 'session-1')
+        cache.delete(lock_key)
+    timer = threading.Timer(0.05, other_login)
+    timer.start()
+
+    cache_store.save_login('session-1', alice, 'ST-2', None, expires_at)
+    timer.join()
+
+    assert cache_store.get_session_keys(['ST-1', 'ST-2']) == {'ST-2': 'session-1'}
+    assert cache_store.get_pgt('session-1', alice) == 'PGT-1'
+    assert cache.get(lock_key) is None
+
+
+def test_incomplete_store_cannot_be_instantiated():
+    class IncompleteTicketStore(stores.BaseTicketStore):
+        def save_login(self, session_key, user, ticket, pgtiou, expires_at):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteTicketStore()
+
+
+def test_cache_store_expires_with_session(settings, cache_store, django_user_model, monkeypatch):
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    timeouts = []
+    monkeypatch.setattr(cache, 'set_many', lambda data, timeout: timeouts.append(timeout))
+    monkeypatch.setattr(cache, 'touch', lambda key, timeout: timeouts.append(timeout))
+    monkeypatch.setattr(cache, 'get', lambda key: {'ticket': 'ST-1', 'user': 1, 'pgt': None})
+
+    now = timezone.now()
+    cache_store.save_login('session-1', django_user_model(pk=1), 'ST-1', None,
+                           now + timedelta(hours=1))
+    cache_store.touch('session-1', now + timedelta(hours=2))
+    assert timeouts == [pytest.approx(3600 + 60, abs=2)] + [pytest.approx(7200 + 60, abs=2)] * 2
+
+
+@pytest.mark.django_db
+def test_login_and_slo_with_cache_store(cache_store, monkeypatch, django_user_model, settings):
+    settings.CAS_PROXY_CALLBACK = 'http://testserver/callback/'
+    settings.CAS_LOGIN_MSG = None
+    settings.CAS_VERSION = 'CAS_2_SAML_1_0'
+    monkeypatch.setattr('django_cas_ng.views.authenticate', lambda **kwargs: user)
+    user = django_user_model.objects.create_user('test@example.com', '')
+    factory = RequestFactory()
+
+    CallbackView().get(factory.get('/callback/', {'pgtIou': 'PGTIOU-1', 'pgtId': 'PGT-1'}))
+    request = factory.get('/login/', {'ticket': 'ST-1'})
+    SessionMiddleware(lambda r: None).process_request(request)
+    AuthenticationMiddleware(lambda r: None).process_request(request)
+    request.session['pgtiou'] = 'PGTIOU-1'
+    assert LoginView().get(request).status_code == 302
+    session_key = request.session.session_key
+    request.session.save()
+
+    assert not SessionTicket.objects.exists()
+    assert not ProxyGrantingTicket.objects.exists()
+    assert ProxyGrantingTicket._get_pgt(request) == 'PGT-1'
+
+    CallbackView().post(factory.post('/callback/', {'logoutRequest': SLO.format('ST-1')}))
+    assert not SessionStore().exists(session_key)
+    assert cache_store.get_ticket(session_key) is None
+
+
+@pytest.mark.django_db
+def test_slo_of_extended_session_with_cache_store(cache_store, monkeypatch, django_user_model,
+                                                  settings):
+    settings.CAS_LOGIN_MSG = None
+    settings.CAS_VERSION = 'CAS_2_SAML_1_0'
+    settings.CAS_SESSION_EXPIRY_REFRESH_INTERVAL = 60
+    monkeypatch.setattr('django_cas_ng.views.authenticate', lambda **kwargs: user)
+    user = django_user_model.objects.create_user('test@example.com', '')
+    factory = RequestFactory()
+
+    request = factory.get('/login/', {'ticket': 'ST-1'})
+    SessionMiddleware(lambda r: None).process_request(request)
+    AuthenticationMiddleware(lambda r: None).process_request(request)
+    assert LoginView().get(request).status_code == 302
+    session_key = request.session.session_key
+    request.session.save()
+
+    timeouts = []
+    touch = cache.touch
+    monkeypatch.setattr(cache, 'touch', lambda key, timeout: timeouts.append(timeout)
+                        or touch(key, timeout))
+    request = factory.get('/')
+    request.session = SessionStore(session_key)
+    request.session.set_expiry(settings.SESSION_COOKIE_AGE * 2)
+    CASMiddleware(lambda r: None).process_response(request, HttpResponse())
+    request.session.save()
+    assert timeouts == [pytest.approx(settings.SESSION_COOKIE_AGE * 2 + 60, abs=2)] * 2
+
+    CallbackView().post(factory.post('/callback/', {'logoutRequest': SLO.format('ST-1')}))
+    assert not SessionStore().exists(session_key)
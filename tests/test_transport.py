@@ -0,0 +1,310 @@
+"""Tests for the pooled HTTP transport"""
+
+import asyncio
+import threading
+import time
+from unittest.mock import Mock
+
+import httpx
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+from django.dispatch import receiver
+from django_cas_ng import transport
+from django_cas_ng.signals import cas_circuit_breaker_state_changed
+from django_cas_ng.utils import get_cas_client
+
+
+def test_clients_share_the_session(settings):
+    settings.CAS_SERVER_URL = 'https://cas.example.com/cas/'
+
+    first = get_cas_client(service_url='https://a.example.com/')
+    second = get_cas_client(service_url='https://b.example.com/')
+
+    assert first.session is second.session
+    assert first.session is transport.get_session()
+
+
+def test_session_uses_pool_settings(settings):
+    settings.CAS_HTTP_POOL_MAXSIZE = 42
+
+    adapter = transport.get_session().get_adapter('https://cas.example.com/')
+
+    assert isinstance(adapter, transport.PooledHTTPAdapter)
+    assert adapter._pool_maxsize == 42
+
+
+def test_session_factory_called_once(settings):
+    session = requests.Session()
+    settings.CAS_SESSION_FACTORY = Mock(return_value=session)
+
+    get_cas_client()
+    client = get_cas_client()
+
+    assert settings.CAS_SESSION_FACTORY.call_count == 1
+    assert client.session is session
+
+
+def test_reset_session_closes_async_clients():
+    running_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=running_loop.run_forever)
+    thread.start()
+    idle_loop = asyncio.new_event_loop()
+
+    async def get_client():
+        return transport.get_async_client()
+
+    try:
+        running_client = asyncio.run_coroutine_threadsafe(get_client(), running_loop).result(5)
+        idle_client = idle_loop.run_until_complete(get_client())
+
+        transport.reset_session()
+
+        assert idle_client.is_closed
+        deadline = time.monotonic() + 5
+        while not running_client.is_closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert running_client.is_closed
+        assert not transport._async_clients
+    finally:
+        running_loop.call_soon_threadsafe(running_loop.stop)
+        thread.join()
+        running_loop.close()
+        idle_loop.close()
+
+
+def test_session_factory_adapters_are_wrapped(settings, monkeypatch):
+    session = requests.Session()
+    adapter = session.get_adapter('https://cas.example.com/')
+    response = requests.Response()
+    response.status_code = 502
+    send = Mock(return_value=response)
+    monkeypatch.setattr(adapter, 'send', send)
+    settings.CAS_SESSION_FACTORY = Mock(return_value=session)
+    settings.CAS_HTTP_TIMEOUTS = {'validate': 3}
+    settings.CAS_CIRCUIT_BREAKER_THRESHOLD = 1
+
+    transport.get_session().get('https://cas.example.com/cas/validate')
+
+    assert send.call_args.kwargs['timeout'] == 3
+    assert transport.circuit_breaker.state == transport.CircuitBreaker.OPEN
+    with pytest.raises(transport.CircuitOpenError):
+        transport.get_session().get('https://cas.example.com/cas/validate')
+
+
+def test_session_does_not_keep_cookies(cas_server):
+    session = transport.get_session()
+    session.get(cas_server + 'validate')
+
+    assert len(session.cookies) == 0
+
+
+def test_pool_reuses_connections(settings, cas_server):
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_VERSION = 1
+    transport.reset_session()
+    before = transport.get_pool_stats()
+
+    for _ in range(3):
+        client = get_cas_client(service_url='http://testserver/login/')
+        assert client.verify_ticket('ST-1') == ('test@example.com', None, None)
+
+    after = transport.get_pool_stats()
+    assert after['requests'] - before['requests'] == 3
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 2
+
+
+def test_timeout_per_operation(settings):
+    settings.CAS_HTTP_TIMEOUT = 10
+    settings.CAS_HTTP_TIMEOUTS = {'validate': (1, 2), 'proxy': 3}
+
+    assert transport.get_timeout('https://cas.example.com/cas/serviceValidate?ticket=ST-1') == (1, 2)
+    assert transport.get_timeout('https://cas.example.com/cas/p3/serviceValidate') == (1, 2)
+    assert transport.get_timeout('https://cas.example.com/cas/validate') == (1, 2)
+    assert transport.get_timeout('https://cas.example.com/cas/proxy?pgt=PGT-1') == 3
+    assert transport.get_timeout('https://cas.example.com/cas/') == 10
+
+
+@pytest.fixture
+def breaker(settings):
+    settings.CAS_CIRCUIT_BREAKER_THRESHOLD = 2
+    settings.CAS_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+    transitions = []
+
+    @receiver(cas_circuit_breaker_state_changed)
+    def record(sender, old_state, new_state, **kwargs):
+        transitions.append((old_state, new_state))
+
+    breaker = transport.CircuitBreaker()
+    breaker.transitions = transitions
+    yield breaker
+    cas_circuit_breaker_state_changed.disconnect(record)
+
+
+def test_circuit_breaker_opens_after_threshold(breaker):
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.is_open()
+    assert breaker.transitions == [('closed', 'open')]
+    with pytest.raises(transport.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_circuit_breaker_success_resets_failures(breaker):
+    breaker.record_failure()
+    breaker.record_response(200)
+    breaker.record_failure()
+
+    assert breaker.state == breaker.CLOSED
+
+
+def test_circuit_breaker_half_open_probe(breaker, settings):
+    breaker.record_failure()
+    breaker.record_response(502)
+    settings.CAS_CIRCUIT_BREAKER_RESET_TIMEOUT = 0
+    breaker.opened_at -= 1
+
+    # A single probe is let through
+    breaker.before_call()
+    assert breaker.state == breaker.HALF_OPEN
+    with pytest.raises(transport.CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.transitions == [
+        ('closed', 'open'),
+        ('open', 'half-open'),
+        ('half-open', 'open'),
+        ('open', 'half-open'),
+        ('half-open', 'closed'),
+    ]
+
+
+def test_circuit_breaker_cancelled_probe(breaker, monkeypatch, settings):
+    settings.CAS_CIRCUIT_BREAKER_RESET_TIMEOUT = 0
+    monkeypatch.setattr(transport, 'circuit_breaker', breaker)
+    breaker.record_failure()
+    breaker.record_failure()
+    started = asyncio.Event()
+
+    async def handle_async_request(self, request):
+        started.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, 'handle_async_request', handle_async_request)
+
+    async def cancel_probe():
+        async with httpx.AsyncClient(transport=transport.CircuitBreakerAsyncTransport()) as client:
+            probe = asyncio.ensure_future(client.get('https://cas.example.com/cas/validate'))
+            await started.wait()
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+
+    asyncio.run(cancel_probe())
+
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.is_open()
+    # The next request probes the server
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+
+
+def test_circuit_breaker_disabled_by_default():
+    breaker = transport.CircuitBreaker()
+    for _ in range(10):
+        breaker.record_failure()
+
+    assert breaker.state == breaker.CLOSED
+    breaker.before_call()
+
+
+def test_circuit_breaker_fails_fast_on_unreachable_server(settings):
+    settings.CAS_CIRCUIT_BREAKER_THRESHOLD = 1
+    # Nothing listens on port 9 (discard) here
+    settings.CAS_SERVER_URL = 'http://127.0.0.1:9/cas/'
+    client = get_cas_client(service_url='http://testserver/login/')
+
+    with pytest.raises(requests.ConnectionError) as excinfo:
+        client.verify_ticket('ST-1')
+    assert not isinstance(excinfo.value, transport.CircuitOpenError)
+    assert transport.circuit_breaker.is_open()
+
+    with pytest.raises(transport.CircuitOpenError):
+        client.verify_ticket('ST-1')
+
+
+def test_warmup_opens_pooled_connections(settings, stub_cas_server):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+    # Keep the connections busy long enough for the requests to overlap
+    stub_cas_server.head_delay = 0.1
+    transport.reset_session()
+    before = transport.get_pool_stats()
+
+    assert transport.warmup(connections=3) == 3
+    after_warmup = transport.get_pool_stats()
+    assert after_warmup['misses'] - before['misses'] == 3
+
+    # The validation reuses a warm connection
+    get_cas_client(service_url='http://testserver/login/').verify_ticket('ST-1')
+    after = transport.get_pool_stats()
+    assert after['misses'] == after_warmup['misses']
+    assert after['hits'] - after_warmup['hits'] == 1
+
+
+def test_warmup_skips_relative_server_url(settings):
+    settings.CAS_SERVER_URL = '/cas/'
+
+    assert transport.warmup() == 0
+
+
+def test_awarmup(settings, stub_cas_server):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+
+    assert async_to_sync(transport.awarmup)(connections=2) == 2
+    assert len(stub_cas_server.requests) == 2
+
+
+def test_preconnect_is_throttled(monkeypatch):
+    calls = []
+    monkeypatch.setattr(transport, '_preconnect_at', 0.0)
+    monkeypatch.setattr(transport, 'warmup', lambda server_url=None: calls.append(server_url))
+
+    transport.preconnect('https://cas.example.com/cas/')
+    transport.preconnect('https://cas.example.com/cas/')
+
+    for thread in threading.enumerate():
+        if thread.name == 'django-cas-ng-preconnect':
+            thread.join()
+    assert calls == ['https://cas.example.com/cas/']
+
+
+def test_keepalive_pings_server(settings, stub_cas_server, monkeypatch):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+    settings.CAS_HTTP_KEEPALIVE_INTERVAL = 0.01
+    monkeypatch.setattr(transport, '_keepalive_pid', None)
+
+    transport.start_keepalive()
+    transport.start_keepalive()
+    deadline = time.monotonic() + 5
+    while len(stub_cas_server.requests) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    settings.CAS_HTTP_KEEPALIVE_INTERVAL = None
+
+    assert len(stub_cas_server.requests) >= 2
+    keepalive_threads = [t for t in threading.enumerate() if t.name == 'django-cas-ng-keepalive']
+    assert len(keepalive_threads) <= 1
+    # Don't let a last ping pollute the pool counters of other tests
+    for thread in keepalive_threads:
+        thread.join()
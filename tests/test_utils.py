@@ -1,8 +1,14 @@
 from unittest.mock import Mock
 
+import pytest
+from asgiref.sync import async_to_sync
 import requests
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.sessions.backends.db import SessionStore
 from django.test import RequestFactory
-from django_cas_ng.utils import get_redirect_url, get_service_url, get_cas_client
+from django_cas_ng import utils
+from django_cas_ng.utils import averify_ticket, get_redirect_url, get_service_url, get_cas_client
 
 
 #
@@ -222,3 +228,120 @@ def test_session_factory(settings):
 
     assert settings.CAS_SESSION_FACTORY.called
     assert client.session is session
+
+
+def test_cas_client_template_is_cached(settings):
+    settings.CAS_SERVER_URL = 'https://cas.example.com/cas/'
+
+    first = get_cas_client(service_url='https://a.example.com/')
+    second = get_cas_client(service_url='https://b.example.com/')
+
+    assert first is not second
+    assert first.service_url == 'https://a.example.com/'
+    assert second.service_url == 'https://b.example.com/'
+    assert utils._get_cas_client_template.cache_info().hits >= 1
+
+
+def test_cas_client_template_cleared_on_setting_change(settings):
+    settings.CAS_SERVER_URL = 'https://cas.example.com/cas/'
+    assert get_cas_client().renew is False
+
+    settings.CAS_RENEW = True
+    assert get_cas_client().renew is True
+
+
+def test_cas_client_relative_server_url_per_host(settings):
+    settings.CAS_SERVER_URL = '/cas/'
+    factory = RequestFactory()
+
+    first = get_cas_client(request=factory.get('/login/', HTTP_HOST='a.example.com'))
+    second = get_cas_client(request=factory.get('/login/', HTTP_HOST='b.example.com'))
+
+    assert first.server_url == 'http://a.example.com/cas/'
+    assert second.server_url == 'http://b.example.com/cas/'
+
+
+def test_cas_client_ssl_warning_emitted_once(settings):
+    settings.CAS_SERVER_URL = 'https://cas.example.com/cas/'
+    settings.CAS_VERIFY_SSL_CERTIFICATE = False
+
+    with pytest.warns(UserWarning) as record:
+        get_cas_client()
+        get_cas_client()
+
+    # Garbage collected sockets of other tests may warn meanwhile
+    assert len([w for w in record if 'CAS_VERIFY_SSL_CERTIFICATE' in str(w.message)]) == 1
+
+
+@pytest.mark.parametrize('version', [1, '2', '3'])
+def test_averify_ticket(settings, cas_server, version):
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_VERSION = version
+    client = get_cas_client(service_url='http://testserver/login/')
+
+    expected = client.verify_ticket('ST-fake-ticket')
+    actual = async_to_sync(averify_ticket)(client, 'ST-fake-ticket')
+
+    assert actual == expected
+    assert actual[0] == 'test@example.com'
+    assert async_to_sync(averify_ticket)(client, 'bad-ticket')[0] is None
+
+
+class GetUserBackend(ModelBackend):
+    def get_user(self, user_id):
+        return super().get_user(user_id)
+
+
+def make_user_session(user=None, backend='django.contrib.auth.backends.ModelBackend'):
+    session = SessionStore()
+    if user is not None:
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = backend
+    session.create()
+    return session
+
+
+@pytest.mark.django_db
+def test_get_users_from_sessions(django_assert_num_queries):
+    User = get_user_model()
+    alice = User.objects.create_user('alice')
+    bob = User.objects.create_user('bob')
+    deleted = User.objects.create_user('deleted')
+    sessions = [make_user_session(alice), make_user_session(bob),
+                make_user_session(deleted), make_user_session()]
+    deleted.delete()
+    session_keys = [session.session_key for session in sessions]
+
+    # The session of bob is given as a store, already loaded
+    sessions[1].load()
+    with django_assert_num_queries(4):
+        users = utils.get_users_from_sessions(session_keys[:1] + sessions[1:2] + session_keys[2:])
+    assert users[session_keys[0]] == alice
+    assert users[session_keys[1]] == bob
+    assert not users[session_keys[2]].is_authenticated
+    assert not users[session_keys[3]].is_authenticated
+
+
+@pytest.mark.django_db
+def test_get_users_from_session_data_custom_get_user():
+    User = get_user_model()
+    alice = User.objects.create_user('alice')
+    backend = 'tests.test_utils.GetUserBackend'
+    sessions = {
+        'alice': {SESSION_KEY: str(alice.pk), BACKEND_SESSION_KEY: backend},
+        'missing': {SESSION_KEY: str(alice.pk + 1), BACKEND_SESSION_KEY: backend},
+        'invalid': {SESSION_KEY: 'x', BACKEND_SESSION_KEY: 'missing.Backend'},
+        'anonymous': {},
+    }
+
+    users = utils.get_users_from_session_data(sessions)
+    assert users['alice'] == alice
+    assert not users['missing'].is_authenticated
+    assert not users['invalid'].is_authenticated
+    assert not users['anonymous'].is_authenticated
+
+
+def test_is_session_authenticated():
+    assert utils.is_session_authenticated({SESSION_KEY: '1', BACKEND_SESSION_KEY: 'backend'})
+    assert not utils.is_session_authenticated({SESSION_KEY: '1'})
+    assert not utils.is_session_authenticated({})
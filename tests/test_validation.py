@@ -0,0 +1,312 @@
+"""Tests for the ticket validation helpers"""
+
+import asyncio
+import json
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from cas import CASClientV2, CASClientV3
+from django.core.cache import cache
+from django_cas_ng import validation
+from django_cas_ng.utils import get_cas_client
+
+
+@pytest.fixture
+def replay(settings):
+    settings.CAS_TICKET_REPLAY_TIMEOUT = 30
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def make_client(service_url='http://testserver/login/'):
+    client = Mock()
+    client.service_url = service_url
+    client.verify_ticket.return_value = ('test@example.com', {'email': 'test@example.com'}, None)
+    return client
+
+
+def test_verify_ticket_without_replay():
+    client = make_client()
+
+    validation.verify_ticket(client, 'ST-1')
+    validation.verify_ticket(client, 'ST-1')
+
+    assert client.verify_ticket.call_count == 2
+
+
+def test_verify_ticket_replays_result(replay):
+    client = make_client()
+
+    first = validation.verify_ticket(client, 'ST-1')
+    second = validation.verify_ticket(client, 'ST-1')
+
+    assert client.verify_ticket.call_count == 1
+    assert first == second
+    # Callers may mutate the attributes, they must not share them
+    assert first[1] is not second[1]
+
+
+def test_verify_ticket_replay_is_per_service(replay):
+    client = make_client()
+    other = make_client('http://testserver/other/')
+
+    validation.verify_ticket(client, 'ST-1')
+    validation.verify_ticket(other, 'ST-1')
+
+    assert client.verify_ticket.call_count == 1
+    assert other.verify_ticket.call_count == 1
+
+
+def test_verify_ticket_coalesces_concurrent_calls(replay):
+    started = threading.Event()
+    client = make_client()
+
+    def slow_verify(ticket):
+        started.set()
+        time.sleep(0.1)
+        return 'test@example.com', None, None
+    client.verify_ticket.side_effect = slow_verify
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(validation.verify_ticket(client, 'ST-1')))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.verify_ticket.call_count == 1
+    assert results == [('test@example.com', None, None)] * 5
+
+
+def test_verify_ticket_waits_for_other_process(replay, monkeypatch):
+    monkeypatch.setattr(validation, '_POLL_INTERVAL', 0.01)
+    client = make_client()
+    key = validation._cache_key('ST-1', client.service_url)
+    # Another process holds the lock, then publishes its result
+    cache.add(key + ':lock', 1)
+    timer = threading.Timer(0.05, cache.set, (key, ('other@example.com', None, None)))
+    timer.start()
+
+    result = validation.verify_ticket(client, 'ST-1')
+    timer.join()
+
+    assert result == ('other@example.com', None, None)
+    assert client.verify_ticket.call_count == 0
+
+
+def test_averify_ticket_coalesces_concurrent_calls(replay, monkeypatch):
+    calls = []
+
+    async def slow_averify(client, ticket):
+        calls.append(ticket)
+        await asyncio.sleep(0.05)
+        return 'test@example.com', {'email': 'test@example.com'}, None
+    monkeypatch.setattr(validation, '_averify', slow_averify)
+    client = make_client()
+
+    async def verify_concurrently():
+        return await asyncio.gather(*[validation.averify_ticket(client, 'ST-1') for _ in range(5)])
+
+    results = asyncio.run(verify_concurrently())
+
+    assert calls == ['ST-1']
+    assert results == [('test@example.com', {'email': 'test@example.com'}, None)] * 5
+    assert results[0][1] is not results[1][1]
+
+
+def test_averify_ticket_takes_over_cancelled_call(replay, monkeypatch):
+    calls = []
+    started = asyncio.Event()
+
+    async def slow_averify(client, ticket):
+        calls.append(ticket)
+        started.set()
+        await asyncio.sleep(0.05)
+        return 'test@example.com', None, None
+    monkeypatch.setattr(validation, '_averify', slow_averify)
+    client = make_client()
+
+    async def cancel_first():
+        first = asyncio.ensure_future(validation.averify_ticket(client, 'ST-1'))
+        await asyncio.wait_for(started.wait(), 5)
+        second = asyncio.ensure_future(validation.averify_ticket(client, 'ST-1'))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(cancel_first()) == ('test@example.com', None, None)
+    assert calls == ['ST-1', 'ST-1']
+
+
+def test_averify_ticket_waits_for_other_process(replay, monkeypatch):
+    monkeypatch.setattr(validation, '_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(validation, '_averify', Mock(side_effect=AssertionError))
+    client = make_client()
+    key = validation._cache_key('ST-1', client.service_url)
+    cache.add(key + ':lock', 1)
+    timer = threading.Timer(0.05, cache.set, (key, ('other@example.com', None, None)))
+    timer.start()
+
+    result = async_to_sync(validation.averify_ticket)(client, 'ST-1')
+    timer.join()
+
+    assert result == ('other@example.com', None, None)
+
+
+def test_verify_ticket_error_is_not_cached(replay):
+    client = make_client()
+    client.verify_ticket.side_effect = [ValueError('boom'), ('test@example.com', None, None)]
+
+    with pytest.raises(ValueError):
+        validation.verify_ticket(client, 'ST-1')
+
+    assert validation.verify_ticket(client, 'ST-1') == ('test@example.com', None, None)
+
+
+def make_xml_response(attributes, pgtiou=None):
+    values = ''.join(
+        '<cas:{0}>{1}</cas:{0}>'.format(name, value)
+        for name, values in attributes.items()
+        for value in values
+    )
+    pgt = '<cas:proxyGrantingTicket>{}</cas:proxyGrantingTicket>'.format(pgtiou) if pgtiou else ''
+    return (
+        '<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">'
+        '<cas:authenticationSuccess><cas:user>test@example.com</cas:user>'
+        '{}<cas:attributes>{}</cas:attributes>'
+        '</cas:authenticationSuccess></cas:serviceResponse>'
+    ).format(pgt, values).encode('utf-8')
+
+
+def make_json_response(attributes, pgtiou=None):
+    success = {'user': 'test@example.com', 'attributes': attributes}
+    if pgtiou:
+        success['proxyGrantingTicket'] = pgtiou
+    return json.dumps({'serviceResponse': {'authenticationSuccess': success}}).encode('utf-8')
+
+
+def test_parse_json_response_matches_xml():
+    attributes = {
+        'email': ['test@example.com'],
+        'memberOf': ['cn=group%d,ou=groups' % i for i in range(500)],
+    }
+
+    expected = CASClientV3.verify_response(make_xml_response(attributes, 'PGTIOU-1'))
+    actual = validation.parse_json_response(make_json_response(attributes, 'PGTIOU-1'))
+
+    assert actual == expected
+    assert actual[1]['email'] == 'test@example.com'
+    assert len(actual[1]['memberOf']) == 500
+
+
+def test_parse_json_response_scalars_match_xml():
+    expected = CASClientV3.verify_response(make_xml_response({
+        'isStaff': ['true'], 'uid': ['1001'], 'weight': ['1.5'], 'empty': [''],
+        'flags': ['false', 'true'],
+    }))
+    actual = validation.parse_json_response(make_json_response({
+        'isStaff': [True], 'uid': [1001], 'weight': 1.5, 'empty': [None],
+        'flags': [False, True],
+    }))
+
+    assert actual == expected
+    assert actual[1]['isStaff'] == 'true'
+    assert actual[1]['empty'] is None
+
+
+def test_parse_json_response_failure():
+    content = json.dumps({'serviceResponse': {'authenticationFailure': {
+        'code': 'INVALID_TICKET', 'description': 'Ticket ST-1 not recognized'}}})
+
+    assert validation.parse_json_response(content) == (None, {}, None)
+
+
+@pytest.mark.parametrize('version, expected_format', [('3', 'JSON'), ('2', None)])
+def test_verify_ticket_json_format(settings, stub_cas_server, version, expected_format):
+    settings.CAS_SERVER_URL = stub_cas_server.url
+    settings.CAS_VERSION = version
+    settings.CAS_RESPONSE_FORMAT = 'JSON'
+    client = get_cas_client(service_url='http://testserver/login/')
+
+    username, attributes, pgtiou = validation.verify_ticket(client, 'ST-1')
+    async_username, async_attributes, _ = async_to_sync(validation.averify_ticket)(client, 'ST-1')
+
+    assert username == async_username == 'test@example.com'
+    assert attributes == async_attributes
+    assert attributes['affiliation'] == ['staff', 'faculty']
+    assert attributes['email'] == 'test@example.com'
+    assert validation.verify_ticket(client, 'bad-ticket')[0] is None
+    assert [params.get('format') for _, params in stub_cas_server.requests] == [expected_format] * 3
+
+
+XML_DOCUMENTS = [
+    # No attributes, proxy granting ticket
+    b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas"><cas:authenticationSuccess>'
+    b'<cas:user>username</cas:user>'
+    b'<cas:proxyGrantingTicket>PGTIOU-84678-8a9d</cas:proxyGrantingTicket>'
+    b'</cas:authenticationSuccess></cas:serviceResponse>',
+    # Failure
+    b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">'
+    b'<cas:authenticationFailure code="INVALID_TICKET">Ticket ST-1 not recognized'
+    b'</cas:authenticationFailure></cas:serviceResponse>',
+    # attraStyle, multi-valued attributes, whitespace
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">\n'
+    b'  <cas:authenticationSuccess>\n    <cas:user>username</cas:user>\n'
+    b'    <cas:attributes>\n      <cas:attraStyle>Jasig</cas:attraStyle>\n'
+    b'      <cas:firstname>John</cas:firstname>\n'
+    b'      <cas:affiliation>staff</cas:affiliation>\n'
+    b'      <cas:affiliation>faculty</cas:affiliation>\n'
+    b'      <cas:affiliation>alumni</cas:affiliation>\n'
+    b'      <cas:empty></cas:empty>\n'
+    b'    </cas:attributes>\n  </cas:authenticationSuccess>\n</cas:serviceResponse>\n',
+    # norEduPerson, other namespace, unicode
+    '<sso:serviceResponse xmlns:sso="urn:example:sso"><sso:authenticationSuccess>'
+    '<sso:user>jöhn</sso:user><sso:norEduPerson><sso:cn>Jöhn Døe</sso:cn>'
+    '<sso:nested><sso:deep>x</sso:deep></sso:nested></sso:norEduPerson>'
+    '</sso:authenticationSuccess></sso:serviceResponse>'.encode('utf-8'),
+]
+
+
+@pytest.mark.parametrize('document', XML_DOCUMENTS)
+@pytest.mark.parametrize('client_class, version', [(CASClientV2, '2'), (CASClientV3, '3')])
+def test_parse_xml_response_matches_python_cas(document, client_class, version):
+    expected = client_class.verify_response(document)
+
+    assert validation.parse_xml_response([document], version) == expected
+    # Split in chunks at every byte
+    chunks = [document[i:i + 1] for i in range(len(document))]
+    assert validation.parse_xml_response(chunks, version) == expected
+
+
+def test_parse_xml_response_large_payload():
+    attributes = {
+        'email': ['test@example.com'],
+        'memberOf': ['cn=group%d,ou=groups' % i for i in range(500)],
+    }
+    document = make_xml_response(attributes, 'PGTIOU-1')
+
+    assert validation.parse_xml_response([document]) == CASClientV3.verify_response(document)
+
+
+@pytest.mark.parametrize('version', ['2', '3'])
+def test_verify_ticket_native_parser(settings, cas_server, monkeypatch, version):
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_VERSION = version
+    client = get_cas_client(service_url='http://testserver/login/')
+    expected = client.verify_ticket('ST-1')
+    expected_failure = client.verify_ticket('bad-ticket')
+
+    settings.CAS_NATIVE_XML_PARSER = True
+    monkeypatch.setattr(type(client), 'verify_response', Mock(side_effect=AssertionError))
+
+    assert validation.verify_ticket(client, 'ST-1') == expected
+    assert async_to_sync(validation.averify_ticket)(client, 'ST-1') == expected
+    assert validation.verify_ticket(client, 'bad-ticket') == expected_failure
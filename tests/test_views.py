@@ -2,14 +2,29 @@ from importlib import import_module
 from unittest.mock import Mock
 
 import pytest
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.signals import user_login_failed
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.http import HttpResponseRedirect
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django_cas_ng import views
+from django_cas_ng.backends import CASBackend
 from django_cas_ng.models import ProxyGrantingTicket, SessionTicket
+from django_cas_ng.transport import CircuitOpenError
 from django_cas_ng.utils import RedirectException
-from django_cas_ng.views import CallbackView, LoginView, LogoutView, is_local_url, clean_next_page
+from django_cas_ng.views import (
+    AsyncLoginView,
+    CallbackView,
+    LoginView,
+    LogoutView,
+    clean_next_page,
+    is_local_url,
+)
 
 SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
@@ -459,3 +474,165 @@ def test_callback_post_logout(django_user_model, settings):
                                               pgt='fake-ticket').exists() is False
     assert SessionTicket.objects.filter(session_key=session.session_key,
                                         ticket='fake-ticket').exists() is False
+
+
+@pytest.mark.django_db
+def test_async_login_authenticate_against_cas_server(django_user_model, settings, cas_server):
+    """
+    Test the asynchronous login view validates the ticket against the CAS server.
+    """
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_LOGIN_MSG = None
+    settings.AUTHENTICATION_BACKENDS = ['django_cas_ng.backends.CASBackend']
+
+    factory = RequestFactory()
+    request = factory.get('/login/', {'ticket': 'ST-fake-ticket'})
+
+    # Create a session object from the middleware
+    process_request_for_middleware(request, SessionMiddleware)
+    # Create a user object from middleware
+    process_request_for_middleware(request, AuthenticationMiddleware)
+
+    response = async_to_sync(AsyncLoginView().get)(request)
+    assert response.status_code == 302
+    assert response['Location'] == '/'
+    assert django_user_model.objects.filter(username='test@example.com').exists()
+    assert SessionTicket.objects.filter(ticket='ST-fake-ticket').exists()
+
+
+@pytest.mark.django_db
+def test_async_login_invalid_ticket(django_user_model, settings, cas_server):
+    settings.CAS_SERVER_URL = cas_server
+    settings.AUTHENTICATION_BACKENDS = ['django_cas_ng.backends.CASBackend']
+
+    factory = RequestFactory()
+    request = factory.get('/login/', {'ticket': 'bad-ticket'})
+    process_request_for_middleware(request, SessionMiddleware)
+    process_request_for_middleware(request, AuthenticationMiddleware)
+
+    with pytest.raises(PermissionDenied):
+        async_to_sync(AsyncLoginView().get)(request)
+
+
+@pytest.mark.django_db
+def test_async_login_awaits_backend_before_django_5_2(django_user_model, settings, cas_server,
+                                                      monkeypatch):
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_LOGIN_MSG = None
+    settings.AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.ModelBackend',
+                                        'django_cas_ng.backends.CASBackend']
+    # Before Django 5.2 aauthenticate() runs authenticate() in a thread
+    monkeypatch.setattr('django_cas_ng.views.aauthenticate', views._aauthenticate)
+    monkeypatch.setattr(CASBackend, 'authenticate', Mock(side_effect=AssertionError))
+    failures = []
+
+    def record_failure(sender, **kwargs):
+        failures.append(kwargs)
+    user_login_failed.connect(record_failure)
+
+    request = RequestFactory().get('/login/', {'ticket': 'ST-fake-ticket'})
+    process_request_for_middleware(request, SessionMiddleware)
+    process_request_for_middleware(request, AuthenticationMiddleware)
+    response = async_to_sync(AsyncLoginView().get)(request)
+
+    assert response.status_code == 302
+    assert request.user.backend == 'django_cas_ng.backends.CASBackend'
+
+    user = async_to_sync(views._aauthenticate)(request, ticket='bad-ticket',
+                                               service='http://testserver/login/')
+    user_login_failed.disconnect(record_failure)
+    assert user is None
+    assert len(failures) == 1
+
+
+def test_async_login_view_is_async():
+    assert AsyncLoginView.view_is_async is True
+
+
+@pytest.mark.django_db
+def test_login_fails_fast_when_circuit_open(monkeypatch, settings):
+    settings.AUTHENTICATION_BACKENDS = ['django_cas_ng.backends.CASBackend']
+
+    def mock_verify(ticket, service):
+        raise CircuitOpenError('open')
+    monkeypatch.setattr('cas.CASClientV2.verify_ticket', mock_verify)
+
+    factory = RequestFactory()
+    request = factory.get('/login/', {'ticket': 'fake-ticket'})
+    process_request_for_middleware(request, SessionMiddleware)
+    process_request_for_middleware(request, AuthenticationMiddleware)
+
+    response = LoginView().get(request)
+    assert response.status_code == 503
+
+    settings.CAS_CIRCUIT_OPEN_RESPONSE = lambda request: HttpResponseRedirect('/maintenance/')
+    response = LoginView().get(request)
+    assert response.status_code == 302
+    assert response['Location'] == '/maintenance/'
+
+
+@pytest.mark.django_db
+def test_login_no_ticket_preconnects(monkeypatch, settings):
+    settings.CAS_SERVER_URL = 'https://cas.example.com/cas/'
+    settings.CAS_HTTP_PRECONNECT = True
+    calls = []
+    monkeypatch.setattr('django_cas_ng.views.preconnect', calls.append)
+
+    factory = RequestFactory()
+    request = factory.get('/login/')
+    process_request_for_middleware(request, SessionMiddleware)
+    process_request_for_middleware(request, AuthenticationMiddleware)
+
+    response = LoginView().get(request)
+    assert response.status_code == 302
+    assert calls == ['https://cas.example.com/cas/']
+
+
+def run_with_query_budget(budget, func, *args):
+    """Runs ``func`` and checks it runs ``budget`` statements, transaction control aside."""
+    with CaptureQueriesContext(connection) as context:
+        response = func(*args)
+    statements = [query['sql'] for query in context.captured_queries
+                  if 'SAVEPOINT' not in query['sql']]
+    assert len(statements) == budget, '\n'.join(statements)
+    return response
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('pgtiou, budget', [(None, 7), ('PGTIOU-1', 9)])
+def test_login_logout_query_budget(django_user_model, settings, cas_server, pgtiou, budget):
+    """
+    Login costs a user lookup, the session key rotation and last_login update
+    made by Django, a SessionTicket upsert, and two PGT statements with a
+    proxy callback. Logout costs a SessionTicket lookup, two deletes and the
+    session deletion.
+    """
+    settings.CAS_SERVER_URL = cas_server
+    settings.CAS_LOGIN_MSG = None
+    settings.CAS_PROXY_CALLBACK = 'http://testserver/callback/'
+    settings.AUTHENTICATION_BACKENDS = ['django_cas_ng.backends.CASBackend']
+    user = django_user_model.objects.create_user('test@example.com', '')
+    ProxyGrantingTicket.objects.create(pgtiou='PGTIOU-1', pgt='PGT-1')
+
+    factory = RequestFactory()
+    request = factory.get('/login/', {'ticket': 'ST-1'})
+    process_request_for_middleware(request, SessionMiddleware)
+    process_request_for_middleware(request, AuthenticationMiddleware)
+    request.session['pgtiou'] = pgtiou
+
+    response = run_with_query_budget(budget, LoginView().get, request)
+    assert response.status_code == 302
+    session_key = request.session.session_key
+    session_ticket = SessionTicket.objects.for_session_key(session_key).get()
+    assert session_ticket.ticket == 'ST-1'
+    assert session_ticket.expires_at is not None
+    pgts = ProxyGrantingTicket.objects.for_session_key(session_key)
+    assert list(pgts.values_list('expires_at', flat=True)) == [session_ticket.expires_at] * bool(pgtiou)
+
+    logout_request = factory.get('/logout/')
+    logout_request.session = request.session
+    logout_request.user = user
+    response = run_with_query_budget(5, LogoutView().get, logout_request)
+    assert response.status_code == 302
+    assert not SessionTicket.objects.exists()
+    assert not ProxyGrantingTicket.objects.for_session_key(session_key).exists()